@@ -0,0 +1,149 @@
+"""
+Compressed ts_kv dumps and device files: gzip (.gz), zstd (.zst) and lz4 (.lz4).
+
+The files are compressed and decompressed by the command line tools if they are installed:
+pigz or gzip, zstd, lz4. The tool runs in its own process, so the data are decompressed
+in parallel with parsing of the csv, and pigz -p, zstd -T0 compress by several threads.
+Without the tools, gzip module and zstandard, lz4 packages are used
+(zstandard compresses by several threads as well).
+
+A compressed file is appended by adding a new frame (gzip member),
+all the tools and the packages read the concatenated frames.
+
+petl reads and writes the files via source(file):
+    tbl = petl.fromcsv(compression.source('ts_kv_1.csv.zst'), delimiter=';')
+    petl.appendcsv(tbl, compression.source('Device_A.csv.zst'), delimiter=';')
+"""
+import gzip
+import os
+import shutil
+import subprocess
+from contextlib import contextmanager
+
+CODECS = ('gzip', 'zstd', 'lz4')
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+THREADS = os.cpu_count() or 1
+USE_TOOLS = True
+# the tools in the order of preference
+READ_TOOLS = {'gzip': [['pigz', '-dc'], ['gzip', '-dc']],
+              'zstd': [['zstd', '-dcq']],
+              'lz4': [['lz4', '-dcq']]}
+WRITE_TOOLS = {'gzip': [['pigz', '-c', '-p', str(THREADS)], ['gzip', '-c']],
+               'zstd': [['zstd', '-cq', '-T0']],
+               'lz4': [['lz4', '-cq']]}
+
+
+def codec(file):
+    """The codec of the file by its extension or None if the file is not compressed"""
+    for name, extension in EXTENSIONS.items():
+        if file.endswith(extension):
+            return name
+    return None
+
+
+def split_extension(file):
+    """('Device_A.csv', '.gz') for 'Device_A.csv.gz', ('Device_A.csv', '') for 'Device_A.csv'"""
+    name = codec(file)
+    if name is None:
+        return file, ''
+    return file[:-len(EXTENSIONS[name])], EXTENSIONS[name]
+
+
+def extension(codec_name):
+    if codec_name is None:
+        return ''
+    if codec_name not in EXTENSIONS:
+        raise ValueError(f"Unknown compression {codec_name}. Possible values are {', '.join(CODECS)}")
+    return EXTENSIONS[codec_name]
+
+
+class FileSource:
+    """petl source of the compressed or plain file"""
+
+    def __init__(self, file):
+        self.file = file
+
+    def open(self, mode='r'):
+        return open_file(self.file, mode)
+
+
+def source(file):
+    """petl source of the file: the file itself if it is not compressed"""
+    return FileSource(file) if codec(file) else file
+
+
+@contextmanager
+def open_file(file, mode='rb'):
+    """Binary file object of the compressed or plain file. mode is 'rb', 'wb' or 'ab' ('r', 'w', 'a' are the same)."""
+    mode = mode.replace('b', '').replace('t', '')
+    codec_name = codec(file)
+    if codec_name is None:
+        with open(file, mode + 'b') as f:
+            yield f
+        return
+    tool = _find_tool((READ_TOOLS if mode == 'r' else WRITE_TOOLS)[codec_name])
+    if tool and mode == 'r':
+        with _read_by_tool(tool, file) as f:
+            yield f
+    elif tool:
+        with _write_by_tool(tool, file, mode) as f:
+            yield f
+    else:
+        f = _open_by_package(codec_name, file, mode)
+        try:
+            yield f
+        finally:
+            f.close()
+
+
+def _find_tool(tools):
+    if not USE_TOOLS:
+        return None
+    for tool in tools:
+        if shutil.which(tool[0]):
+            return tool
+    return None
+
+
+@contextmanager
+def _read_by_tool(tool, file):
+    proc = subprocess.Popen(tool + [file], stdout=subprocess.PIPE)
+    try:
+        yield proc.stdout
+        # the reader stopped before the end of the file, e.g. petl read only the header
+        stopped = proc.stdout.closed or bool(proc.stdout.read(1))
+    except BaseException:
+        stopped = True
+        raise
+    finally:
+        if stopped:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+    if not stopped and proc.returncode != 0:
+        raise OSError(f"{tool[0]} failed to decompress {file}, exit code {proc.returncode}")
+
+
+@contextmanager
+def _write_by_tool(tool, file, mode):
+    with open(file, mode + 'b') as out:
+        proc = subprocess.Popen(tool, stdin=subprocess.PIPE, stdout=out)
+        try:
+            yield proc.stdin
+        finally:
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise OSError(f"{tool[0]} failed to compress {file}, exit code {proc.returncode}")
+
+
+def _open_by_package(codec_name, file, mode):
+    if codec_name == 'gzip':
+        return gzip.open(file, mode + 'b')
+    if codec_name == 'zstd':
+        import zstandard
+        if mode == 'r':
+            return zstandard.ZstdDecompressor().stream_reader(open(file, 'rb'), read_across_frames=True,
+                                                              closefd=True)
+        return zstandard.ZstdCompressor(threads=-1).stream_writer(open(file, mode + 'b'), closefd=True)
+    import lz4.frame
+    return lz4.frame.open(file, mode + 'b')
@@ -0,0 +1,131 @@
+import copy
+import threading
+from urllib.parse import urlparse
+
+import pytest
+
+import entity_backup as backup
+import tb_rest as tb
+
+TB_URL = 'http://tb'
+LISTS = {'/api/customers': 'CUSTOMER', '/api/tenant/assets': 'ASSET', '/api/tenant/devices': 'DEVICE',
+         '/api/tenant/dashboards': 'DASHBOARD', '/api/ruleChains': 'RULECHAIN'}
+POSTS = {'/api/customer': 'CUSTOMER', '/api/asset': 'ASSET', '/api/device': 'DEVICE'}
+
+
+class FakeResponse:
+    def __init__(self, url, status_code, data=None):
+        self.url = url
+        self.status_code = status_code
+        self.data = data
+        self.text = '' if status_code == 200 else f"Error {status_code}"
+
+    def json(self):
+        return self.data
+
+
+class FakeTb:
+    """
+    Tenant of Thingsboard served by the REST API calls of tb_rest, used as the session of the requests.
+    The requests of the urls in fail are failed with 500, the first creation of an entity with the name
+    in lose creates it, but its response is lost (503).
+    """
+
+    def __init__(self):
+        self.entities = {name: [] for name in ('CUSTOMER', 'ASSET', 'DEVICE', 'DASHBOARD', 'RULECHAIN')}
+        self.details = {}  # the configuration of the dashboards and the metadata of the rule chains by their ids
+        self.relations = []
+        self.attributes = {}  # id -> {scope: [{'key', 'value', 'lastUpdateTs'}]}
+        self.fail = set()
+        self.lose = set()
+        self.posted = []  # (url path, json) of the POST requests
+        self.ids = 0
+        self.lock = threading.Lock()
+
+    def add(self, entity_type, name, **fields):
+        """Creates the entity, returns it"""
+        with self.lock:
+            self.ids += 1
+            entity_id = f"{entity_type.lower()}-{self.ids}"
+        name_field = 'title' if entity_type in ('CUSTOMER', 'DASHBOARD') else 'name'
+        entity = {'id': {'entityType': entity_type, 'id': entity_id}, 'createdTime': self.ids, 'version': 1,
+                  name_field: name, **fields}
+        self.entities[entity_type].append(entity)
+        return entity
+
+    def update(self, entity, **fields):
+        entity.update(fields)
+        entity['version'] += 1
+
+    def remove(self, entity):
+        self.entities[entity['id']['entityType']].remove(entity)
+        self.attributes.pop(entity['id']['id'], None)
+        self.relations = [r for r in self.relations if entity['id'] not in (r['from'], r['to'])]
+
+    def find(self, entity_type, name):
+        return [e for e in self.entities[entity_type] if backup_name(e) == name]
+
+    def get(self, url, headers=None, params=None):
+        path = urlparse(url).path
+        params = params or {}
+        if path in self.fail:
+            return FakeResponse(url, 500)
+        if path in LISTS:
+            entities = self.entities[LISTS[path]]
+            if params.get('textSearch'):
+                entities = [e for e in entities if params['textSearch'].lower() in backup_name(e).lower()]
+            page, size = params['page'], params['pageSize']
+            data = entities[page * size:(page + 1) * size]
+            return FakeResponse(url, 200, {'data': data, 'hasNext': (page + 1) * size < len(entities)})
+        if path == '/api/relations':
+            return FakeResponse(url, 200, [r for r in self.relations if r['from']['id'] == params['fromId']])
+        if path.startswith('/api/plugins/telemetry/'):
+            entity_id, scope = path.split('/')[5], path.split('/')[-1]
+            return FakeResponse(url, 200, self.attributes.get(entity_id, {}).get(scope, []))
+        entity_id = params.get('ruleChainId') or path.split('/')[-1]
+        if entity_id in self.details:
+            entity = next(e for e in self.entities['DASHBOARD'] + self.entities['RULECHAIN']
+                          if e['id']['id'] == entity_id)
+            return FakeResponse(url, 200, dict(entity, **self.details[entity_id]))
+        return FakeResponse(url, 404)
+
+    def post(self, url, headers=None, json=None):
+        path = urlparse(url).path
+        with self.lock:
+            self.posted.append((path, copy.deepcopy(json)))
+        if path in self.fail:
+            return FakeResponse(url, 500)
+        if path in POSTS:
+            entity_type = POSTS[path]
+            name = backup_name(dict(json, id={'entityType': entity_type}))
+            if self.find(entity_type, name):
+                return FakeResponse(url, 400)
+            fields = {k: v for k, v in json.items() if k not in ('name', 'title')}
+            entity = self.add(entity_type, name, **fields)
+            if name in self.lose:
+                self.lose.remove(name)
+                return FakeResponse(url, 503)
+            return FakeResponse(url, 200, entity)
+        if path == '/api/relation':
+            self.relations.append(json)
+            return FakeResponse(url, 200)
+        if path.startswith('/api/plugins/telemetry/'):
+            entity_id, scope = path.split('/')[5], path.split('/')[-1]
+            values = [{'key': k, 'value': v, 'lastUpdateTs': 1} for k, v in json.items()]
+            self.attributes.setdefault(entity_id, {}).setdefault(scope, []).extend(values)
+            return FakeResponse(url, 200)
+        return FakeResponse(url, 404)
+
+
+def backup_name(entity):
+    return entity['title'] if entity['id']['entityType'] in ('CUSTOMER', 'DASHBOARD') else entity['name']
+
+
+@pytest.fixture
+def fake_tb(monkeypatch):
+    """FakeTb serving every request of tb_rest, the failed requests are retried without waiting"""
+    fake = FakeTb()
+    monkeypatch.setattr(tb, '_http', lambda session: fake)
+    monkeypatch.setattr(tb, 'make_session', lambda *args, **kwargs: fake)
+    monkeypatch.setattr(backup, 'RETRY_SEC', 0)
+    return fake
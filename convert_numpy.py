@@ -0,0 +1,129 @@
+"""
+NumPy engine of convert: the device tables of convert.lookup_and_transform computed with arrays.
+
+The dump is parsed to columns of strings, the value is taken from the first non-empty field of
+bool_v, str_v, long_v, dbl_v, and the (key, ts, value) rows of every device are pivoted
+to the table with ts and a column for every key by sorting and indexing.
+Python code runs once per distinct value and once per output row, not per input row.
+
+The values are formatted as the petl engine writes them:
+    bool_v -> True (any non-empty bool_v, because bool('false') is True as well)
+    str_v -> as is, long_v -> str(int(v)), dbl_v -> str(float(v))
+    several values of a key at the same ts -> the list of the values, like petl.recast does
+Unlike petl.recast, the keys of a device are found in all its rows, not in the first 1000 rows.
+Rows with a key id absent from the keys dictionary are skipped.
+
+Requires numpy.
+"""
+import io
+
+import numpy as np
+
+import compression
+
+VALUE_FIELDS = ('bool_v', 'str_v', 'long_v', 'dbl_v')
+VALUE_TYPES = (bool, str, int, float)
+NO_VALUE = -1
+
+
+def read_dump(ts_file, header):
+    """Columns of the dump as {field: array of strings}. The fields absent from the file are empty strings."""
+    with compression.open_file(ts_file) as f:
+        data = np.loadtxt(io.TextIOWrapper(f, encoding='utf-8'), delimiter=';', dtype=str, quotechar='"',
+                          comments=None, ndmin=2)
+    if data.size == 0:
+        data = np.empty((0, len(header)), dtype=str)
+    columns = {f: data[:, i] for i, f in enumerate(header[:data.shape[1]])}
+    for f in header[data.shape[1]:]:
+        columns[f] = np.full(data.shape[0], '')
+    return columns
+
+
+def get_keys(columns, kvdict=None):
+    """Key names of the rows and the mask of rows with known keys"""
+    keys = columns['key']
+    if kvdict is None:
+        return keys, np.ones(len(keys), dtype=bool)
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    names = [kvdict.get(k) for k in uniq.tolist()]
+    known = np.array([n is not None for n in names], dtype=bool)
+    names = np.array([n if n is not None else '' for n in names], dtype=str)
+    return names[inverse], known[inverse]
+
+
+def get_values(columns):
+    """Returns (kinds, values): kinds is the index in VALUE_FIELDS of the field the value is taken from
+    (NO_VALUE if all are empty), values are formatted as the petl engine writes them"""
+    n = len(columns['ts'])
+    kinds = np.full(n, NO_VALUE, dtype=np.int8)
+    for i in reversed(range(len(VALUE_FIELDS))):
+        kinds[columns[VALUE_FIELDS[i]] != ''] = i
+    values = np.full(n, '', dtype=object)
+    for i, (field, conv) in enumerate(zip(VALUE_FIELDS, VALUE_TYPES)):
+        mask = kinds == i
+        if mask.any():
+            values[mask] = _format_unique(columns[field][mask], conv)
+    return kinds, values
+
+
+def _format_unique(raw, conv):
+    uniq, inverse = np.unique(raw, return_inverse=True)
+    formatted = np.array([str(conv(u)) for u in uniq.tolist()], dtype=object)
+    return formatted[inverse]
+
+
+def typed_value(columns, kinds, i):
+    """The value of the row i as the python object made by convert.get_value"""
+    if kinds[i] == NO_VALUE:
+        return ''
+    return VALUE_TYPES[kinds[i]](columns[VALUE_FIELDS[kinds[i]]][i])
+
+
+def pivot(ts, key_names, values, duplicate_value, remove=()):
+    """ts, key_names, values are the rows of a device sorted by ts.
+    duplicate_value(rows) makes the value of the cell from the positions of several rows with the same ts and key.
+    Returns the table (list of tuples with the header) sorted by ts, the columns are sorted by key names."""
+    row_ts, row_idx = np.unique(ts, return_inverse=True)
+    variables, col_idx = np.unique(key_names, return_inverse=True)
+    cells = np.full((len(row_ts), len(variables)), '', dtype=object)
+    cells[row_idx, col_idx] = values
+    cell_idx = row_idx * len(variables) + col_idx
+    uniq_cells, counts = np.unique(cell_idx, return_counts=True)
+    for cell in uniq_cells[counts > 1].tolist():
+        rows = np.flatnonzero(cell_idx == cell)
+        cells[cell // len(variables), cell % len(variables)] = duplicate_value(rows)
+    # the removed keys are cut after the pivot, so their timestamps stay in the table like in petl engine
+    keep = [j for j, v in enumerate(variables.tolist()) if v not in remove]
+    header = ('ts',) + tuple(variables[keep].tolist())
+    cells = cells[:, keep]
+    return [header] + list(zip(row_ts.tolist(), *cells.T.tolist()))
+
+
+def lookup_and_transform(ts_file, header, devices, kvdict=None, keys=None):
+    """Reads the dump and returns {device_id: table} for the devices present in devices.
+    The tables are the same as convert.lookup_and_transform makes."""
+    columns = read_dump(ts_file, header)
+    print(f"Loaded {len(columns['ts'])} rows.")
+    key_names, known = get_keys(columns, kvdict)
+    selected = np.flatnonzero(known & np.isin(columns['entity_id'], list(devices)))
+    columns = {f: c[selected] for f, c in columns.items()}
+    key_names = key_names[selected]
+    entity_ids = columns['entity_id']
+    ts = columns['ts'].astype(np.int64)
+    kinds, values = get_values(columns)
+    remove = set(keys['remove']) if keys else set()
+
+    # stable, so the rows with the same ts keep the order of the dump
+    order = np.lexsort((ts, entity_ids))
+    sorted_ids = entity_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]]) if len(order) else []
+    ends = np.r_[starts[1:], len(order)] if len(order) else []
+    tables = {}
+    for start, end in zip(starts, ends):
+        rows = order[start:end]
+
+        def duplicate_value(positions, rows=rows):
+            return [typed_value(columns, kinds, i) for i in rows[positions].tolist()]
+
+        tables[str(sorted_ids[start])] = pivot(ts[rows], key_names[rows], values[rows], duplicate_value, remove)
+    return tables
@@ -29,7 +29,8 @@ def delete_all_data(tb_connection, devices, keys, start_time, end_time):
             elem = device_queue.get()
             print(f"Delete telemetry for {elem['name']}. \
                 From {start_time.strftime(TIME_FORMAT)} to {end_time.strftime(TIME_FORMAT)}...", end = " ")         
-            resp = tb.delete_telemetry(tb_connection.url, tb_connection.get_token(), elem['id'], keys, start_time, end_time)
+            resp = tb.delete_telemetry(tb_connection.url, tb_connection.get_token(), elem['id'], keys, start_time, end_time,
+                                       session=tb_connection.session)
             if tb.request_success(resp):
                 print("Success")
             elif resp.status_code == 204:
@@ -66,7 +67,8 @@ if __name__ == "__main__":
         params['password'] = input("Enter password: ")
     tb_connection = tb.TbConnection(params['url'], params['user'], params['password'])
     if 'device_type' in params.keys():#if device type is specified, ignore the specified devices
-        devices, resp = tb.get_tenant_devices(tb_connection.url, tb_connection.get_token(), params['device_type'])
+        devices, resp = tb.get_tenant_devices(tb_connection.url, tb_connection.get_token(), params['device_type'],
+                                              session=tb_connection.session)
         if not tb.request_success(resp):
             raise tb.ConnectionError(resp)
         params['devices'] = dwn.name_id_dict(devices)
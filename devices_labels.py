@@ -42,7 +42,7 @@ def assign_labels(device_by_types):
 
 def upload_tb(tb_con, devices):
     for d in devices:
-        _, resp = tb.post_device(tb_con.url, tb_con.get_token(), d)
+        _, resp = tb.post_device(tb_con.url, tb_con.get_token(), d, session=tb_con.session)
         if resp.status_code != 200:
             print("Failed to post device:")
             print(d)
@@ -75,7 +75,8 @@ devices is the list of structures:
 if __name__ == "__main__":
     tb_params = tb.load_access_parameters(argv[1])
     tb_con = tb.TbConnection(tb_params['url'], tb_params['user'], tb_params['password'])
-    devices, resp = tb.get_tenant_devices(tb_con.url, tb_con.get_token(), get_credentials = True)
+    devices, resp = tb.get_tenant_devices(tb_con.url, tb_con.get_token(), get_credentials = True,
+                                         session = tb_con.session)
     device_by_types = group_by_types(devices)
     assign_labels(device_by_types)
     devices = [d for group in device_by_types.values() for d in group ]
@@ -1,25 +1,49 @@
 import os
+import asyncio
 import datetime
 import time
 import io
 import json
 import os.path as path
 import sys
-from collections import namedtuple
+import argparse
+import threading
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
 from unidecode import unidecode
 #import csv
 import tb_rest as tb
+import writers
 from tb_rest import TbConnection
 from tb_rest import ConnectionError
 
 TIME_FORMAT = "%d.%m.%Y %H:%M:%S"
 FILE_MODE = 'a'
+FORMAT = 'csv'
 DELIMETER = ','
 MIN_TIME_DELTA = datetime.timedelta(seconds=2)
 SEC_IN_HOUR = 60*60
 TIME_SEGMENT = datetime.timedelta(seconds = 3*SEC_IN_HOUR)
+WORKERS = 1
+MAX_PER_HOST = 8
+PENDING_PER_WORKER = 4
+# resume index
+STATE_FILE = "download_state.json"
+SAVE_STATE_EVERY = 100 # updates
+TAIL_BLOCK = 4096 # bytes
+LIMIT = tb.SEC_IN_DAY
+# adaptive segmentation
+DENSITY_FILE = "densities.json"
+TARGET_FILL = 0.5 # desired number of points in a response relative to LIMIT
+MAX_GROWTH = 8 # a segment is at most MAX_GROWTH times longer than the previous one
+MIN_SEGMENT = datetime.timedelta(seconds = 1)
+MAX_SEGMENT = datetime.timedelta(days = 31)
 
 TimeSegment = namedtuple('TimeSegment', ['start', 'end'] )
+# one request of the parallel download
+WorkItem = namedtuple('WorkItem', ['device_name', 'device_id', 'key_files', 'segment'])
 
 
 
@@ -36,15 +60,84 @@ def time_segments(start_time, end_time, delta = TIME_SEGMENT):
         segments.append(TimeSegment(seg_start_time, seg_start_time + last_seg))
     return segments
 
-def check_interval(start_time, end_time, file, file_mode):
-    def check_in_file():
-        if os.path.exists(file):
+class JsonState:
+    """Dictionary kept in a json file of the data folder between runs"""
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+        self.values = {}
+        if path.exists(file):
             with open(file, 'r') as f:
-                lines = f.readlines()
-                if len(lines) > 1:
-                    time_line = lines[-1].split(DELIMETER)[0]
-                    #return datetime.datetime.strptime(time_line, TIME_FORMAT)
-                    return datetime.datetime.fromtimestamp(tb.fromJsTimestamp(time_line))
+                self.values = json.load(f)
+
+    def save(self):
+        with self.lock:
+            tmp_file = self.file + ".tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(self.values, f, indent=1)
+            os.replace(tmp_file, self.file)
+
+class DownloadState(JsonState):
+    """The last downloaded ts of every key file and the size of the file after it was written:
+    {"device_name/key.csv": [ts, size]}
+    The ts is valid only while the size of the file is the same, 
+    otherwise the file was changed by somebody else and its last line has to be read."""
+    def __init__(self, data_dir):
+        super().__init__(path.join(data_dir, STATE_FILE))
+        self.data_dir = data_dir
+        self.updates = 0
+
+    def last_ts(self, file):
+        with self.lock:
+            entry = self.values.get(path.relpath(file, self.data_dir))
+        if entry and path.exists(file) and writers.output_size(file) == entry[1]:
+            return entry[0]
+        return None
+
+    def update(self, file, ts):
+        with self.lock:
+            self.values[path.relpath(file, self.data_dir)] = [ts, writers.output_size(file)]
+            self.updates += 1
+            need_save = self.updates % SAVE_STATE_EVERY == 0
+        if need_save:
+            self.save()
+
+def last_line(file):
+    """Reads the last non-empty line of the file by blocks from its end"""
+    with open(file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        tail = b''
+        while pos > 0:
+            step = min(TAIL_BLOCK, pos)
+            pos -= step
+            f.seek(pos)
+            tail = f.read(step) + tail
+            lines = tail.rstrip(b'\r\n').split(b'\n')
+            if len(lines) > 1 or pos == 0:
+                return lines[-1].decode('utf-8')
+    return ''
+
+def last_ts_in_file(file):
+    """The ts of the last line of the key file or None if the file has no data"""
+    if not os.path.exists(file):
+        return None
+    if writers.is_columnar(file):
+        return writers.last_ts(file)
+    time_line = last_line(file).split(DELIMETER)[0]
+    try:
+        return int(time_line)
+    except ValueError:# the header or an empty file
+        return None
+
+def check_interval(start_time, end_time, file, file_mode, state = None):
+    def check_in_file():
+        last_ts = state.last_ts(file) if state else None
+        if last_ts is None:
+            last_ts = last_ts_in_file(file)
+        if last_ts is not None:
+            #return datetime.datetime.strptime(time_line, TIME_FORMAT)
+            return datetime.datetime.fromtimestamp(tb.fromJsTimestamp(last_ts))
         return None
     if file_mode == 'a':
         start_time_file = check_in_file()
@@ -75,33 +168,48 @@ def print_to_csv(file, values, key, mode,  delimeter = DELIMETER):
 def str_ts(ts):
     return datetime.datetime.fromtimestamp(ts).strftime(TIME_FORMAT)
 
-def key_file(device_folder, key):
-    return device_folder + f'/{key}.csv'
+def key_file(device_folder, key, fmt = FORMAT):
+    return device_folder + f'/{key}' + writers.file_extension(fmt)
 
 def long_interval(start_time, end_time):
     return  end_time - start_time >= MIN_TIME_DELTA
 
-def get_data_noseg(tb_connection, file, device_name, device_id, start_time, end_time, key, file_mode = FILE_MODE):
+def request_data(tb_connection, device_id, keys, start_time, end_time, limiter = None, limit = LIMIT):
+    """limiter is a semaphore bounding the number of simultaneous requests to the host"""
+    if limiter is None:
+        limiter = threading.BoundedSemaphore(1)
+    with limiter:
+        return tb.get_timeseries(tb_connection.url, device_id, tb_connection.get_token(), keys, 
+                                    tb.toJsTimestamp(start_time.timestamp()), 
+                                    tb.toJsTimestamp(end_time.timestamp()), 
+                                    limit = limit, session = tb_connection.session)
+
+def save_data(resp, file, device_name, key, file_mode, state = None):
+    """Writes the response to the key file. Returns False if the request failed."""
+    if not tb.request_success(resp):
+        print(f"ERROR at key {key} for device {device_name}.")
+        print(f"Code={resp.status_code}")
+        print(resp.json())
+        return False
+    data_key = resp.json()
+    if len(data_key)>0:
+        print(f'Writing to csv...', end=' ')
+        sorted_values = sorted(data_key[key], key = lambda x: x['ts'])
+        print_to_csv(file, sorted_values, key, mode = file_mode)
+        if state:
+            state.update(file, sorted_values[-1]['ts'])
+        print('Done')
+    else:
+        print('No data found')
+    return True
+
+def get_data_noseg(tb_connection, file, device_name, device_id, start_time, end_time, key, file_mode = FILE_MODE,
+                   state = None):
     if long_interval(start_time, end_time):
         print(f'Downloading data for {device_name}, key: {key}, \
                     interval: {start_time.strftime(TIME_FORMAT)}-{end_time.strftime(TIME_FORMAT)}')
-        resp = tb.get_timeseries(tb_connection.url, device_id, tb_connection.get_token(), [key], 
-                                    tb.toJsTimestamp(start_time.timestamp()), 
-                                    tb.toJsTimestamp(end_time.timestamp()), 
-                                    limit = tb.SEC_IN_DAY)
-        if not tb.request_success(resp):
-            print(f"ERROR at key {key} for device {device_name}.")
-            print(f"Code={resp.status_code}")
-            print(resp.json())
-        else:
-            data_key = resp.json()
-            if len(data_key)>0:
-                print(f'Writing to csv...', end=' ')
-                sorted_values = sorted(data_key[key], key = lambda x: x['ts'])
-                print_to_csv(file, sorted_values, key, mode = file_mode)
-                print('Done')
-            else:
-                print('No data found')
+        resp = request_data(tb_connection, device_id, [key], start_time, end_time)
+        save_data(resp, file, device_name, key, file_mode, state)
         return resp
     else:
         print(f"Skipped for {device_name}, key: {key}, \
@@ -109,15 +217,12 @@ def get_data_noseg(tb_connection, file, device_name, device_id, start_time, end_
                     is too short")
         return None
 
-def get_tb_params(argv):
-    access_file = argv[1]
+def get_tb_params(access_file):
     tb_params = tb.load_access_parameters(access_file)
     return tb_params["url"], tb_params["user"], tb_params["password"]
 
 config_file = "config.txt"
-def get_config_params(argv):
-    if len(argv) > 2:
-        config_file = argv[2]
+def get_config_params(config_file = config_file):
     with open(config_file, 'r') as f:
         params = json.load(f)
     if 'file_mode' not in params :
@@ -136,34 +241,356 @@ def check_dir(folder):
         os.mkdir(folder)
 
 def load_all_data(tb_connection, data_dir, devices, start_time, end_time, time_delta, keys, file_mode):
-    for device_name, _id in devices.items():
-        load_device_data(tb_connection, data_dir, device_name, _id, start_time, end_time, time_delta, keys, file_mode)
+    state = DownloadState(data_dir)
+    try:
+        for device_name, _id in devices.items():
+            load_device_data(tb_connection, data_dir, device_name, _id, start_time, end_time, time_delta, keys, file_mode,
+                             state)
+    finally:
+        state.save()
     
 
-def load_device_data(tb_connection, data_dir, device_name, device_id, start_time, end_time, time_delta, keys, file_mode):
+def load_device_data(tb_connection, data_dir, device_name, device_id, start_time, end_time, time_delta, keys, file_mode,
+                     state = None):
     device_folder = f'{data_dir}/{device_name}'
     check_dir(device_folder)
     for key in keys:
         file = key_file(device_folder, key)
-        key_start_time, key_end_time = check_interval(start_time, end_time, file, file_mode)
+        key_start_time, key_end_time = check_interval(start_time, end_time, file, file_mode, state)
         if long_interval(key_start_time, key_end_time):
             #divide time into segments
             segments = time_segments(key_start_time, key_end_time, delta = time_delta)
             if segments:
                 if file_mode == 'w':#if mode = 'write', the first segment is written in 'w' mode
-                    resp = get_data_noseg(tb_connection, file, device_name, device_id, segments[0].start, segments[0].end, key, file_mode = 'w')
+                    resp = get_data_noseg(tb_connection, file, device_name, device_id, segments[0].start, segments[0].end, key, file_mode = 'w', state = state)
                 else:
-                    resp = get_data_noseg(tb_connection, file, device_name, device_id, segments[0].start, segments[0].end, key, file_mode = 'a')
+                    resp = get_data_noseg(tb_connection, file, device_name, device_id, segments[0].start, segments[0].end, key, file_mode = 'a', state = state)
                 if not tb.request_success(resp):
                     return resp
                 #other segments is written in 'append' mode
                 for seg in segments[1:]:
-                    resp = get_data_noseg(tb_connection, file, device_name, device_id, seg.start, seg.end, key, file_mode = 'a')
+                    resp = get_data_noseg(tb_connection, file, device_name, device_id, seg.start, seg.end, key, file_mode = 'a', state = state)
                     if not tb.request_success(resp):
                         return resp
         else:
             print(f"WARNING: small segment for device {device_name}, key {key}: {key_start_time} to {key_end_time}")
 
+class KeyFile:
+    """The file of a key and the time from which the key is downloaded. 
+    The file is opened in mode for the first write and appended afterwards.
+    The writer stays open until close(), so a columnar file gets one part per run.
+    The last ts is saved to the state after the write for csv and after close() for a columnar file,
+    because the size of a columnar part is known only when its footer is written."""
+    def __init__(self, file, start_time, mode, fmt = FORMAT):
+        self.file = file
+        self.start_time = start_time
+        self.mode = mode
+        self.fmt = fmt
+        self.writer = None
+        self.last_ts = None
+        self.state = None
+
+    def write(self, key, values, state = None):
+        if self.writer is None:
+            self.writer = writers.open_writer(self.fmt, self.file, self.mode, DELIMETER)
+            self.mode = 'a'
+        self.writer.write(['ts', key], ((row['ts'], row['value']) for row in values))
+        self.last_ts = values[-1]['ts']
+        if state and writers.is_columnar(self.file):
+            self.state = state
+        elif state:
+            state.update(self.file, self.last_ts)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.state:
+            self.state.update(self.file, self.last_ts)
+            self.state = None
+
+def device_key_files(data_dir, device_name, start_time, end_time, keys, file_mode, state = None, fmt = FORMAT):
+    device_folder = f'{data_dir}/{device_name}'
+    check_dir(device_folder)
+    key_files = {}
+    for key in keys:
+        file = key_file(device_folder, key, fmt)
+        key_start_time, key_end_time = check_interval(start_time, end_time, file, file_mode, state)
+        if long_interval(key_start_time, key_end_time):
+            key_files[key] = KeyFile(file, key_start_time, file_mode, fmt)
+        else:
+            print(f"WARNING: small segment for device {device_name}, key {key}: {key_start_time} to {key_end_time}")
+    return key_files
+
+def key_groups(key_files, batch_keys):
+    """The keys requested together: all keys of the device if batch_keys is set, otherwise one by one"""
+    groups = [key_files] if batch_keys else [{k: kf} for k, kf in key_files.items()]
+    return [g for g in groups if g]
+
+def work_items(data_dir, devices, start_time, end_time, time_delta, keys, file_mode, batch_keys = False, state = None,
+               fmt = FORMAT):
+    """Yields the segments to download in the order they must be written: device by device, key by key.
+    If batch_keys is set, one item requests all keys of the device, which were not downloaded yet for the segment."""
+    if not end_time:
+        end_time = datetime.datetime.now()
+    for device_name, device_id in devices.items():
+        key_files = device_key_files(data_dir, device_name, start_time, end_time, keys, file_mode, state, fmt)
+        for group in key_groups(key_files, batch_keys):
+            group_start_time = min(kf.start_time for kf in group.values())
+            for seg in time_segments(group_start_time, end_time, delta = time_delta):
+                seg_files = {k: kf for k, kf in group.items() if kf.start_time < seg.end}
+                yield WorkItem(device_name, device_id, seg_files, seg)
+
+def save_segment(resp, item, state = None):
+    """Writes the response to the files of the item keys. Returns False if the request failed."""
+    if not tb.request_success(resp):
+        print(f"ERROR at keys {','.join(item.key_files)} for device {item.device_name}.")
+        print(f"Code={resp.status_code}")
+        print(resp.json())
+        return False
+    data = resp.json()
+    for key, kf in item.key_files.items():
+        # in batch mode the segment may start before the last point already saved for the key
+        start_ts = tb.toJsTimestamp(kf.start_time.timestamp())
+        values = sorted((v for v in data.get(key, []) if v['ts'] >= start_ts), key = lambda x: x['ts'])
+        if values:
+            kf.write(key, values, state)
+    return True
+
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+def host_limiter(url, max_per_host = MAX_PER_HOST):
+    """The semaphore shared by all downloads from the host of url"""
+    host = urlparse(url).netloc
+    with _host_limiters_lock:
+        if host not in _host_limiters:
+            _host_limiters[host] = threading.BoundedSemaphore(max_per_host)
+        return _host_limiters[host]
+
+class SegmentWriter:
+    """
+    Writes the responses of the work items in the order of work_items.
+    The key files of a device are closed when the items of the next device come.
+    If a segment fails, the rest of its keys is skipped, 
+    so the files have no gaps and the next run in 'a' mode continues from their last timestamp.
+    """
+    def __init__(self, state = None):
+        self.state = state
+        self.failed_files = set()
+        self.open_files = {}
+        self.last_device = None
+
+    def accept(self, item):
+        """The item without the failed keys or None if all its keys failed, so its request is not needed"""
+        # the items come device by device, so the files of the previous device are complete
+        if item.device_name != self.last_device:
+            self.close()
+            self.last_device = item.device_name
+        self.open_files.update({kf.file: kf for kf in item.key_files.values()})
+        item = item._replace(key_files = {k: kf for k, kf in item.key_files.items() if kf.file not in self.failed_files})
+        return item if item.key_files else None
+
+    def write(self, item, resp):
+        """Writes the response of the accepted item, resp is None if the request failed by the connection error"""
+        seg = item.segment
+        print(f'Downloaded data for {item.device_name}, keys: {",".join(item.key_files)}, \
+                    interval: {seg.start.strftime(TIME_FORMAT)}-{seg.end.strftime(TIME_FORMAT)}')
+        if resp is None or not save_segment(resp, item, self.state):
+            self.failed_files.update(kf.file for kf in item.key_files.values())
+
+    def close(self):
+        for kf in self.open_files.values():
+            kf.close()
+        self.open_files.clear()
+
+def load_all_data_parallel(tb_connection, data_dir, devices, start_time, end_time, time_delta, keys, file_mode,
+                           workers = WORKERS, max_per_host = MAX_PER_HOST, batch_keys = False, fmt = FORMAT):
+    """
+    The segments of all devices and keys are requested by the pool of workers.
+    The responses are written by the calling thread in the order of work_items,
+    so every key file is written in timestamp order.
+    At most workers*PENDING_PER_WORKER responses wait in memory to be written.
+    If a segment fails, the rest of its keys is skipped, 
+    so the files have no gaps and the next run in 'a' mode continues from their last timestamp.
+    If batch_keys is set, all keys of a device are requested at once and the number of requests is divided by the number of keys.
+    """
+    limiter = host_limiter(tb_connection.url, max_per_host)
+    state = DownloadState(data_dir)
+    writer = SegmentWriter(state)
+
+    def write(item, future):
+        item = writer.accept(item)
+        if item is None:
+            future.cancel()
+            return
+        try:
+            resp = future.result()
+        except requests.RequestException as e:
+            print(f"ERROR at keys {','.join(item.key_files)} for device {item.device_name}: {e}")
+            resp = None
+        writer.write(item, resp)
+
+    pending = deque()
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            for item in work_items(data_dir, devices, start_time, end_time, time_delta, keys, file_mode, batch_keys,
+                                   state, fmt):
+                future = pool.submit(request_data, tb_connection, item.device_id, list(item.key_files),
+                                     item.segment.start, item.segment.end, limiter)
+                pending.append((item, future))
+                if len(pending) >= workers * PENDING_PER_WORKER:
+                    write(*pending.popleft())
+            while pending:
+                write(*pending.popleft())
+    finally:
+        writer.close()
+        state.save()
+    return writer.failed_files
+
+async def load_all_data_async(connection, data_dir, devices, start_time, end_time, time_delta, keys, file_mode,
+                              batch_keys = False, fmt = FORMAT):
+    """
+    The same as load_all_data_parallel, but the segments are requested by the coroutines
+    of tb_rest_async.AsyncTbConnection instead of the threads. Up to connection.max_concurrency requests
+    are sent at once and at most max_concurrency*PENDING_PER_WORKER responses wait to be written.
+    Returns the files of the failed segments.
+    """
+    import aiohttp
+    state = DownloadState(data_dir)
+    writer = SegmentWriter(state)
+
+    async def write(item, task):
+        item = writer.accept(item)
+        if item is None:
+            task.cancel()
+            return
+        try:
+            resp = await task
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"ERROR at keys {','.join(item.key_files)} for device {item.device_name}: {e}")
+            resp = None
+        writer.write(item, resp)
+
+    pending = deque()
+    try:
+        for item in work_items(data_dir, devices, start_time, end_time, time_delta, keys, file_mode, batch_keys,
+                               state, fmt):
+            request = connection.get_timeseries(item.device_id, list(item.key_files),
+                                                tb.toJsTimestamp(item.segment.start.timestamp()),
+                                                tb.toJsTimestamp(item.segment.end.timestamp()), limit = LIMIT)
+            pending.append((item, asyncio.ensure_future(request)))
+            if len(pending) >= connection.max_concurrency * PENDING_PER_WORKER:
+                await write(*pending.popleft())
+        while pending:
+            await write(*pending.popleft())
+    finally:
+        for item, task in pending:
+            task.cancel()
+        writer.close()
+        state.save()
+    return writer.failed_files
+
+def run_async(tb_url, tb_user, tb_password, max_concurrency, *args, **kwargs):
+    """Runs load_all_data_async with tb_rest_async.AsyncTbConnection, which requires aiohttp"""
+    from tb_rest_async import AsyncTbConnection
+
+    async def run():
+        async with AsyncTbConnection(tb_url, tb_user, tb_password, max_concurrency) as connection:
+            return await load_all_data_async(connection, *args, **kwargs)
+    return asyncio.run(run())
+
+class Densities(JsonState):
+    """Points per second of every device key learned from the responses.
+    The densities are kept in a json file between runs: {device_name: {key: density}}"""
+    def get(self, device_name, key):
+        with self.lock:
+            return self.values.get(device_name, {}).get(key)
+
+    def update(self, device_name, key, density):
+        with self.lock:
+            self.values.setdefault(device_name, {})[key] = density
+
+def next_segment(seg_len, density, limit = LIMIT):
+    """The segment which is expected to contain TARGET_FILL*limit points"""
+    if density:
+        seg_len = min(seg_len * MAX_GROWTH, datetime.timedelta(seconds = TARGET_FILL * limit / density))
+    else:
+        seg_len = seg_len * MAX_GROWTH
+    return min(max(seg_len, MIN_SEGMENT), MAX_SEGMENT)
+
+def load_adaptive(tb_connection, device_name, device_id, key_files, end_time, time_delta, densities,
+                  limiter = None, limit = LIMIT, state = None):
+    """
+    Downloads the keys from their start time to end_time by segments adjusted to the density of the data.
+    The first segment is estimated from the known densities of the keys or equals time_delta.
+    If a response holds few points, the next segment is longer.
+    If a response reaches the limit, it may be truncated, so the segment is halved and requested again.
+    Returns False if a request failed.
+    """
+    try:
+        return _load_adaptive(tb_connection, device_name, device_id, key_files, end_time, time_delta, densities,
+                              limiter, limit, state)
+    finally:
+        for kf in key_files.values():
+            kf.close()
+
+def _load_adaptive(tb_connection, device_name, device_id, key_files, end_time, time_delta, densities,
+                   limiter, limit, state):
+    start_time = min(kf.start_time for kf in key_files.values())
+    known = [densities.get(device_name, k) for k in key_files]
+    if None in known:
+        seg_len = time_delta
+    else:
+        seg_len = next_segment(MAX_SEGMENT, max(known), limit)
+    while long_interval(start_time, end_time):
+        seg = TimeSegment(start_time, min(start_time + seg_len, end_time))
+        seg_files = {k: kf for k, kf in key_files.items() if kf.start_time < seg.end}
+        try:
+            resp = request_data(tb_connection, device_id, list(seg_files), seg.start, seg.end, limiter, limit)
+        except requests.RequestException as e:
+            print(f"ERROR at keys {','.join(seg_files)} for device {device_name}: {e}")
+            return False
+        if tb.request_success(resp):
+            counts = {k: len(v) for k, v in resp.json().items()}
+            if max(counts.values(), default = 0) >= limit and seg.end - seg.start > MIN_SEGMENT:
+                seg_len = (seg.end - seg.start) / 2
+                continue
+        print(f'Downloaded data for {device_name}, keys: {",".join(seg_files)}, \
+                    interval: {seg.start.strftime(TIME_FORMAT)}-{seg.end.strftime(TIME_FORMAT)}')
+        if not save_segment(resp, WorkItem(device_name, device_id, seg_files, seg), state):
+            return False
+        seconds = (seg.end - seg.start).total_seconds()
+        for k in seg_files:
+            densities.update(device_name, k, counts.get(k, 0) / seconds)
+        seg_len = next_segment(seg.end - seg.start, max(counts.values(), default = 0) / seconds, limit)
+        start_time = seg.end
+    return True
+
+def load_all_data_adaptive(tb_connection, data_dir, devices, start_time, end_time, time_delta, keys, file_mode,
+                           workers = WORKERS, max_per_host = MAX_PER_HOST, batch_keys = False, fmt = FORMAT):
+    """
+    Every key (or every device if batch_keys is set) is downloaded by load_adaptive in one of the workers.
+    The learned densities are saved to data_dir/DENSITY_FILE and used by the next run.
+    """
+    if not end_time:
+        end_time = datetime.datetime.now()
+    limiter = host_limiter(tb_connection.url, max_per_host)
+    densities = Densities(path.join(data_dir, DENSITY_FILE))
+    state = DownloadState(data_dir)
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            futures = []
+            for device_name, device_id in devices.items():
+                key_files = device_key_files(data_dir, device_name, start_time, end_time, keys, file_mode, state, fmt)
+                for group in key_groups(key_files, batch_keys):
+                    futures.append(pool.submit(load_adaptive, tb_connection, device_name, device_id, group,
+                                               end_time, time_delta, densities, limiter, LIMIT, state))
+            return all([f.result() for f in futures])
+    finally:
+        densities.save()
+        state.save()
+
 def name_id_dict(entities):
     return {valid_name(x['name']):x['id']['id'] for x in entities}
 
@@ -175,20 +602,60 @@ TRANS_TABLE = FORBIDDEN_SYMBOLS.maketrans(FORBIDDEN_SYMBOLS, REPLACE_SYMBOLS)
 def valid_name(device_name):
     return unidecode(device_name.translate(TRANS_TABLE)).replace("__", "_").replace("___", "_").strip("_")
 
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Downloads telemetry of Thingsboard devices to csv files: data_folder/device_name/key.csv")
+    parser.add_argument('access_file', help="File with url, user and password of Thingsboard")
+    parser.add_argument('config_file', nargs='?', default=config_file, help="JSON file with download parameters")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="Number of simultaneous requests. With 1 worker the segments are downloaded one by one.")
+    parser.add_argument('--max-per-host', type=int, default=MAX_PER_HOST,
+                        help="Maximum number of simultaneous requests to one Thingsboard server")
+    parser.add_argument('--batch-keys', action='store_true',
+                        help="Request all keys of a device in one request per segment")
+    parser.add_argument('--format', choices=writers.FORMATS, default=FORMAT,
+                        help="Format of the key files. Parquet and feather files are written by parts to key.parquet/ or key.feather/ folders")
+    parser.add_argument('--adaptive', action='store_true',
+                        help=f"Adjust the segments to the density of the data. The densities are saved to {DENSITY_FILE}")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Request the segments by asyncio instead of the threads, --max-per-host requests at once. \
+                        --workers is not used. Requires aiohttp.")
+    args = parser.parse_args()
+    if args.use_async and args.adaptive:
+        parser.error("--async can not be used with --adaptive")
+    return args
+
 if __name__ == "__main__":
-    tb_url, tb_user, tb_password = get_tb_params(sys.argv)
+    args = get_args()
+    tb_url, tb_user, tb_password = get_tb_params(args.access_file)
     #data_dir, start_time, end_time, keys, devices, file_mode, device_type = get_config_params(sys.argv)
-    params = get_config_params(sys.argv)
+    params = get_config_params(args.config_file)
     check_dir(params['folder'])
-    tb_connection = TbConnection(tb_url, tb_user, tb_password)
+    tb_connection = TbConnection(tb_url, tb_user, tb_password, pool_size = max(tb.POOL_SIZE, args.workers))
     if params['device_type']:#if device type is specified, ignore the specified devices
-        devices, resp = tb.get_tenant_devices(tb_connection.url, tb_connection.get_token(), params['device_type'])
+        devices, resp = tb.get_tenant_devices(tb_connection.url, tb_connection.get_token(), params['device_type'],
+                                              session=tb_connection.session)
         if not tb.request_success(resp):
-            raise ConnectionError(self, resp)
+            raise ConnectionError(tb_connection, resp)
         params['devices'] = name_id_dict(devices)
     print("*** Download started ***")
     print(f"Total interval: {params['start_time'].strftime(TIME_FORMAT)}-{params['end_time'].strftime(TIME_FORMAT)}")
-    load_all_data(tb_connection, params['folder'], params['devices'], 
-                    params['start_time'], params['end_time'], params['time_delta'],
-                    params['keys'], params['file_mode'])
+    if args.use_async:
+        run_async(tb_url, tb_user, tb_password, args.max_per_host, params['folder'], params['devices'],
+                  params['start_time'], params['end_time'], params['time_delta'],
+                  params['keys'], params['file_mode'], args.batch_keys, args.format)
+    elif args.adaptive:
+        load_all_data_adaptive(tb_connection, params['folder'], params['devices'], 
+                        params['start_time'], params['end_time'], params['time_delta'],
+                        params['keys'], params['file_mode'], args.workers, args.max_per_host, args.batch_keys,
+                        args.format)
+    elif args.workers > 1 or args.batch_keys or args.format != FORMAT:
+        load_all_data_parallel(tb_connection, params['folder'], params['devices'], 
+                        params['start_time'], params['end_time'], params['time_delta'],
+                        params['keys'], params['file_mode'], args.workers, args.max_per_host, args.batch_keys,
+                        args.format)
+    else:
+        load_all_data(tb_connection, params['folder'], params['devices'], 
+                        params['start_time'], params['end_time'], params['time_delta'],
+                        params['keys'], params['file_mode'])
     print("*** Download finished ***")
\ No newline at end of file
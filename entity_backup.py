@@ -14,47 +14,189 @@
 #Load rule chains
 #Load views
 
+#The lists of entities are saved as they are loaded, page by page, so memory does not grow with the tenant:
+#    json - an array, one entity per line
+#    jsonl - JSON Lines, an entity per line without the brackets
+#The files are compressed if the compression is given (gzip, zstd or lz4), e.g. devices.jsonl.zst
+#
+#Incremental backup:
+#The first run saves the full snapshot and manifest.json with the ids of the entities, their createdTime,
+#version and the hash of the entity as it is listed. The next runs with --incremental list the entities,
+#compare them with the manifest and save only the new and changed entities to a delta-<time> folder,
+#with deleted.json for the deleted ones. The dashboards and rule chains are loaded only if they are changed.
+#The relations and the attributes of all assets and devices are loaded by every run, because changing them
+#does not change the entity, but only those changed since the last backup are saved: the manifest keeps
+#the hash of the relations and of the attributes (with their lastUpdateTs) of every entity too.
+#Thingsboard without the version of entities (before 3.6) changes the listed dashboard or rule chain
+#only if its title or flags change, not its configuration, so a full snapshot should be taken from time to time.
+#--compact merges the deltas into the full snapshot.
+#If a list of the entities is not loaded, the backup fails: the full snapshot is saved to the ~snapshot folder
+#and replaces the previous one only when it is complete, a failed delta folder is removed.
+#
+#Usage: entity_backup.py tb.access folder [--format jsonl] [--compress zstd] [--incremental | --compact]
+
 
 import tb_rest as tb
+import compression
 import json as json
 import os.path as path
 import os as os
 import datetime as dt
-import sys
+import argparse
+import hashlib
+import itertools
+import shutil
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# crawler of relations and attributes
+WORKERS = 8
+MAX_TRY = 3
+RETRY_SEC = 1
+RETRY_STATUS = (429, 500, 502, 503, 504)
+PROGRESS_SEC = 5
+
+FORMATS = ('json', 'jsonl')
+
+# incremental backup
+MANIFEST_FILE = "manifest.json"
+DELETED_FILE = "deleted.json"
+DELTA_PREFIX = "delta-"
+SNAPSHOT_TMP_DIR = "~snapshot"
+TIME_FORMAT = "%Y%m%d-%H%M%S"
+# the entities compared with the manifest, the relations and the attributes are compared by their entity
+TRACKED = ('CUSTOMER', 'ASSET', 'DEVICE', 'DASHBOARD', 'RULECHAIN', 'RELATION', 'ATTRIBUTE')
+
+def file_format(file):
+    """'jsonl' or 'json' by the extension of the file, the compression extension is ignored"""
+    return 'jsonl' if compression.split_extension(file)[0].endswith('.jsonl') else 'json'
 
-def json_format(json_str):
-    json_str = json_str.replace('\'', '\"' )
-    json_str = json_str.replace('None', 'null')
-    json_str = json_str.replace('\": True', '\": true')
-    json_str = json_str.replace('\": False', '\": false')
-    return json_str
+class EntityWriter:
+    """
+    Writes the entities one by one to the json array or JSON Lines file (by the extension of the file),
+    compressed if the file has the extension of compression.
+    The entities are written to a temporary file, which replaces the file when the writer is closed,
+    so the previous backup is kept if the loading fails.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.jsonl = file_format(file) == 'jsonl'
+        self.tmp_file = path.join(path.dirname(file), '~' + path.basename(file))
+        self.count = 0
+        self._context = compression.open_file(self.tmp_file, 'wb')
+        self._f = self._context.__enter__()
+
+    def __enter__(self):
+        return self
 
-def save_entities(file, entities_list):
-    with open(file, 'w', encoding='utf-8') as file:
-        json_str = json_format(str(entities_list))
-        file.write(json_str)
+    def __exit__(self, exc_type, exc, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, entity):
+        line = json.dumps(entity, ensure_ascii=False).encode('utf-8')
+        if self.jsonl:
+            self._f.write(line + b'\n')
+        else:
+            self._f.write((b'[\n' if self.count == 0 else b',\n') + line)
+        self.count += 1
+
+    def close(self):
+        if not self.jsonl:
+            self._f.write(b'[\n]\n' if self.count == 0 else b'\n]\n')
+        self._context.__exit__(None, None, None)
+        os.replace(self.tmp_file, self.file)
+
+    def abort(self):
+        try:
+            self._context.__exit__(None, None, None)
+        finally:
+            os.remove(self.tmp_file)
+
+def save_entities(file, entities):
+    """
+    Writes the entities of the iterable as they come, returns the number of the entities
+    """
+    with EntityWriter(file) as writer:
+        for entity in entities:
+            writer.write(entity)
+    return writer.count
+
+def save_entity(file, entity):
+    with open(file, 'w', encoding='utf-8') as f:
+        json.dump(entity, f, ensure_ascii=False)
+
+def read_entities(file):
+    """
+    Yields the entities of the file saved by save_entities.
+    JSON Lines and the arrays with an entity per line are read line by line, other json files are loaded whole.
+    """
+    with compression.open_file(file) as f:
+        lines = (line.decode('utf-8').strip() for line in f)
+        if file_format(file) == 'jsonl':
+            for line in lines:
+                if line:
+                    yield json.loads(line)
+            return
+        first = next(lines, '')
+        if first != '[':
+            yield from json.loads(first + ''.join(lines))
+            return
+        count = 0
+        for line in lines:
+            if line and line != ']':
+                try:
+                    entity = json.loads(line[:-1] if line.endswith(',') else line)
+                except ValueError:
+                    if count:
+                        raise
+                    # the array is written with indentation, not an entity per line
+                    yield from json.loads(first + line + ''.join(lines))
+                    return
+                count += 1
+                yield entity
 
 def save_tenants(tb_url, admin_user, admin_password, save_file):
     """
         Admin user is required!
     """
     bearerToken, refreshToken = tb.getToken(tb_url, admin_user, admin_password)[0:2]
-    tenants_list = tb.get_tenants(tb_url, bearerToken)
-    save_entities(save_file, tenants_list)
-    return tenants_list
+    return save_list("tenants", tb.iter_tenants(tb_url, bearerToken, prefetch=True), save_file)
 
-def save_customers(tb_url, save_file, tenant_admin_user=None, password=None, token=None):
+def save_customers(tb_url, save_file, tenant_admin_user=None, password=None, token=None, changes=None):
     """
     Save customers that belong to this user's tenant
     """
     if not token:
         token, refreshToken = tb.getToken(tb_url, tenant_admin_user, password)[0:2]
-    customers_list = tb.get_customers(tb_url, token)
-    save_entities(save_file, customers_list)
-    return customers_list
+    return save_list("customers", tb.iter_customers(tb_url, token, prefetch=True), save_file, changes)
+
+def save_list(title, entities, save_file, changes=None):
+    """
+    Saves the entities of the paginator as the pages are loaded. Returns the number of the entities.
+    tb.RequestError is raised if a page was not loaded, the previous file is kept then.
+    With changes only the new and changed entities are saved.
+    """
+    if changes:
+        entities = changes.filter(entities)
+    try:
+        count = save_entities(save_file, entities)
+    except tb.RequestError as e:
+        print(f"FAILURE: {title} were not loaded")
+        print(f"Response status: {e.resp.status_code}")
+        print(e.resp.text)
+        raise
+    if changes:
+        changes.commit()
+    print(f"{count} {title} saved to {save_file}")
+    return count
 
-ASSET_LIMIT = 2000
-def save_assets(tb_url, save_file, tenant_admin_user=None, password=None, token=None):
+def save_assets(tb_url, save_file, tenant_admin_user=None, password=None, token=None, changes=None):
     """
     Save assets that belong to this user's tenant
     """
@@ -62,19 +204,9 @@ def save_assets(tb_url, save_file, tenant_admin_user=None, password=None, token=
         print("Obtaining token...")
         token, refreshToken = tb.getToken(tb_url, tenant_admin_user, password)[0:2]
     print("Loading assets...")
-    assets_list, resp = tb.list_tenant_assets(tb_url, token, limit = ASSET_LIMIT)
-    if assets_list:
-        print(f"{len(assets_list)} assets loaded.")
-        save_entities(save_file, assets_list)
-        print(f"Assets successfully saved to {save_file}")
-    else:
-        print("FAILURE: assets were not loaded")
-        print(f"Response status: {resp.status_code}")
-        print(resp.json())
-    return assets_list
-    
-DEVICE_LIMIT = 2000
-def save_devices(tb_url, save_file, tenant_admin_user=None, password=None, token=None):
+    return save_list("assets", tb.iter_tenant_assets(tb_url, token, prefetch=True), save_file, changes)
+
+def save_devices(tb_url, save_file, tenant_admin_user=None, password=None, token=None, changes=None):
     """
     Save devices that belong to this user's tenant
     """
@@ -82,107 +214,452 @@ def save_devices(tb_url, save_file, tenant_admin_user=None, password=None, token
         print("Obtaining token...")
         token, refreshToken = tb.getToken(tb_url, tenant_admin_user, password)[0:2]
     print("Loading devices...")
-    devices_list, resp = tb.get_tenant_devices(tb_url, token, limit = DEVICE_LIMIT)
-    if devices_list:
-        print(f"{len(devices_list)} devices loaded.")
-        save_entities(save_file, devices_list)
-        print(f"Devices successfully saved to {save_file}")
-    else:
-        print("FAILURE: devices were not loaded")
-        print(f"Response status: {resp.status_code}")
-        print(resp.json())
-    return devices_list
-
-def save_relations(tb_url, entity_list, save_file, tenant_admin_user=None, password=None, token=None):
+    return save_list("devices", tb.iter_tenant_devices(tb_url, token, prefetch=True), save_file, changes)
+
+class FetchError(Exception):
+    """The response of a request of the crawler is not successful"""
+    def __init__(self, resp):
+        super().__init__(f"Response status: {resp.status_code}")
+        self.resp = resp
+        self.transient = resp.status_code in RETRY_STATUS
+
+class Progress:
+    """Prints the number of processed entities and the throughput every PROGRESS_SEC seconds"""
+    def __init__(self, title):
+        self.title = title
+        self.done = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self.printed = self.start
+
+    def update(self, success):
+        self.done += 1
+        if not success:
+            self.failed += 1
+        now = time.monotonic()
+        if now - self.printed >= PROGRESS_SEC:
+            self.printed = now
+            self.print()
+
+    def print(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        print(f"{self.title}: {self.done} entities, {self.failed} failed, {self.done / elapsed:.1f} entities/s")
+
+def crawl(entities, fetch, title, workers=WORKERS, max_try=MAX_TRY):
+    """
+    Calls fetch(entity) for the entities by the pool of workers threads and yields (entity, result)
+    in the order of the entities. fetch raises FetchError if a response is not successful.
+    Connection errors and RETRY_STATUS responses are retried max_try times, result of a failed entity is None.
+    Not more than 4 * workers entities are waiting, so entities may be a lazy iterable.
+    """
+    progress = Progress(title)
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entity in entities:
+            window.append((entity, executor.submit(_fetch_with_retry, fetch, entity, max_try)))
+            if len(window) >= 4 * workers:
+                yield _crawl_result(window.popleft(), progress)
+        while window:
+            yield _crawl_result(window.popleft(), progress)
+    progress.print()
+
+def _fetch_with_retry(fetch, entity, max_try):
+    for attempt in range(max_try):
+        try:
+            return fetch(entity)
+        except FetchError as e:
+            if not e.transient:
+                raise
+            error = e
+        except requests.RequestException as e:
+            error = e
+        time.sleep(RETRY_SEC * 2 ** attempt)
+    raise error
+
+def _crawl_result(item, progress):
+    entity, future = item
+    try:
+        result = future.result()
+    except (FetchError, requests.RequestException) as e:
+        print(f"FAILURE: {progress.title}: {describe(entity)}")
+        print(e)
+        result = None
+    progress.update(result is not None)
+    return entity, result
+
+def describe(entity):
+    if 'id' not in entity:
+        # relation
+        return (f"From {entity['from']['entityType']} {entity['from']['id']} "
+                f"to {entity['to']['entityType']} {entity['to']['id']}")
+    return f"Type {entity['id']['entityType']}, Id = {entity['id']['id']}"
+
+def save_relations(tb_url, entity_list, save_file, tenant_admin_user=None, password=None, token=None,
+                   workers=WORKERS, session=None, changes=None):
+    """
+    Relations from the entities, loaded by workers threads. entity_list may be a lazy iterable,
+    e.g. read_entities of the saved assets. Returns the number of the relations.
+    With changes only the relations of the entities whose relations are changed are saved.
+    """
     if not token:
         print("Obtaining token...")
         token, refreshToken = tb.getToken(tb_url, tenant_admin_user, password)[0:2]
+    session = session or tb.make_session(pool_size=workers)
+    def fetch(entity):
+        relations_list, resp = tb.get_relations(tb_url, token, fromId=entity['id']['id'],
+                                                fromType=entity['id']['entityType'], session=session)
+        if resp.status_code != 200:
+            raise FetchError(resp)
+        return relations_list
     print("Loading relations...")
-    all_relations_list = []
-    for entity in entity_list:
-        relations_list, resp = tb.get_relations(tb_url, token, fromId=entity['id']['id'], fromType=entity['id']['entityType'])
-        if relations_list:
-            all_relations_list += relations_list
-        elif resp.status_code != 200:
-            print("FAILURE: relations were not loaded for entity:")
-            print(f"Type {entity['id']['entityType']}, Id = {entity['id']['id']}")
-            print(f"Response status: {resp.status_code}")
-            print(resp.json())
-    save_entities(save_file, all_relations_list)
-    return all_relations_list
-
-def save_attributes(tb_url, entity_list, save_file, token):
-    print("Loading attributes...")
-    all_attributes_list = []
-    for entity in entity_list:
+    with EntityWriter(save_file) as writer:
+        for entity, relations_list in crawl(entity_list, fetch, "Relations", workers):
+            if changes and relations_list is None:
+                changes.skip(entity)
+            # an entity without relations has no mark, so its old relations are deleted
+            elif not changes or (relations_list and changes.check(relations_group(entity, relations_list))):
+                for relation in relations_list or []:
+                    writer.write(relation)
+    if changes:
+        changes.commit()
+    return writer.count
+
+def relations_group(entity, relations_list):
+    """The relations of the entity compared with the manifest, the order of the relations does not matter"""
+    return {'id': entity['id'],
+            'relations': sorted(relations_list, key=lambda r: json.dumps(r, sort_keys=True))}
+
+def save_attributes(tb_url, entity_list, save_file, token, workers=WORKERS, session=None, changes=None):
+    """
+    Attributes of all scopes of the entities, loaded by workers threads.
+    The scopes of an entity are empty lists if its attributes were not loaded.
+    Returns the number of the entities.
+    With changes only the entities with the changed attributes are saved.
+    """
+    session = session or tb.make_session(pool_size=workers)
+    def fetch(entity):
         entry = {'id': entity['id']}
         for scope in tb.ATTR_SCOPES:
-            #entity_keys, resp = tb.get_attribute_keys(tb_url, token, entity['id']['id'], entity['id']['entityType'], scope = scope)
-            attributes, resp = tb.get_attribute_values(tb_url, token, entity['id']['id'], entity['id']['entityType'], scope = scope)
-            entry[scope] = attributes
-        all_attributes_list.append(entry)
-    save_entities(save_file, all_attributes_list)
-    return all_attributes_list     
-
-def save_dashboards(tb_url, save_dir, token):
+            attributes, resp = tb.get_attribute_values(tb_url, token, entity['id']['id'], entity['id']['entityType'],
+                                                       scope=scope, session=session)
+            if resp.status_code != 200:
+                raise FetchError(resp)
+            entry[scope] = sorted(attributes, key=lambda a: a['key'])
+        return entry
+    print("Loading attributes...")
+    with EntityWriter(save_file) as writer:
+        for entity, entry in crawl(entity_list, fetch, "Attributes", workers):
+            if entry is None:
+                if changes:
+                    changes.skip(entity)
+                if not changes or not changes.only_changed:
+                    entry = {'id': entity['id']}
+                    entry.update({scope: [] for scope in tb.ATTR_SCOPES})
+                    writer.write(entry)
+            elif not changes or changes.check(entry):
+                writer.write(entry)
+    if changes:
+        changes.commit()
+    return writer.count
+
+def save_dashboards(tb_url, save_dir, token, changes=None):
+    """
+    Every dashboard with its configuration is saved to its own file. Returns the number of the saved dashboards.
+    """
     print("Loading dashboards...")
-    dashboards, resp = tb.list_tenant_dashboards(tb_url, token)
-    if dashboards:
-        print(f"{len(dashboards)} dashboards loaded.")
-    #    save_entities(save_file, dashboards)
-    #    print(f"Dashboards successfully saved to {save_file}")
-    else:
-        print("FAILURE: dashboards were not loaded")
-        print(f"Response status: {resp.status_code}")
-        print(resp.json())
-    db_info_list = []
-    check_dir(save_dir)
-    for i, db in enumerate(dashboards):
-        db_info, resp = tb.get_dashboard(tb_url, token, db['id']['id'])
-        if db_info:
-            db_info_list.append(db_info)
-        else:
-            print(f"FAILURE: dashboard {db['id']['id']} was not loaded")
-            print(f"Response status: {resp.status_code}")
-            print(resp.json())
-        save_file = save_dir + '/' + f"{str(i)}.json"
-        save_entities(save_file, db_info)
-    return db_info_list
-
-def save_rulechains(tb_url, save_dir, token):
+    dashboards = tb.iter_tenant_dashboards(tb_url, token, prefetch=True)
+    return save_details("dashboards", dashboards, lambda id: tb.get_dashboard(tb_url, token, id), save_dir, changes)
+
+def save_rulechains(tb_url, save_dir, token, changes=None):
+    """
+    Every rule chain with its metadata is saved to its own file. Returns the number of the saved rule chains.
+    """
     print("Loading rulechains...")
-    rulechains, resp = tb.list_tenant_rulechains(tb_url, token)
-    if rulechains:
-        print(f"{len(rulechains)} rulechains loaded.")
-    else:
-        print("FAILURE: rulechains were not loaded")
-        print(f"Response status: {resp.status_code}")
-        print(resp.json())
-    chains_info_list = []
+    rulechains = tb.iter_tenant_rulechains(tb_url, token, prefetch=True)
+    return save_details("rulechains", rulechains, lambda id: tb.get_rulechain(tb_url, token, id), save_dir, changes)
+
+def save_details(title, entities, get, save_dir, changes=None):
+    """
+    Loads every entity of the paginator by get(id) and saves it to save_dir/<id>.json.
+    With changes only the new and changed entities are loaded, otherwise the files of the entities
+    absent from the list are removed. tb.RequestError is raised if a page of the list was not loaded.
+    """
     check_dir(save_dir)
-    for i, chain in enumerate(rulechains):
-        chain_info, resp = tb.get_rulechain(tb_url, token, chain['id']['id'])
-        if chain_info:
-            chains_info_list.append(chain_info)
+    if changes:
+        entities = changes.filter(entities)
+    listed = set()
+    count = 0
+    try:
+        for entity in entities:
+            entity_id = entity['id']['id']
+            listed.add(entity_id + '.json')
+            info, resp = get(entity_id)
+            if info:
+                save_entity(path.join(save_dir, entity_id + '.json'), info)
+                count += 1
+            else:
+                print(f"FAILURE: {title[:-1]} {entity_id} was not loaded")
+                print(f"Response status: {resp.status_code}")
+                print(resp.text)
+                if changes:
+                    changes.skip(entity)
+    except tb.RequestError as e:
+        print(f"FAILURE: {title} were not loaded")
+        print(f"Response status: {e.resp.status_code}")
+        raise
+    if changes:
+        changes.commit()
+    if not changes or not changes.only_changed:
+        for file in os.listdir(save_dir):
+            if file.endswith('.json') and file not in listed:
+                os.remove(path.join(save_dir, file))
+    print(f"{count} {title} saved to {save_dir}")
+    return count
+
+def entity_mark(entity):
+    """createdTime, version and the hash of the entity as it is listed by the paginator"""
+    content = json.dumps(entity, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return {'createdTime': entity.get('createdTime'), 'version': entity.get('version'),
+            'hash': hashlib.sha1(content).hexdigest()}
+
+def is_changed(mark, old_mark):
+    """The version is compared if Thingsboard has it, the hash otherwise"""
+    if old_mark is None:
+        return True
+    if mark['version'] is not None and old_mark.get('version') is not None:
+        return mark['version'] != old_mark['version']
+    return mark['hash'] != old_mark['hash']
+
+class Manifest:
+    """
+    The marks of the saved entities by their ids, the format of the files and the delta snapshots
+    not merged into the full snapshot yet. Saved to MANIFEST_FILE of the backup folder.
+    """
+    def __init__(self, folder, fmt='json', codec=None):
+        self.folder = folder
+        self.fmt = fmt
+        self.codec = codec
+        self.snapshot = dt.datetime.now().strftime(TIME_FORMAT)
+        self.deltas = []
+        self.entities = {name: {} for name in TRACKED}
+
+    @classmethod
+    def load(cls, folder):
+        """
+        The manifest of the folder or None if the folder has no full snapshot
+        """
+        file = path.join(folder, MANIFEST_FILE)
+        if not path.exists(file):
+            return None
+        with open(file, encoding='utf-8') as f:
+            data = json.load(f)
+        manifest = cls(folder, data['format'], data['codec'])
+        manifest.snapshot = data['snapshot']
+        manifest.deltas = data['deltas']
+        manifest.entities.update(data['entities'])
+        return manifest
+
+    def save(self):
+        file = path.join(self.folder, MANIFEST_FILE)
+        tmp_file = file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'format': self.fmt, 'codec': self.codec, 'snapshot': self.snapshot,
+                       'deltas': self.deltas, 'entities': self.entities}, f)
+        os.replace(tmp_file, file)
+
+    def entity_path(self, folder, entity_name):
+        return mkpath(folder, entity_name, self.fmt, self.codec)
+
+    def changes(self, entity_name, only_changed=True):
+        return Changes(self, entity_name, only_changed)
+
+class Changes:
+    """
+    Compares the entities of a type with the manifest as they are loaded.
+    The marks of the manifest are replaced by commit() when all the entities are saved,
+    so the manifest is not changed if the loading fails.
+    """
+    def __init__(self, manifest, entity_name, only_changed=True):
+        self.manifest = manifest
+        self.entity_name = entity_name
+        self.only_changed = only_changed
+        self.old_marks = manifest.entities[entity_name]
+        self.marks = {}
+        self.deleted = []
+
+    def filter(self, entities):
+        """
+        Yields the new and changed entities, all the entities if not only_changed
+        """
+        for entity in entities:
+            if self.check(entity):
+                yield entity
+
+    def check(self, entity):
+        """
+        Adds the mark of the entity, returns True if the entity is new or changed or if not only_changed
+        """
+        entity_id = entity['id']['id']
+        mark = entity_mark(entity)
+        self.marks[entity_id] = mark
+        return not self.only_changed or is_changed(mark, self.old_marks.get(entity_id))
+
+    def skip(self, entity):
+        """
+        The entity was not saved, so it is loaded by the next backup again
+        """
+        entity_id = entity['id']['id']
+        if entity_id in self.old_marks:
+            self.marks[entity_id] = self.old_marks[entity_id]
         else:
-            print(f"FAILURE: rulechain {chain['id']['id']} was not loaded")
-            print(f"Response status: {resp.status_code}")
-            print(resp.json())
-        save_file = save_dir + '/' + f"{str(i)}.json"
-        save_entities(save_file, chain_info,)
-    return chains_info_list
+            self.marks.pop(entity_id, None)
+
+    def commit(self):
+        self.deleted = [entity_id for entity_id in self.old_marks if entity_id not in self.marks]
+        self.manifest.entities[self.entity_name] = self.marks
+
+def save_tenant(tb_url, token, folder, manifest, only_changed=False):
+    """
+    Saves the entities of the tenant to folder in the format of the manifest and updates the manifest.
+    With only_changed the entities not changed since the manifest are skipped. The relations and the attributes
+    are loaded for all assets and devices, but only the changed ones are saved.
+    Returns the ids of the deleted entities by the entity names, the ids of the entities
+    whose relations or attributes are deleted for RELATION and ATTRIBUTE.
+    tb.RequestError is raised if a list of the entities was not loaded.
+    """
+    changes = {name: manifest.changes(name, only_changed) for name in TRACKED}
+    save_customers(tb_url, manifest.entity_path(folder, 'CUSTOMER'), token=token, changes=changes['CUSTOMER'])
+    save_assets(tb_url, manifest.entity_path(folder, 'ASSET'), token=token, changes=changes['ASSET'])
+    save_devices(tb_url, manifest.entity_path(folder, 'DEVICE'), token=token, changes=changes['DEVICE'])
+    def listed(entity_name):
+        # all entities of the tenant are in the manifest, the saved file of a delta has only the changed ones
+        return ({'id': {'entityType': entity_name, 'id': entity_id}} for entity_id in manifest.entities[entity_name])
+    session = tb.make_session(pool_size=WORKERS)
+    save_relations(tb_url, listed('ASSET'), manifest.entity_path(folder, 'RELATION'), token=token, session=session,
+                   changes=changes['RELATION'])
+    save_attributes(tb_url, itertools.chain(listed('ASSET'), listed('DEVICE')),
+                    manifest.entity_path(folder, 'ATTRIBUTE'), token, session=session, changes=changes['ATTRIBUTE'])
+    save_dashboards(tb_url, manifest.entity_path(folder, 'DASHBOARD'), token, changes['DASHBOARD'])
+    save_rulechains(tb_url, manifest.entity_path(folder, 'RULECHAIN'), token, changes['RULECHAIN'])
+    return {name: c.deleted for name, c in changes.items() if c.deleted}
+
+def save_snapshot(tb_url, token, folder, fmt='json', codec=None):
+    """
+    Full backup of the tenant with a new manifest. The snapshot is saved to a temporary folder and replaces
+    the previous one when all the lists are loaded, so a failed backup keeps the previous backup with its deltas.
+    The delta snapshots of the previous backup are removed.
+    """
+    check_dir(folder)
+    previous = Manifest.load(folder)
+    manifest = Manifest(folder, fmt, codec)
+    tmp_dir = path.join(folder, SNAPSHOT_TMP_DIR)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    check_dir(tmp_dir)
+    try:
+        save_tenant(tb_url, token, tmp_dir, manifest)
+        for name in TRACKED:
+            saved = manifest.entity_path(folder, name)
+            if name in DIRS:
+                shutil.rmtree(saved, ignore_errors=True)
+            os.replace(manifest.entity_path(tmp_dir, name), saved)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    manifest.save()
+    for delta in previous.deltas if previous else []:
+        shutil.rmtree(path.join(folder, delta), ignore_errors=True)
+    print(f"Full snapshot saved to {folder}")
+    return manifest
 
+def save_delta(tb_url, token, folder):
+    """
+    Saves the changes since the last backup to a new delta folder. The delta is listed in the manifest
+    when it is complete, so an interrupted delta is ignored by the next backups.
+    """
+    manifest = Manifest.load(folder)
+    delta = DELTA_PREFIX + dt.datetime.now().strftime(TIME_FORMAT)
+    # an interrupted delta of the same second is not reused
+    delta = next(name for name in itertools.chain([delta], (f"{delta}-{i}" for i in itertools.count(1)))
+                 if not path.exists(path.join(folder, name)))
+    delta_dir = path.join(folder, delta)
+    check_dir(delta_dir)
+    try:
+        deleted = save_tenant(tb_url, token, delta_dir, manifest, only_changed=True)
+        save_entity(path.join(delta_dir, DELETED_FILE), deleted)
+    except BaseException:
+        shutil.rmtree(delta_dir, ignore_errors=True)
+        raise
+    manifest.deltas.append(delta)
+    manifest.save()
+    print(f"Delta snapshot saved to {delta_dir}")
+    return delta_dir
 
+def compact(folder):
+    """
+    Merges the delta snapshots into the full snapshot in their order and removes them
+    """
+    manifest = Manifest.load(folder)
+    if not manifest or not manifest.deltas:
+        print(f"No delta snapshots in {folder}")
+        return
+    delta_dirs = [path.join(folder, delta) for delta in manifest.deltas]
+    deleted = []
+    for delta_dir in delta_dirs:
+        with open(path.join(delta_dir, DELETED_FILE), encoding='utf-8') as f:
+            deleted.append(json.load(f))
+    # the relations of an entity are replaced all together, so they are found by the entity
+    keys = {'CUSTOMER': _entity_id, 'ASSET': _entity_id, 'DEVICE': _entity_id,
+            'RELATION': lambda r: r['from']['id'], 'ATTRIBUTE': _entity_id}
+    for name, key in keys.items():
+        # the number of the snapshot with the latest version of the entity, 0 is the full snapshot, None if deleted
+        latest = {}
+        for i, delta_dir in enumerate(delta_dirs):
+            file = manifest.entity_path(delta_dir, name)
+            for entity in read_entities(file) if path.exists(file) else []:
+                latest[key(entity)] = i + 1
+            for entity_id in deleted[i].get(name, []):
+                latest[entity_id] = None
+        _merge_file(manifest, folder, delta_dirs, name, latest, key)
+    for name in DIRS:
+        save_dir = manifest.entity_path(folder, name)
+        check_dir(save_dir)
+        for i, delta_dir in enumerate(delta_dirs):
+            delta_save_dir = manifest.entity_path(delta_dir, name)
+            for file in os.listdir(delta_save_dir) if path.exists(delta_save_dir) else []:
+                os.replace(path.join(delta_save_dir, file), path.join(save_dir, file))
+            for entity_id in deleted[i].get(name, []):
+                file = path.join(save_dir, entity_id + '.json')
+                if path.exists(file):
+                    os.remove(file)
+    manifest.snapshot = manifest.deltas[-1][len(DELTA_PREFIX):]
+    manifest.deltas = []
+    manifest.save()
+    for delta_dir in delta_dirs:
+        shutil.rmtree(delta_dir, ignore_errors=True)
+    print(f"{len(delta_dirs)} delta snapshots merged into {folder}")
 
+def _entity_id(entity):
+    return entity['id']['id']
 
-files = {'TENANT': "tenants.json",
-         'ASSET': "assets.json",
-         'DEVICE': "devices.json",
-         'RELATION': "relations.json",
-         'CUSTOMER': "customers.json",
-         'ATTRIBUTE': "attributes.json",
+def _merge_file(manifest, folder, delta_dirs, entity_name, latest, key):
+    files = [manifest.entity_path(folder, entity_name)] + [manifest.entity_path(delta_dir, entity_name) for delta_dir in delta_dirs]
+    with EntityWriter(files[0]) as writer:
+        for i, file in enumerate(files):
+            if not path.exists(file):
+                continue
+            for entity in read_entities(file):
+                if latest.get(key(entity), 0) == i:
+                    writer.write(entity)
+
+files = {'TENANT': "tenants",
+         'ASSET': "assets",
+         'DEVICE': "devices",
+         'RELATION': "relations",
+         'CUSTOMER': "customers",
+         'ATTRIBUTE': "attributes",
          'DASHBOARD': "dashboards",
          'RULECHAIN': "rulechains"}
+# saved to directories, a file per entity
+DIRS = ('DASHBOARD', 'RULECHAIN')
 
 def check_dir(folder):
     if not path.exists(folder):
@@ -196,8 +673,12 @@ def prepare_tenant_dir(folder, tenant):
     tenant_user, tenant_pass = tenant_params['user'], tenant_params['password']
     return tenant_dir, tenant_user, tenant_pass
 
-def mkpath(folder, entity_name):
+def mkpath(folder, entity_name, fmt='json', codec=None):
+    if entity_name in DIRS:
         return folder + '/' + files[entity_name]
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}. Possible values are {', '.join(FORMATS)}")
+    return folder + '/' + files[entity_name] + '.' + fmt + compression.extension(codec)
 
 #TB_ACCESS_FILE = 
 #TB_ACCESS_FILE = "tb_lab11.access"
@@ -205,9 +686,21 @@ def mkpath(folder, entity_name):
 #folder = "main_tb"
 
 if __name__ == "__main__":
-    access_file = sys.argv[1]
-    folder = sys.argv[2]
+    parser = argparse.ArgumentParser(description="Backup of the entities of Thingsboard tenant")
+    parser.add_argument('access_file', help="Thingsboard url, user and password")
+    parser.add_argument('folder', help="backup folder")
+    parser.add_argument('--format', choices=FORMATS, default='json',
+                        help="json array or JSON Lines, the format of the full snapshot is kept by its deltas")
+    parser.add_argument('--compress', choices=compression.CODECS, help="compression of the files")
+    parser.add_argument('--incremental', action='store_true',
+                        help="save only the changes since the last backup, the full snapshot is saved if there is none")
+    parser.add_argument('--compact', action='store_true', help="merge the delta snapshots into the full snapshot")
+    args = parser.parse_args()
+    access_file, folder = args.access_file, args.folder
     check_dir(folder)
+    if args.compact:
+        compact(folder)
+        raise SystemExit
     params = tb.load_access_parameters(access_file)
     tb_url, tb_user, tb_password, tb_admin, tb_admin_password = params["url"], params["user"], params["password"], params["admin_user"], params["admin_password"]
     #tenants_list = save_tenants(tb_url, tb_admin, tb_admin_password, mkpath(folder, 'TENANT'))
@@ -219,14 +712,10 @@ if __name__ == "__main__":
         bearerToken = tb.getToken(tb_url, tb_user, tb_password)[0]
         print("Access token obtained:")
         print(bearerToken)
-        #save_customers(tb_url, mkpath(folder, 'CUSTOMER'), token = bearerToken)
-        #assets = save_assets(tb_url,  mkpath(folder,'ASSET'), token = bearerToken)
-        #devices = save_devices(tb_url,  mkpath(folder, 'DEVICE'), token = bearerToken)
-        #save_relations(tb_url, assets, mkpath(folder, 'RELATION'), token = bearerToken)
-        #entity_list = assets + devices
-        #save_attributes(tb_url, entity_list, mkpath(folder, 'ATTRIBUTE'), token = bearerToken)
-        #save_dashboards(tb_url, mkpath(folder, 'DASHBOARD'), token = bearerToken)
-        save_rulechains(tb_url, mkpath(folder, 'RULECHAIN'), token = bearerToken)
+        if args.incremental and Manifest.load(folder):
+            save_delta(tb_url, bearerToken, folder)
+        else:
+            save_snapshot(tb_url, bearerToken, folder, args.format, args.compress)
     except Exception as e:
         print(e)
             
@@ -1,66 +1,229 @@
-#TODO
-#Devices
-#Assets
-#Relations
-#Attributes
+#Restores the entities of a tenant from the folder saved by entity_backup:
+#customers, then assets and devices, then relations, then attributes.
+#The entities of every step are created concurrently by WORKERS threads, the requests failed with
+#RETRY_STATUS or by the connection error are retried (see entity_backup.crawl).
+#The entity may be created by the request whose response is lost, so before the retry of the creation
+#the entity is looked up by the name and is not created twice.
+#The new entities get new ids, the map old id -> new id is used to restore the customers of assets and devices,
+#the relations and the attributes, and can be saved to a file.
+#The entities with the names that already exist in the tenant are not created again, their ids are used,
+#so the restore that failed may be run again.
+#The attributes of every scope of an entity are uploaded by one request.
+#CLIENT_SCOPE attributes are sent by the devices and are not restored, the dashboards and rule chains too.
+#The restored devices get new credentials (access tokens), so the devices must be given the new tokens.
+#The delta snapshots of the incremental backup must be merged by entity_backup.py --compact before.
+#
+#Usage: entity_upload.py tb.access folder [--workers 8] [--id-map ids.json]
 
 import tb_rest as tb
+import entity_backup as backup
+import compression
 import json as json
-import os as os
+import os.path as path
+import argparse
+import itertools
+import threading
 
+WORKERS = 8
+# customerId of the entities not assigned to a customer
+NULL_ID = "13814000-1dd2-11b2-8080-808080808080"
+UPLOAD_SCOPES = ('SERVER_SCOPE', 'SHARED_SCOPE')
+POST = {'CUSTOMER': tb.post_customer, 'ASSET': tb.post_asset, 'DEVICE': tb.post_device}
+
+
+def find_file(folder, entity_name):
+    """
+    The file of the entities saved in any format and compression or None
+    """
+    for fmt, codec in itertools.product(backup.FORMATS, (None,) + compression.CODECS):
+        file = backup.mkpath(folder, entity_name, fmt, codec)
+        if path.exists(file):
+            return file
+    return None
+
+def saved_entities(folder, entity_name):
+    file = find_file(folder, entity_name)
+    if file is None:
+        print(f"No {backup.files[entity_name]} in {folder}")
+        return []
+    return backup.read_entities(file)
+
+def entity_name(entity):
+    return entity['title'] if entity['id']['entityType'] == 'CUSTOMER' else entity['name']
+
+def existing_ids(tb_url, token, session=None):
+    """
+    Ids of the customers, assets and devices of the tenant by (entity type, name)
+    """
+    entities = itertools.chain(tb.iter_customers(tb_url, token, session=session),
+                               tb.iter_tenant_assets(tb_url, token, session=session),
+                               tb.iter_tenant_devices(tb_url, token, session=session))
+    return {(e['id']['entityType'], entity_name(e)): e['id']['id'] for e in entities}
+
+def find_id(tb_url, token, entity_type, name, session=None):
+    """
+    Id of the customer, asset or device of the tenant with the name or None
+    """
+    search = {'CUSTOMER': tb.iter_customers, 'ASSET': tb.iter_tenant_assets, 'DEVICE': tb.iter_tenant_devices}
+    try:
+        for e in search[entity_type](tb_url, token, textSearch=name, session=session):
+            if entity_name(e) == name:
+                return e['id']['id']
+    except tb.RequestError as e:
+        raise backup.FetchError(e.resp)
+    return None
+
+def upload_entities(tb_url, token, entities, id_map, existing, title, workers=WORKERS, session=None):
+    """
+    Creates the customers, assets or devices and adds their new ids to id_map.
+    The customers of the assets and devices are replaced by the new ones, so the customers are uploaded first.
+    Returns the number of the entities created or found in existing.
+    """
+    posted = set()
+    lock = threading.Lock()
+    def post(entity):
+        entity_type, name = entity['id']['entityType'], entity_name(entity)
+        entity_id = existing.get((entity_type, name))
+        if entity_id:
+            return entity_id
+        with lock:
+            retry = entity['id']['id'] in posted
+            posted.add(entity['id']['id'])
+        if retry:
+            # the previous request may have created the entity before its response was lost
+            entity_id = find_id(tb_url, token, entity_type, name, session)
+            if entity_id:
+                return entity_id
+        entity_json = dict(entity)
+        if 'customerId' in entity_json:
+            customer_id = entity_json['customerId']['id']
+            if customer_id not in id_map:
+                raise ValueError(f"Customer {customer_id} was not restored")
+            entity_json['customerId'] = {'entityType': 'CUSTOMER', 'id': id_map[customer_id]}
+        created, resp = POST[entity['id']['entityType']](tb_url, token, entity_json, create_new=True, session=session)
+        if not created:
+            raise backup.FetchError(resp)
+        return created['id']['id']
+    count = 0
+    for entity, entity_id in backup.crawl(entities, _skip_errors(post), title, workers):
+        if entity_id:
+            id_map[entity['id']['id']] = entity_id
+            count += 1
+    return count
+
+def upload_relations(tb_url, token, relations, id_map, workers=WORKERS, session=None):
+    """
+    Creates the relations between the restored entities, the relations with other entities are skipped.
+    Returns the number of the created relations.
+    """
+    skipped = 0
+    def mapped():
+        nonlocal skipped
+        for relation in relations:
+            if relation['from']['id'] in id_map and relation['to']['id'] in id_map:
+                yield relation
+            else:
+                skipped += 1
+    def post(relation):
+        resp = tb.create_relation(tb_url, token, relation['from']['entityType'], id_map[relation['from']['id']],
+                                  relation['to']['entityType'], id_map[relation['to']['id']],
+                                  relation['type'], relation['typeGroup'], relation.get('additionalInfo'),
+                                  session=session)
+        if resp.status_code != 200:
+            raise backup.FetchError(resp)
+        return True
+    count = sum(1 for relation, done in backup.crawl(mapped(), post, "Relations", workers) if done)
+    if skipped:
+        print(f"{skipped} relations with the entities that were not restored are skipped")
+    return count
+
+def upload_attributes(tb_url, token, attributes_list, id_map, workers=WORKERS, session=None):
+    """
+    Uploads UPLOAD_SCOPES attributes of the restored entities, a request per scope.
+    Returns the number of the entities with the uploaded attributes.
+    """
+    def post(entry):
+        for scope in UPLOAD_SCOPES:
+            attributes = {a['key']: a['value'] for a in entry.get(scope) or []}
+            if attributes:
+                resp = tb.upload_attributes(tb_url, token, id_map[entry['id']['id']], entry['id']['entityType'],
+                                            scope, attributes, session=session)
+                if resp.status_code != 200:
+                    raise backup.FetchError(resp)
+        return True
+    entries = (entry for entry in attributes_list if entry['id']['id'] in id_map)
+    return sum(1 for entry, done in backup.crawl(entries, post, "Attributes", workers) if done)
+
+def restore(tb_url, token, folder, workers=WORKERS):
+    """
+    Restores the entities of the backup folder to the tenant of the token, returns the map old id -> new id
+    """
+    manifest = backup.Manifest.load(folder)
+    if manifest and manifest.deltas:
+        raise ValueError(f"{folder} has delta snapshots, merge them by entity_backup.py --compact")
+    session = tb.make_session(pool_size=workers)
+    print("Loading existing entities...")
+    existing = existing_ids(tb_url, token, session=session)
+    id_map = {NULL_ID: NULL_ID}
+    count = upload_entities(tb_url, token, saved_entities(folder, 'CUSTOMER'), id_map, existing, "Customers",
+                            workers, session)
+    print(f"{count} customers restored")
+    entities = itertools.chain(saved_entities(folder, 'ASSET'), saved_entities(folder, 'DEVICE'))
+    count = upload_entities(tb_url, token, entities, id_map, existing, "Assets and devices", workers, session)
+    print(f"{count} assets and devices restored")
+    count = upload_relations(tb_url, token, saved_entities(folder, 'RELATION'), id_map, workers, session)
+    print(f"{count} relations restored")
+    count = upload_attributes(tb_url, token, saved_entities(folder, 'ATTRIBUTE'), id_map, workers, session)
+    print(f"Attributes of {count} entities restored")
+    del id_map[NULL_ID]
+    return id_map
 
 def upload_devices(tb_url, json_file, token):
-    with open(json_file, 'r', encoding="cp1251") as file:
-        json_dict = json.load(file)
-    for d in json_dict:
-        resp_data, resp = tb.post_device(tb_url, token, d)
-        if not resp_data:
-            print("Error uploading device:")
-            print(d)
-            print(resp)
+    """
+    Creates the devices of the file saved by entity_backup, the customers are not assigned.
+    The devices get new ids and new credentials generated by Thingsboard, the access tokens of the backup
+    are not restored. ownerId is sent as it is saved, only customerId is replaced.
+    """
+    devices = ({**d, 'customerId': {'entityType': 'CUSTOMER', 'id': NULL_ID}} for d in backup.read_entities(json_file))
+    return upload_entities(tb_url, token, devices, {NULL_ID: NULL_ID}, {}, "Devices")
+
+def _skip_errors(post):
+    """The entity that can not be restored because of the backup is failed without the retries"""
+    def post_entity(entity):
+        try:
+            return post(entity)
+        except ValueError as e:
+            print(f"FAILURE: {backup.describe(entity)}: {e}")
+            return None
+    return post_entity
 
 
 #TB_ACCESS_FILE = "tb_lab11.access"
 TB_ACCESS_FILE = "tb.access"
 
-files = {'TENANT': "tenants.json",
-         'ASSET': "assets.json",
-         'DEVICE': "devices.json",
-         'RELATION': "relations.json",
-         'CUSTOMER': "customers.json",
-         'ATTRIBUTE': "attributes.json",
-         'DASHBOARD': "dashboards.json"}
-
 #folder = "lab_11"
 folder = "main_tb/ИПУ РАН"
 
-def mkpath(entity_name):
-    return folder + '/' + files[entity_name]
-
 if __name__ == "__main__":
-    
-    params = tb.load_access_parameters(TB_ACCESS_FILE)
-    tb_url, tb_user, tb_password, tb_admin, tb_admin_password = params["url"], params["user"], params["password"], params["admin_user"], params["admin_password"]
-    #tenants_list = upload_tenants(tb_url, mkpath('TENANT'), token)
-    #tenants_list = ['ИПУ РАН']
-    #tenant_dir = folder + "/ИПУ РАН"
-    #for tenant_dir in os.walk(folder):
-    try:
+    parser = argparse.ArgumentParser(description="Restore of the entities of Thingsboard tenant from the backup")
+    parser.add_argument('access_file', nargs='?', default=TB_ACCESS_FILE, help="Thingsboard url, user and password")
+    parser.add_argument('folder', nargs='?', default=folder, help="backup folder saved by entity_backup")
+    parser.add_argument('--workers', type=int, default=WORKERS, help="concurrent requests")
+    parser.add_argument('--id-map', help="json file to save the map old id -> new id")
+    args = parser.parse_args()
+    params = tb.load_access_parameters(args.access_file)
+    tb_url = params["url"]
     #read tenant user
     #    params = tb.load_access_parameters(folder + '/' + '.access')
+    try:
         tenant_user, tenant_pass = params['user'], params['password']
         print(f"Authorizing as {tenant_user}...")
-        bearerToken = tb.get_token(tb_url, tenant_user, tenant_pass)[0]
+        bearerToken = tb.getToken(tb_url, tenant_user, tenant_pass)[0]
         print("Access token obtained:")
         print(bearerToken)
-        #upload_customers(tb_url, mkpath('CUSTOMER'), bearerToken)
-        upload_devices(tb_url, mkpath('DEVICE'), bearerToken)
-        #upload_assets(tb_url, mkpath('ASSETS'), bearerToken)
-        #upload_relations(tb_url, mkpath('RELATION'), bearerToken)
-        #upload_attributes(tb_url, mkpath('ATTRIBUTE'), bearerToken)
-        #upload_dashboards(tb_url, mkpath('DASHBOARD'), bearerToken)
+        id_map = restore(tb_url, bearerToken, args.folder, args.workers)
+        if args.id_map:
+            with open(args.id_map, 'w', encoding='utf-8') as f:
+                json.dump(id_map, f)
     except Exception as e:
-        #print(f"Error at tenant {tenant_dir}")
         print(e)
-
-
@@ -1,6 +1,12 @@
+"""
+Uploads random telemetry to all devices of the tenant.
+python populate_tb.py access.json N [mqtt]
+N - number of messages of every device. With mqtt, the telemetry is published by MQTT (requires paho-mqtt).
+"""
 from sys import argv
 import time
 import random
+from urllib.parse import urlparse
 import tb_rest as tb
 
 
@@ -11,11 +17,16 @@ if __name__ == "__main__":
     tb_con = tb.TbConnection(tb_params['url'], tb_params['user'], tb_params['password'])
     print(tb_con.get_token())
     #list devices
-    devices, resp = tb.get_tenant_devices(tb_con.url, tb_con.get_token())
+    devices, resp = tb.get_tenant_devices(tb_con.url, tb_con.get_token(), session=tb_con.session)
     #generate data
     for d in devices:
-        d['token'] = tb.get_device_credentials(tb_con.url, tb_con.get_token(), d['id']['id'])['credentialsId']
+        d['token'] = tb.get_device_credentials(tb_con.url, tb_con.get_token(), d['id']['id'],
+                                                 session=tb_con.session)['credentialsId']
     num = int(argv[2])
+    mqtt_uploader = None
+    if len(argv) > 3 and argv[3] == 'mqtt':
+        import tb_mqtt
+        mqtt_uploader = tb_mqtt.MqttUploader(urlparse(tb_con.url).hostname)
     for i in range(num):
         for d in devices:
             if d['type']=='thermostat':
@@ -24,5 +35,10 @@ if __name__ == "__main__":
                 json_data = {'K': random.randint(0, 100), 'P':5-random.random()*10}
             else:
                 json_data = {'A': random.randint(0, 10), 'B':random.random()*10}
-            tb.upload_telemetry(tb_con.url, d['token'], json_data)
+            if mqtt_uploader:
+                mqtt_uploader.submit(d['token'], json_data)
+            else:
+                tb.upload_telemetry(tb_con.url, d['token'], json_data, session=tb_con.session)
+    if mqtt_uploader:
+        mqtt_uploader.close()
     time.sleep(WAIT_SEC)
\ No newline at end of file
@@ -0,0 +1,228 @@
+"""
+MQTT transport for telemetry upload to Thingsboard.
+
+A connection is kept open, so a message costs a PUBLISH packet instead of an HTTP request.
+Two APIs of Thingsboard are supported:
+    device - every device has its own connection with its access token as the user name,
+             the messages are published to v1/devices/me/telemetry
+    gateway - one connection with the access token of a gateway device, the messages of all devices
+              are published to v1/gateway/telemetry as {"Device A": [{"ts": ..., "values": {...}}, ...]}.
+              The devices are found (or created by Thingsboard) by their names.
+The device mode opens a connection and a network thread for every device, so with many devices
+the gateway mode is preferred.
+
+With QoS 1 a message is complete when the broker acknowledges it, with QoS 0 when it is sent.
+Not more than max_inflight messages of a connection wait for the acknowledgement;
+the next message waits for a place, so the caller is not ahead of the broker.
+If no place is free for INFLIGHT_TIMEOUT_SEC (the broker does not acknowledge or the connection is lost)
+or the broker rejects the connection, the message is failed like a message failed by the HTTP uploader,
+and the next messages are failed at once until a message of the connection is complete again.
+
+MqttUploader has the interface of upload_arxiv.Uploader, so the batches of upload_arxiv and the journal
+work with both transports:
+    with MqttUploader('my-tb.org', gateway_token='GATEWAY_TOKEN') as uploader:
+        uploader.submit('Device A', {'ts': 1616965289148, 'values': {'T': 20}})
+
+Requires paho-mqtt 2.
+"""
+import json
+import threading
+import time
+from datetime import datetime
+from sys import stderr
+
+import paho.mqtt.client as mqtt
+
+PORT = 1883
+QOS = 1
+MAX_INFLIGHT = 100
+KEEPALIVE_SEC = 60
+CONNECT_TIMEOUT_SEC = 30
+CLOSE_TIMEOUT_SEC = 60
+INFLIGHT_TIMEOUT_SEC = 60
+INFLIGHT_POLL_SEC = 1
+DEVICE_TOPIC = "v1/devices/me/telemetry"
+GATEWAY_TOPIC = "v1/gateway/telemetry"
+
+
+class Connection:
+    """MQTT connection with the access token as the user name.
+    The client reconnects by itself after a disconnection, the messages with QoS 1 are sent again."""
+
+    def __init__(self, host, port, token, qos=QOS, max_inflight=MAX_INFLIGHT, keepalive=KEEPALIVE_SEC):
+        self.address = f"{host}:{port}"
+        self.qos = qos
+        self.inflight = threading.Semaphore(max_inflight)
+        self.lock = threading.Lock()
+        self.pending = {}  # mid -> done callback
+        self.early = set()  # mids acknowledged before publish() returned
+        self.connected = threading.Event()
+        self.error = None
+        self.stalled = False  # a message could not get a place in the window
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.client.username_pw_set(token)
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.connect(host, port, keepalive)
+        self.client.loop_start()
+        if not self.connected.wait(CONNECT_TIMEOUT_SEC) or self.error:
+            self.client.loop_stop()
+            raise ConnectionError(f"MQTT connection to {self.address} failed: {self.error or 'timeout'}")
+
+    def publish(self, topic, payload, done):
+        """Waits for a place in the in-flight window and publishes the message.
+        done(success) is called by the network thread when the message is complete,
+        done(False) is called at once if the message can not get a place."""
+        if not self._acquire():
+            done(False)
+            return
+        # the lock is not held while paho publishes, because paho calls on_publish with its own lock held
+        info = self.client.publish(topic, payload, self.qos)
+        # without the connection the message with QoS 1 is queued until the client reconnects
+        queued = info.rc == mqtt.MQTT_ERR_NO_CONN and self.qos > 0
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and not queued:
+            print(f"ERROR at {datetime.now()}: publish to {self.address} failed: "
+                  f"{mqtt.error_string(info.rc)}", file=stderr)
+            self.inflight.release()
+            done(False)
+            return
+        with self.lock:
+            if info.mid in self.early:
+                self.early.remove(info.mid)
+            else:
+                self.pending[info.mid] = done
+                return
+        self.stalled = False
+        self.inflight.release()
+        done(True)
+
+    def _acquire(self):
+        """Waits for a place in the in-flight window, returns False if the connection is stalled or rejected"""
+        deadline = time.monotonic() + INFLIGHT_TIMEOUT_SEC
+        while not self.inflight.acquire(timeout=0 if self.stalled else INFLIGHT_POLL_SEC):
+            if self.error or self.stalled or time.monotonic() >= deadline:
+                if not self.stalled:
+                    state = "rejected: " + self.error if self.error else \
+                        "connected" if self.connected.is_set() else "disconnected"
+                    print(f"ERROR at {datetime.now()}: no acknowledgement from {self.address} "
+                          f"for {INFLIGHT_TIMEOUT_SEC} s ({state}), the messages are failed", file=stderr)
+                    self.stalled = True
+                return False
+        return True
+
+    def close(self, timeout=CLOSE_TIMEOUT_SEC):
+        """Waits for the messages in flight, the messages not complete in timeout seconds are failed"""
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self.lock:
+            failed = list(self.pending.values())
+            self.pending.clear()
+        for done in failed:
+            done(False)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            self.error = str(reason_code)
+            # the token is wrong or the broker rejects the client, reconnecting does not help
+            client.disconnect()
+        self.connected.set()
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        if self.connected.is_set() and not self.error and reason_code != 0:
+            print(f"ERROR at {datetime.now()}: disconnected from {self.address}: {reason_code}", file=stderr)
+            self.connected.clear()
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        with self.lock:
+            done = self.pending.pop(mid, None)
+            if done is None:
+                self.early.add(mid)
+                return
+        self.stalled = False
+        self.inflight.release()
+        done(True)
+
+
+class MqttUploader:
+    """Publishes telemetry by MQTT. The interface is the same as upload_arxiv.Uploader.
+    In the device mode device_token is the access token of the device,
+    in the gateway mode (gateway_token is given) it is the name of the device.
+    limiter.acquire(device_token, size) is called before every message if the limiter is given.
+    Used as a context manager: on exit it waits until all messages are complete."""
+
+    def __init__(self, host, port=PORT, qos=QOS, max_inflight=MAX_INFLIGHT, gateway_token=None, limiter=None):
+        self.host = host
+        self.port = port
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.limiter = limiter
+        self.sent = 0
+        self.failed = 0
+        self.entries = 0
+        self.lock = threading.Lock()
+        self.gateway = Connection(host, port, gateway_token, qos, max_inflight) if gateway_token else None
+        self.devices = {}  # device token -> Connection or None if the device can not connect
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, device_token, message_json, done=None):
+        if self.gateway and 'values' not in message_json:
+            # the gateway API accepts only the messages with ts
+            message_json = {'ts': int(time.time() * 1000), 'values': message_json}
+        self.submit_body(device_token, json.dumps(message_json).encode('utf-8'), done=done)
+
+    def submit_body(self, device_token, body, entries=1, done=None):
+        """body is the json of the message or of the array of messages, entries is the number of telemetry
+        entries in it. done(success) is called when the message is complete."""
+        if self.limiter:
+            self.limiter.acquire(device_token, len(body))
+        if self.gateway:
+            connection, topic, body = self.gateway, GATEWAY_TOPIC, gateway_payload(device_token, body)
+        else:
+            connection, topic = self._device_connection(device_token), DEVICE_TOPIC
+
+        def complete(success):
+            with self.lock:
+                if success:
+                    self.sent += 1
+                    self.entries += entries
+                else:
+                    self.failed += 1
+            if done:
+                done(success)
+
+        if connection is None:
+            complete(False)
+        else:
+            connection.publish(topic, body, complete)
+
+    def close(self):
+        for connection in list(self.devices.values()) + [self.gateway]:
+            if connection:
+                connection.close()
+        print(f"Published {self.sent} messages with {self.entries} entries, failed {self.failed}")
+
+    def _device_connection(self, device_token):
+        if device_token not in self.devices:
+            try:
+                self.devices[device_token] = Connection(self.host, self.port, device_token, self.qos,
+                                                        self.max_inflight)
+            except (ConnectionError, OSError) as e:
+                print(f"ERROR at {datetime.now()}: device {device_token}: {e}", file=stderr)
+                self.devices[device_token] = None
+        return self.devices[device_token]
+
+
+def gateway_payload(device_name, body):
+    """{"device name": [messages]} for the json of a message or of an array of messages"""
+    messages = body if body.lstrip().startswith(b'[') else b'[' + body + b']'
+    return b'{' + json.dumps(device_name).encode('utf-8') + b': ' + messages + b'}'
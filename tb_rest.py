@@ -1,14 +1,32 @@
 # Import smtplib for the actual sending function
 import urllib.request
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime as dt
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import os.path as path
 import os as os
 
 # authorization
 LOGIN_URL = '/api/auth/login'
 
+# connection pool
+POOL_SIZE = 10
+MAX_RETRIES = 3
+RETRY_BACKOFF_SEC = 0.5
+RETRY_STATUS = (502, 503, 504)
+
+# pagination
+PAGE_SIZE = 1000
+
+# the fields of an entity that Thingsboard sets itself, removed when the entity of a backup is created again;
+# the profiles are found or created by Thingsboard by the type of the entity
+SERVER_FIELDS = ('id', 'createdTime', 'tenantId', 'version', 'externalId',
+                 'deviceProfileId', 'assetProfileId', 'firmwareId', 'softwareId')
+
 
 class ConnectionError(Exception):
     def __init__(self, tb_connection, resp):
@@ -17,12 +35,42 @@ class ConnectionError(Exception):
         self.message = resp.message
 
 
+class RequestError(Exception):
+    """The response of Thingsboard is not successful"""
+    def __init__(self, resp):
+        super().__init__(f"Error at {resp.url}: {resp.status_code}")
+        self.resp = resp
+
+
+def make_session(pool_size=POOL_SIZE, max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF_SEC):
+    """
+    Creates requests.Session which keeps up to pool_size keep-alive connections per host.
+    Idempotent requests (GET, DELETE) are retried max_retries times on connection errors
+    and on RETRY_STATUS responses with the exponential backoff.
+    POST requests are not retried, because they may be not idempotent.
+    """
+    retries = Retry(total=max_retries, backoff_factor=backoff,
+                    status_forcelist=RETRY_STATUS, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 class TbConnection:
+    """
+    Keeps the access token and the pool of HTTP connections to Thingsboard.
+    Pass tb_connection.session to the functions of this module to reuse the connections:
+        tb.get_timeseries(con.url, device_id, con.get_token(), keys, start_ts, end_ts, session=con.session)
+    If session is not passed, the function opens a new connection for every request.
+    """
     TOKEN_EXPIRE_SEC = dt.timedelta(seconds=800)
 
-    def __init__(self, tb_url, tb_user, tb_password):
+    def __init__(self, tb_url, tb_user, tb_password, pool_size=POOL_SIZE, max_retries=MAX_RETRIES):
         print(f"Authorization at {tb_url} as {tb_user}")
-        bearer_token, refresh_token, resp = getToken(tb_url, tb_user, tb_password)
+        self.session = make_session(pool_size, max_retries)
+        bearer_token, refresh_token, resp = getToken(tb_url, tb_user, tb_password, session=self.session)
         if not request_success(resp):
             raise ConnectionError(self, resp)
         self.user = tb_user
@@ -31,26 +79,38 @@ class TbConnection:
         self.refresh_token = refresh_token
         self.url = tb_url
         self.token_time = dt.datetime.now()
+        self._token_lock = threading.Lock()
 
     def expired(self):
         return dt.datetime.now() - self.token_time >= self.TOKEN_EXPIRE_SEC
 
     def update_token(self, force=False):
         if self.expired() or force:
-            print("Refreshing token ...")
-            self.token, self.refresh_token, tokenAuthResp = refresh_token(self.url, self.token, self.refresh_token)
-            self.token_time = dt.datetime.now()
-            if not request_success(tokenAuthResp):
-                print("Token refresh failed, obtaining a new token ...")
-                self.token, self.refresh_token, new_resp = getToken(self.url, self.user, self.password)
-                if not request_success(new_resp):
-                    print("Authorization request failed")
-                    raise ConnectionError(self, new_resp)
+            with self._token_lock:
+                # another thread could refresh the token while this one was waiting for the lock
+                if self.expired() or force:
+                    self._refresh()
+
+    def _refresh(self):
+        print("Refreshing token ...")
+        self.token, self.refresh_token, tokenAuthResp = refresh_token(self.url, self.token, self.refresh_token,
+                                                                      session=self.session)
+        self.token_time = dt.datetime.now()
+        if not request_success(tokenAuthResp):
+            print("Token refresh failed, obtaining a new token ...")
+            self.token, self.refresh_token, new_resp = getToken(self.url, self.user, self.password,
+                                                                session=self.session)
+            if not request_success(new_resp):
+                print("Authorization request failed")
+                raise ConnectionError(self, new_resp)
 
     def get_token(self):
         self.update_token()
         return self.token
 
+    def close(self):
+        self.session.close()
+
 
 def get_auth_url(tb_url):
     return tb_url + LOGIN_URL
@@ -69,12 +129,12 @@ def load_access_parameters(key_value_file):
     return params
 
 
-def getToken(tb_url, user, passwd, print_token=False):
+def getToken(tb_url, user, passwd, print_token=False, session=None):
     url = get_auth_url(tb_url)
     headers = {'Content-Type': 'application/json',
                'Accept': 'application/json'}
     loginJSON = {'username': user, 'password': passwd}
-    resp = requests.post(url, headers=headers, json=loginJSON)
+    resp = _http(session).post(url, headers=headers, json=loginJSON)
     tokenAuthResp = resp.json()
     if 'token' in tokenAuthResp:
         bearerToken = 'Bearer: ' + tokenAuthResp['token']
@@ -135,22 +195,22 @@ def is_expired(expire_time):
     return expire_time < dt.datetime.now()
 
 
-def refresh_token(tb_url, bearerToken, refreshToken):
+def refresh_token(tb_url, bearerToken, refreshToken, session=None):
     REFRESH_URL = '/api/auth/token'
     url = tb_url + REFRESH_URL
     headers = {'Content-Type': 'application/json',
                'X-Authorization': bearerToken}
     json = {'refreshToken': refreshToken}
-    tokenAuthResp = requests.post(url, headers=headers, json=json)
+    tokenAuthResp = _http(session).post(url, headers=headers, json=json)
     bearerToken = 'Bearer: ' + tokenAuthResp.json()['token']
     refreshToken = tokenAuthResp.json()['refreshToken']
     return bearerToken, refreshToken, tokenAuthResp
 
 
-def getKeys(tb_url, deviceId, bearerToken):
+def getKeys(tb_url, deviceId, bearerToken, session=None):
     url = tb_url + '/api/plugins/telemetry/DEVICE/' + deviceId + '/keys/timeseries'
     headers = {'Accept': 'application/json', 'X-Authorization': bearerToken}
-    resp = requests.get(url, headers=headers)
+    resp = _http(session).get(url, headers=headers)
     return resp
 
 
@@ -167,7 +227,8 @@ SEC_IN_WEEK = SEC_IN_DAY * 7
 SEC_IN_MONTH = SEC_IN_DAY * 30
 
 
-def get_timeseries(tb_url, deviceId, bearerToken, keys, startTs, endTs, limit=SEC_IN_DAY, interval=None, agg='NONE'):
+def get_timeseries(tb_url, deviceId, bearerToken, keys, startTs, endTs, limit=SEC_IN_DAY, interval=None, agg='NONE',
+                   session=None):
     '''
     keys - an iterable like ['temperature', 'humidity']
     startTs, endTs - JavaScript integer timestamp
@@ -177,12 +238,12 @@ def get_timeseries(tb_url, deviceId, bearerToken, keys, startTs, endTs, limit=SE
               'limit': limit, 'interval': interval, 'agg': agg}
     url = tb_url + '/api/plugins/telemetry/DEVICE/' + deviceId + '/values/timeseries'
     headers = {'Accept': 'application/json', 'X-Authorization': bearerToken}
-    resp = requests.get(url, headers=headers, params=params)
+    resp = _http(session).get(url, headers=headers, params=params)
     return resp
 
 
 def get_telemetry(tb_url, deviceId, bearerToken, keys, start_time, end_time, limit=SEC_IN_DAY, interval=None,
-                  agg='NONE'):
+                  agg='NONE', session=None):
     '''
     keys - an iterable like ['temperature', 'humidity']
     start_time, end_time - Python datetime objects
@@ -193,41 +254,44 @@ def get_telemetry(tb_url, deviceId, bearerToken, keys, start_time, end_time, lim
               'limit': limit, 'interval': interval, 'agg': agg}
     url = tb_url + '/api/plugins/telemetry/DEVICE/' + deviceId + '/values/timeseries'
     headers = {'Accept': 'application/json', 'X-Authorization': bearerToken}
-    resp = requests.get(url, headers=headers, params=params)
+    resp = _http(session).get(url, headers=headers, params=params)
     return resp
 
 
 def delete_telemetry(tb_url, bearerToken, entityId, keys,
-                     start_time, end_time, entityType="DEVICE", deleteAllData=False, rewriteLatest=False):
+                     start_time, end_time, entityType="DEVICE", deleteAllData=False, rewriteLatest=False,
+                     session=None):
     start_ts = toJsTimestamp(start_time.timestamp())
     end_ts = toJsTimestamp(end_time.timestamp())
     params = {'keys': ','.join(keys), 'startTs': start_ts, 'endTs': end_ts,
               'deleteAllDataForKeys': deleteAllData, 'rewriteLatestIfDeleted': rewriteLatest}
     headers = {'Accept': 'application/json', 'X-Authorization': bearerToken}
     url = tb_url + f'/api/plugins/telemetry/{entityType}/{entityId}/timeseries/delete'
-    resp = requests.delete(url, headers=headers, params=params)
+    resp = _http(session).delete(url, headers=headers, params=params)
     return resp
 
 
-def load_telemetry(tb_url, bearerToken, device_list, startTs, endTs):
+def load_telemetry(tb_url, bearerToken, device_list, startTs, endTs, session=None):
     for device in device_list:
         resp = get_timeseries(tb_url,
-                              device['id'], bearerToken, device['keys'], startTs, endTs, limit=10000)
+                              device['id'], bearerToken, device['keys'], startTs, endTs, limit=10000,
+                              session=session)
         if resp.status_code == 200:
             device['data'] = resp.json()
     return device_list, resp
 
 
-def upload_telemetry(tb_url, deviceToken, json_data):
+def upload_telemetry(tb_url, deviceToken, json_data, session=None):
     # http(s)://host:port/api/v1/$ACCESS_TOKEN/telemetry
     url = tb_url + '/api/v1/' + deviceToken + '/telemetry'
     headers = {'Content-Type': 'application/json'}
-    resp = requests.post(url, headers=headers, json=json_data)
+    resp = _http(session).post(url, headers=headers, json=json_data)
     return resp
 
 
 def create_asset(tb_url, bearerToken, name,
-                 tenantId, customerId, assetType, info="", createdTime=toJsTimestamp(dt.datetime.now().timestamp())):
+                 tenantId, customerId, assetType, info="", createdTime=toJsTimestamp(dt.datetime.now().timestamp()),
+                 session=None):
     ''' Example of json for NEW asset:
       {
       "additionalInfo": "Info",
@@ -260,35 +324,44 @@ def create_asset(tb_url, bearerToken, name,
         },
         "type": assetType
     }
-    resp = requests.post(url, headers=headers, json=asset_json)
+    resp = _http(session).post(url, headers=headers, json=asset_json)
     if resp.status_code == 200:
         return resp.json(), resp
     else:
         return [], resp
 
 
-def get_asset(tb_url, bearer_token, asset_id):
+def get_asset(tb_url, bearer_token, asset_id, session=None):
     url = tb_url + f"/api/asset/{asset_id}"
-    return _get_entity(url, _x_auth_headers(bearer_token))
+    return _get_entity(url, _x_auth_headers(bearer_token), session=session)
 
 
-def upload_attributes(tb_url, bearer_token, entityId, entityType, scope, attributes):
+def post_asset(tb_url, bearer_token, asset_json, create_new=False, session=None):
+    """
+    Saves the asset. With create_new a new asset is created from asset_json, e.g. of a backup.
+    """
+    if create_new:
+        asset_json = new_entity_json(asset_json)
+    return _post_entity(tb_url + '/api/asset', _x_auth_headers(bearer_token), asset_json, session=session)
+
+
+def upload_attributes(tb_url, bearer_token, entityId, entityType, scope, attributes, session=None):
     """
     attributes - dictionary {key:value}
     scope = SERVER_SCOPE, CLIENT_SCOPE, SHARED_SCOPE
     """
     url = tb_url + f'/api/plugins/telemetry/{entityType}/{entityId}/attributes/{scope}'
     headers = headers = {'Content-Type': 'application/json', 'X-Authorization': bearer_token}
-    resp = requests.post(url, headers=headers, json=attributes)
+    resp = _http(session).post(url, headers=headers, json=attributes)
     return resp
 
 
-def get_attribute_keys(tb_url, bearerToken, entity_id, entity_type, scope=None):
+def get_attribute_keys(tb_url, bearerToken, entity_id, entity_type, scope=None, session=None):
     url = tb_url + f'/api/plugins/telemetry/{entity_type}/{entity_id}/keys/attributes'
     if scope:
         url = url + f'/{scope}'
     headers = {'Accept': 'application/json', 'X-Authorization': bearerToken}
-    resp = requests.get(url, headers=headers)
+    resp = _http(session).get(url, headers=headers)
     if resp.status_code == 200:
         return resp.json(), resp
     else:
@@ -298,7 +371,7 @@ def get_attribute_keys(tb_url, bearerToken, entity_id, entity_type, scope=None):
 ATTR_SCOPES = {'SERVER_SCOPE', 'CLIENT_SCOPE', 'SHARED_SCOPE'}
 
 
-def get_attribute_values(tb_url, bearerToken, entity_id, entity_type, scope=None, keys=None):
+def get_attribute_values(tb_url, bearerToken, entity_id, entity_type, scope=None, keys=None, session=None):
     if scope:
         url = f'{tb_url}/api/plugins/telemetry/{entity_type}/{entity_id}/values/attributes/{scope}'
     else:
@@ -306,9 +379,9 @@ def get_attribute_values(tb_url, bearerToken, entity_id, entity_type, scope=None
     headers = {'Accept': 'application/json', 'X-Authorization': bearerToken}
     if keys:
         params = {'keys': keys}
-        resp = requests.get(url, headers=headers, params=params)
+        resp = _http(session).get(url, headers=headers, params=params)
     else:
-        resp = requests.get(url, headers=headers)
+        resp = _http(session).get(url, headers=headers)
     if resp.status_code == 200:
         data = resp.json()
     else:
@@ -316,7 +389,7 @@ def get_attribute_values(tb_url, bearerToken, entity_id, entity_type, scope=None
     return data, resp
 
 
-def list_tenant_assets(tb_url, bearerToken, assetType=None, limit=100, textSearch=None):
+def list_tenant_assets(tb_url, bearerToken, assetType=None, limit=100, textSearch=None, session=None):
     url = f'{tb_url}/api/tenant/assets'
     params = {'limit': limit}
     if assetType:
@@ -324,7 +397,7 @@ def list_tenant_assets(tb_url, bearerToken, assetType=None, limit=100, textSearc
     if textSearch:
         params['textSearch'] = textSearch
     headers = {'Accept': 'application/json', 'X-Authorization': bearerToken}
-    resp = requests.get(url, headers=headers, params=params)
+    resp = _http(session).get(url, headers=headers, params=params)
     if resp.status_code == 200:
         return resp.json()['data'], resp
     else:
@@ -332,7 +405,7 @@ def list_tenant_assets(tb_url, bearerToken, assetType=None, limit=100, textSearc
 
 
 def get_tenant_devices(tb_url, bearerToken, deviceType=None, pageSize=500, page=0, textSearch=None,
-                       get_credentials=False):
+                       get_credentials=False, session=None):
     url = f'{tb_url}/api/tenant/devices'
     params = {'pageSize': pageSize, 'page': page}
     if deviceType:
@@ -340,18 +413,19 @@ def get_tenant_devices(tb_url, bearerToken, deviceType=None, pageSize=500, page=
     if textSearch:
         params['textSearch'] = textSearch
     headers = {'Accept': 'application/json', 'X-Authorization': bearerToken}
-    resp = requests.get(url, headers=headers, params=params)
+    resp = _http(session).get(url, headers=headers, params=params)
     if resp.status_code == 200:
         devices = resp.json()['data']
         if get_credentials:
             for d in devices:
-                d['token'] = get_device_credentials(tb_url, bearerToken, d['id']['id'])['credentialsId']
+                d['token'] = get_device_credentials(tb_url, bearerToken, d['id']['id'],
+                                                    session=session)['credentialsId']
         return devices, resp
     else:
         return [], resp
 
 
-def device_query(tb_url, bearerToken, deviceTypes=None, parameters=None, relationType=None):
+def device_query(tb_url, bearerToken, deviceTypes=None, parameters=None, relationType=None, session=None):
     '''
     Description:
    tb_url/swagger-ui.html#!/device-controller/findByQueryUsingPOST_1
@@ -378,15 +452,15 @@ def device_query(tb_url, bearerToken, deviceTypes=None, parameters=None, relatio
     if relationType:
         query['relationType'] = relationType
     headers = {'Accept': 'application/json', 'X-Authorization': bearerToken}
-    resp = requests.post(url, headers=headers, json={'query': query})
+    resp = _http(session).post(url, headers=headers, json={'query': query})
     return resp.json()
 
 
-def get_devices(tb_url, jwtToken, customerId, device_type='', limit=200):
+def get_devices(tb_url, jwtToken, customerId, device_type='', limit=200, session=None):
     params = {'customerId': customerId, 'limit': limit, 'type': device_type}
     url = tb_url + '/api/customer/' + customerId + '/devices'
     headers = {'Accept': 'application/json', 'X-Authorization': jwtToken}
-    resp = requests.get(url, headers=headers, params=params)
+    resp = _http(session).get(url, headers=headers, params=params)
     if resp.status_code == 200:
         return resp.json()['data']
     else:
@@ -394,10 +468,10 @@ def get_devices(tb_url, jwtToken, customerId, device_type='', limit=200):
         return []
 
 
-def get_device_credentials(tb_url, jwtToken, device_id):
+def get_device_credentials(tb_url, jwtToken, device_id, session=None):
     url = tb_url + '/api/device/' + device_id + '/credentials'
     headers = {'Accept': 'application/json', 'X-Authorization': jwtToken}
-    resp = requests.get(url, headers=headers)
+    resp = _http(session).get(url, headers=headers)
     if resp.status_code == 200:
         return resp.json()
     else:
@@ -406,7 +480,8 @@ def get_device_credentials(tb_url, jwtToken, device_id):
 
 
 def create_device(tb_url, bearerToken, name,
-                  tenantId, customerId, deviceType, info="", createdTime=toJsTimestamp(dt.datetime.now().timestamp())):
+                  tenantId, customerId, deviceType, info="", createdTime=toJsTimestamp(dt.datetime.now().timestamp()),
+                  session=None):
     ''' Example of json for NEW device:
       {
       "additionalInfo": "Info",
@@ -439,7 +514,7 @@ def create_device(tb_url, bearerToken, name,
         },
         "type": deviceType
     }
-    resp = requests.post(url, headers=headers, json=asset_json)
+    resp = _http(session).post(url, headers=headers, json=asset_json)
     if resp.status_code == 200:
         return resp.json(), resp
     else:
@@ -447,29 +522,34 @@ def create_device(tb_url, bearerToken, name,
     pass
 
 
-def post_device(tb_url, bearerToken, device_json, create_new=False):
+def post_device(tb_url, bearerToken, device_json, create_new=False, session=None):
+    """
+    Saves the device. With create_new a new device is created from device_json, e.g. of a backup,
+    by the same request.
+    """
     url = tb_url + '/api/device'
     headers = {'Content-Type': 'application/json', 'X-Authorization': bearerToken}
     if create_new:
-        created_json = create_device(tb_url, bearerToken,
-                                     device_json['name'],
-                                     device_json['tenantId']['id'],
-                                     device_json['customerId']['id'],
-                                     device_json['type'],
-                                     device_json['additionalInfo'])
-        device_json['id'] = created_json['id']
-    resp = requests.post(url, headers=headers, json=device_json)
+        device_json = new_entity_json(device_json)
+    resp = _http(session).post(url, headers=headers, json=device_json)
     if resp.status_code == 200:
         return resp.json(), resp
     else:
         return [], resp
 
 
-def get_tenants(tb_url, bearerToken):
+def new_entity_json(entity_json):
+    """
+    Copy of the entity without SERVER_FIELDS, so Thingsboard creates a new entity from it
+    """
+    return {key: value for key, value in entity_json.items() if key not in SERVER_FIELDS}
+
+
+def get_tenants(tb_url, bearerToken, session=None):
     url = f"{tb_url}/api/tenants"
     headers = {'Content-Type': 'application/json', 'X-Authorization': bearerToken}
     params = {'limit': 100}
-    resp = requests.get(url, headers=headers, params=params)
+    resp = _http(session).get(url, headers=headers, params=params)
     if resp.status_code == 200:
         return resp.json()['data']
     else:
@@ -477,11 +557,11 @@ def get_tenants(tb_url, bearerToken):
         return []
 
 
-def get_customers(tb_url, bearerToken):
+def get_customers(tb_url, bearerToken, session=None):
     url = f"{tb_url}/api/customers"
     headers = {'Content-Type': 'application/json', 'X-Authorization': bearerToken}
     params = {'limit': 100}
-    resp = requests.get(url, headers=headers, params=params)
+    resp = _http(session).get(url, headers=headers, params=params)
     if resp.status_code == 200:
         return resp.json()['data']
     else:
@@ -489,13 +569,22 @@ def get_customers(tb_url, bearerToken):
         return [], resp
 
 
-def get_relations(tb_url, bearerToken, fromId, fromType, relationType=None):
+def post_customer(tb_url, bearerToken, customer_json, create_new=False, session=None):
+    """
+    Saves the customer. With create_new a new customer is created from customer_json, e.g. of a backup.
+    """
+    if create_new:
+        customer_json = new_entity_json(customer_json)
+    return _post_entity(tb_url + '/api/customer', _x_auth_headers(bearerToken), customer_json, session=session)
+
+
+def get_relations(tb_url, bearerToken, fromId, fromType, relationType=None, session=None):
     url = f"{tb_url}/api/relations"
     headers = {'Content-Type': 'application/json', 'X-Authorization': bearerToken}
     params = {'fromId': fromId, 'fromType': fromType}
     if relationType:
         params['relationType'] = relationType
-    resp = requests.get(url, headers=headers, params=params)
+    resp = _http(session).get(url, headers=headers, params=params)
     if resp.status_code == 200:
         return resp.json(), resp
     else:
@@ -504,7 +593,7 @@ def get_relations(tb_url, bearerToken, fromId, fromType, relationType=None):
 
 
 def create_relation(tb_url, bearer_token, from_type, from_id, to_type, to_id,
-                    relation_type="CONTAINS", type_group="COMMON", info=""):
+                    relation_type="CONTAINS", type_group="COMMON", info="", session=None):
     """
     from_entity, to_entity are dictionaries like {"entityType":"DEVICE","id":"abcd1234"}
     {
@@ -529,14 +618,14 @@ def create_relation(tb_url, bearer_token, from_type, from_id, to_type, to_id,
         "type": relation_type,
         "typeGroup": type_group
     }
-    return requests.post(url, headers=_x_auth_headers(bearer_token), json=content)
+    return _http(session).post(url, headers=_x_auth_headers(bearer_token), json=content)
 
 
-def list_tenant_dashboards(tb_url, bearerToken, limit=100):
+def list_tenant_dashboards(tb_url, bearerToken, limit=100, session=None):
     url = f"{tb_url}/api/tenant/dashboards"
     headers = {'Content-Type': 'application/json', 'X-Authorization': bearerToken}
     params = {'limit': limit}
-    resp = requests.get(url, headers=headers, params=params)
+    resp = _http(session).get(url, headers=headers, params=params)
     if resp.status_code == 200:
         return resp.json()['data'], resp
     else:
@@ -544,10 +633,10 @@ def list_tenant_dashboards(tb_url, bearerToken, limit=100):
         return [], resp
 
 
-def get_dashboard(tb_url, bearerToken, dashboard_id):
+def get_dashboard(tb_url, bearerToken, dashboard_id, session=None):
     url = f"{tb_url}/api/dashboard/{dashboard_id}"
     headers = _x_auth_headers(bearerToken)
-    resp = requests.get(url, headers=headers)
+    resp = _http(session).get(url, headers=headers)
     if resp.status_code == 200:
         return resp.json(), resp
     else:
@@ -555,26 +644,106 @@ def get_dashboard(tb_url, bearerToken, dashboard_id):
         return [], resp
 
 
-def list_tenant_rulechains(tb_url, bearerToken, limit=100):
+def list_tenant_rulechains(tb_url, bearerToken, limit=100, session=None):
     url = f"{tb_url}/api/ruleChains"
     headers = _x_auth_headers(bearerToken)
     params = {'limit': limit}
-    return _get_list(url, headers, params)
+    return _get_list(url, headers, params, session=session)
 
 
-def get_rulechain(tb_url, bearerToken, chain_id):
+def get_rulechain(tb_url, bearerToken, chain_id, session=None):
     # url = f"{tb_url}/api/rulechain/{chain_id}"
     url = f"{tb_url}/api/rulechain/"
     headers = _x_auth_headers(bearerToken)
     params = {'ruleChainId': chain_id}
-    return _get_entity(url, headers, params)
+    return _get_entity(url, headers, params, session=session)
+
+
+''' Paginators
+The functions iterate over the entities of all pages of a list, the pages are requested as the entities are consumed.
+With prefetch=True, the next page is requested in a background thread while the current page is consumed.
+The pages are sorted by createdTime, so the entities created during the iteration do not shift the pages.
+RequestError is raised if a page is not loaded.
+'''
+
+
+def iter_pages(url, headers, params=None, page_size=PAGE_SIZE, prefetch=False, session=None):
+    """Entities of all pages of the list at url, the pages are followed while hasNext is true"""
+    params = dict(params or {}, pageSize=page_size, sortProperty='createdTime', sortOrder='ASC')
+
+    def get_page(page):
+        resp = _http(session).get(url, headers=headers, params=dict(params, page=page))
+        if resp.status_code != 200:
+            raise RequestError(resp)
+        return resp.json()
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        page = 0
+        data = get_page(page)
+        while True:
+            next_data = None
+            if data['hasNext'] and executor:
+                next_data = executor.submit(get_page, page + 1)
+            yield from data['data']
+            if not data['hasNext']:
+                return
+            page += 1
+            data = next_data.result() if next_data else get_page(page)
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
+
+
+def iter_tenant_devices(tb_url, bearerToken, deviceType=None, textSearch=None, page_size=PAGE_SIZE, prefetch=False,
+                        session=None):
+    params = {'type': deviceType, 'textSearch': textSearch}
+    return iter_pages(f'{tb_url}/api/tenant/devices', _x_auth_headers(bearerToken), params, page_size, prefetch,
+                      session)
+
+
+def iter_customer_devices(tb_url, bearerToken, customerId, deviceType=None, textSearch=None, page_size=PAGE_SIZE,
+                          prefetch=False, session=None):
+    params = {'type': deviceType, 'textSearch': textSearch}
+    return iter_pages(f'{tb_url}/api/customer/{customerId}/devices', _x_auth_headers(bearerToken), params, page_size,
+                      prefetch, session)
+
+
+def iter_tenant_assets(tb_url, bearerToken, assetType=None, textSearch=None, page_size=PAGE_SIZE, prefetch=False,
+                       session=None):
+    params = {'type': assetType, 'textSearch': textSearch}
+    return iter_pages(f'{tb_url}/api/tenant/assets', _x_auth_headers(bearerToken), params, page_size, prefetch,
+                      session)
+
+
+def iter_tenant_dashboards(tb_url, bearerToken, textSearch=None, page_size=PAGE_SIZE, prefetch=False, session=None):
+    params = {'textSearch': textSearch}
+    return iter_pages(f'{tb_url}/api/tenant/dashboards', _x_auth_headers(bearerToken), params, page_size, prefetch,
+                      session)
+
+
+def iter_tenant_rulechains(tb_url, bearerToken, textSearch=None, page_size=PAGE_SIZE, prefetch=False, session=None):
+    params = {'textSearch': textSearch}
+    return iter_pages(f'{tb_url}/api/ruleChains', _x_auth_headers(bearerToken), params, page_size, prefetch,
+                      session)
+
+
+def iter_customers(tb_url, bearerToken, textSearch=None, page_size=PAGE_SIZE, prefetch=False, session=None):
+    params = {'textSearch': textSearch}
+    return iter_pages(f'{tb_url}/api/customers', _x_auth_headers(bearerToken), params, page_size, prefetch, session)
+
+
+def iter_tenants(tb_url, bearerToken, textSearch=None, page_size=PAGE_SIZE, prefetch=False, session=None):
+    """Admin user is required"""
+    params = {'textSearch': textSearch}
+    return iter_pages(f'{tb_url}/api/tenants', _x_auth_headers(bearerToken), params, page_size, prefetch, session)
 
 
 ''' Hidden functions'''
 
 
-def _get_list(url, headers, params):
-    resp = requests.get(url, headers=headers, params=params)
+def _get_list(url, headers, params, session=None):
+    resp = _http(session).get(url, headers=headers, params=params)
     if resp.status_code == 200:
         return resp.json()['data'], resp
     else:
@@ -582,8 +751,8 @@ def _get_list(url, headers, params):
         return [], resp
 
 
-def _get_entity(url, headers, params=None):
-    resp = requests.get(url, headers=headers, params=params)
+def _get_entity(url, headers, params=None, session=None):
+    resp = _http(session).get(url, headers=headers, params=params)
     if resp.status_code == 200:
         return resp.json(), resp
     else:
@@ -591,13 +760,18 @@ def _get_entity(url, headers, params=None):
         return [], resp
 
 
-def _post_entity(url, headers, content):
-    resp = requests.post(url, headers=headers, json=content)
+def _post_entity(url, headers, content, session=None):
+    resp = _http(session).post(url, headers=headers, json=content)
     if resp.status_code == 200:
         return resp.json(), resp
     else:
         return [], resp
 
 
+def _http(session):
+    """requests.Session if it is given, otherwise the requests module which opens a new connection per request"""
+    return session if session is not None else requests
+
+
 def _x_auth_headers(token):
     return {'Content-Type': 'application/json', 'X-Authorization': token}
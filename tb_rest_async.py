@@ -0,0 +1,231 @@
+"""
+Asyncio client for Thingsboard REST API.
+The methods of AsyncTbConnection mirror the functions of tb_rest,
+but the url, the token and the session are taken from the connection.
+The number of simultaneous requests is limited by max_concurrency.
+
+Usage:
+    async with AsyncTbConnection(tb_url, tb_user, tb_password, max_concurrency=100) as con:
+        devices, resp = await con.get_tenant_devices('Mercury')
+        responses = await asyncio.gather(*[con.get_timeseries(d['id']['id'], keys, start_ts, end_ts)
+                                           for d in devices])
+
+Requires aiohttp.
+"""
+import asyncio
+import datetime as dt
+import json
+
+import aiohttp
+
+import tb_rest as tb
+
+MAX_CONCURRENCY = 50
+HTTP_UNAUTHORIZED = 401
+
+
+class Response:
+    """
+    The status and the body of the completed request.
+    It has the same attributes as requests.Response used by tb_rest callers,
+    so tb.request_success(resp) and resp.json() work for both.
+    """
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+    def __repr__(self):
+        return f"<Response [{self.status_code}]>"
+
+
+class AsyncTbConnection:
+    TOKEN_EXPIRE_SEC = tb.TbConnection.TOKEN_EXPIRE_SEC
+
+    def __init__(self, tb_url, tb_user, tb_password, max_concurrency=MAX_CONCURRENCY):
+        self.url = tb_url
+        self.user = tb_user
+        self.password = tb_password
+        self.max_concurrency = max_concurrency
+        self.token = ''
+        self.refresh_token = ''
+        self.token_time = None
+        self.session = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._token_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb_):
+        await self.close()
+
+    async def connect(self):
+        print(f"Authorization at {self.url} as {self.user}")
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        self.session = aiohttp.ClientSession(connector=connector)
+        resp = await self._login()
+        if not tb.request_success(resp):
+            await self.close()
+            raise tb.ConnectionError(self, resp)
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    def expired(self):
+        return dt.datetime.now() - self.token_time >= self.TOKEN_EXPIRE_SEC
+
+    async def update_token(self, force=False):
+        if not (force or self.expired()):
+            return
+        old_token = self.token
+        async with self._token_lock:
+            # the token could be refreshed by another coroutine while this one was waiting for the lock
+            if self.token != old_token:
+                return
+            if self.expired() or force:
+                print("Refreshing token ...")
+                resp = await self._refresh()
+                if not tb.request_success(resp):
+                    print("Token refresh failed, obtaining a new token ...")
+                    resp = await self._login()
+                    if not tb.request_success(resp):
+                        print("Authorization request failed")
+                        raise tb.ConnectionError(self, resp)
+
+    async def get_token(self):
+        await self.update_token()
+        return self.token
+
+    async def get_timeseries(self, deviceId, keys, startTs, endTs, limit=tb.SEC_IN_DAY, interval=None, agg='NONE'):
+        """
+        keys - an iterable like ['temperature', 'humidity']
+        startTs, endTs - JavaScript integer timestamp
+        """
+        params = {'keys': ','.join(keys), 'startTs': startTs, 'endTs': endTs,
+                  'limit': limit, 'interval': interval, 'agg': agg}
+        url = self.url + '/api/plugins/telemetry/DEVICE/' + deviceId + '/values/timeseries'
+        return await self._auth_request('GET', url, params=params)
+
+    async def delete_telemetry(self, entityId, keys, start_time, end_time, entityType="DEVICE",
+                               deleteAllData=False, rewriteLatest=False):
+        start_ts = tb.toJsTimestamp(start_time.timestamp())
+        end_ts = tb.toJsTimestamp(end_time.timestamp())
+        params = {'keys': ','.join(keys), 'startTs': start_ts, 'endTs': end_ts,
+                  'deleteAllDataForKeys': deleteAllData, 'rewriteLatestIfDeleted': rewriteLatest}
+        url = self.url + f'/api/plugins/telemetry/{entityType}/{entityId}/timeseries/delete'
+        return await self._auth_request('DELETE', url, params=params)
+
+    async def upload_telemetry(self, deviceToken, json_data):
+        url = self.url + '/api/v1/' + deviceToken + '/telemetry'
+        headers = {'Content-Type': 'application/json'}
+        return await self._request('POST', url, headers, json_data=json_data)
+
+    async def get_tenant_devices(self, deviceType=None, pageSize=500, page=0, textSearch=None,
+                                 get_credentials=False):
+        url = f'{self.url}/api/tenant/devices'
+        params = {'pageSize': pageSize, 'page': page}
+        if deviceType:
+            params['type'] = deviceType
+        if textSearch:
+            params['textSearch'] = textSearch
+        resp = await self._auth_request('GET', url, params=params)
+        if resp.status_code == 200:
+            devices = resp.json()['data']
+            if get_credentials:
+                credentials = await asyncio.gather(*[self.get_device_credentials(d['id']['id']) for d in devices])
+                for d, c in zip(devices, credentials):
+                    d['token'] = c['credentialsId']
+            return devices, resp
+        else:
+            return [], resp
+
+    async def get_device_credentials(self, device_id):
+        url = self.url + '/api/device/' + device_id + '/credentials'
+        resp = await self._auth_request('GET', url)
+        if resp.status_code == 200:
+            return resp.json()
+        else:
+            print('Error: ' + str(resp.status_code))
+            return []
+
+    async def get_relations(self, fromId, fromType, relationType=None):
+        url = f"{self.url}/api/relations"
+        params = {'fromId': fromId, 'fromType': fromType}
+        if relationType:
+            params['relationType'] = relationType
+        resp = await self._auth_request('GET', url, params=params)
+        if resp.status_code == 200:
+            return resp.json(), resp
+        else:
+            print('Error: ' + str(resp.status_code))
+            return [], resp
+
+    async def get_attribute_values(self, entity_id, entity_type, scope=None, keys=None):
+        if scope:
+            url = f'{self.url}/api/plugins/telemetry/{entity_type}/{entity_id}/values/attributes/{scope}'
+        else:
+            url = f'{self.url}/api/plugins/telemetry/{entity_type}/{entity_id}/values/attributes'
+        params = {'keys': keys if isinstance(keys, str) else ','.join(keys)} if keys else None
+        resp = await self._auth_request('GET', url, params=params)
+        if resp.status_code == 200:
+            data = resp.json()
+        else:
+            data = []
+        return data, resp
+
+    async def _login(self):
+        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+        login_json = {'username': self.user, 'password': self.password}
+        resp = await self._request('POST', tb.get_auth_url(self.url), headers, json_data=login_json)
+        if tb.request_success(resp):
+            self._set_token(resp)
+        else:
+            print(f"ERROR {resp.status_code}: {resp.text}")
+        return resp
+
+    async def _refresh(self):
+        headers = {'Content-Type': 'application/json', 'X-Authorization': self.token}
+        url = self.url + '/api/auth/token'
+        resp = await self._request('POST', url, headers, json_data={'refreshToken': self.refresh_token})
+        if tb.request_success(resp):
+            self._set_token(resp)
+        return resp
+
+    def _set_token(self, resp):
+        self.token = 'Bearer: ' + resp.json()['token']
+        self.refresh_token = resp.json()['refreshToken']
+        self.token_time = dt.datetime.now()
+
+    async def _auth_request(self, method, url, params=None, json_data=None):
+        """Request with the bearer token. If the server rejects the token, it is refreshed and the request repeated."""
+        token = await self.get_token()
+        resp = await self._request(method, url, _auth_headers(token), params, json_data)
+        if resp.status_code == HTTP_UNAUTHORIZED:
+            if self.token == token:
+                await self.update_token(force=True)
+            resp = await self._request(method, url, _auth_headers(self.token), params, json_data)
+        return resp
+
+    async def _request(self, method, url, headers, params=None, json_data=None):
+        async with self._semaphore:
+            async with self.session.request(method, url, headers=headers, params=_query_params(params),
+                                            json=json_data) as resp:
+                return Response(resp.status, await resp.text())
+
+
+def _auth_headers(token):
+    return {'Accept': 'application/json', 'Content-Type': 'application/json', 'X-Authorization': token}
+
+
+def _query_params(params):
+    """aiohttp accepts only strings and numbers, and does not skip None like requests does"""
+    if params is None:
+        return None
+    return {k: str(v) for k, v in params.items() if v is not None}
@@ -0,0 +1,101 @@
+import os
+from os import path
+
+import pytest
+
+import compression
+import convert
+
+OLD_DUMPS = path.join(path.dirname(__file__), 'old')
+
+
+def convert_old(output_folder, **options):
+    os.makedirs(output_folder)
+    devices = convert.load_devices(path.join(OLD_DUMPS, 'device.csv'), str(output_folder))
+    convert.convert_folder(OLD_DUMPS, str(output_folder), convert.converter['old'], devices, header=convert.HEADER,
+                           **options)
+    return device_files(output_folder)
+
+
+def device_files(folder):
+    """{file name without the compression extension: content} of the device files"""
+    files = {}
+    for entry in os.scandir(folder):
+        name = compression.split_extension(entry.name)[0]
+        if name.endswith('.csv') and name != 'devices.csv':
+            with compression.open_file(entry.path) as f:
+                files[name] = f.read().decode('utf-8')
+    return files
+
+
+@pytest.fixture
+def expected(tmp_path):
+    return convert_old(tmp_path / 'petl')
+
+
+def test_dumps_are_converted(expected):
+    assert len(expected) > 1
+    for content in expected.values():
+        header, *rows = content.splitlines()
+        assert header.startswith('ts;')
+        assert rows
+
+
+@pytest.mark.parametrize('options', [{'engine': 'numpy'},
+                                     {'memory_mb': 1},
+                                     {'jobs': 2},
+                                     {'jobs': 2, 'engine': 'numpy'},
+                                     {'compress': 'gzip'},
+                                     {'memory_mb': 1, 'compress': 'gzip'}],
+                         ids=['numpy', 'stream', 'jobs', 'jobs-numpy', 'compress', 'stream-compress'])
+def test_same_output(tmp_path, expected, options):
+    if options.get('engine') == 'numpy':
+        pytest.importorskip('numpy')
+    assert convert_old(tmp_path / 'out', **options) == expected
+
+
+def test_merge_table():
+    old = [('ts', 'A'), (1, 'a1'), (3, 'a3'), (5, 'a5')]
+    new = [('B', 'ts'), ('b2', 2), ('b3', 3), ('b6', 6)]
+    merged = convert.MergeTable([old, new], ['ts', 'A', 'B'])
+    assert list(merged) == [('ts', 'A', 'B'), (1, 'a1', None), (2, None, 'b2'), (3, 'a3', None), (3, None, 'b3'),
+                            (5, 'a5', None), (6, None, 'b6')]
+
+
+def test_new_fields_are_merged(tmp_path):
+    device_file = str(tmp_path / 'A.csv')
+    manifest = convert.Manifest(str(tmp_path))
+    convert.load_file([('ts', 'A'), (1, 'a1'), (3, 'a3')], device_file, manifest)
+    convert.load_file([('ts', 'B'), (2, 'b2')], device_file, manifest)
+    convert.load_file([('ts', 'A'), (4, 'a4')], device_file, manifest)
+    with open(device_file) as f:
+        assert f.read().splitlines() == ['ts;A;B', '1;a1;', '2;;b2', '3;a3;', '4;a4;']
+    entry = manifest.entries['A.csv']
+    assert {k: entry[k] for k in ('header', 'max_ts', 'sorted')} == {'header': ['ts', 'A', 'B'], 'max_ts': 4,
+                                                                     'sorted': True}
+    assert entry['size'] == os.path.getsize(device_file)
+
+
+def test_changed_file_is_scanned_again(tmp_path):
+    device_file = str(tmp_path / 'A.csv')
+    manifest = convert.Manifest(str(tmp_path))
+    convert.load_file([('ts', 'A'), (1, 'a1'), (3, 'a3')], device_file, manifest)
+    manifest.save()
+    # the file is changed outside of the converter, e.g. an older version is copied back
+    with open(device_file, 'w') as f:
+        f.write('ts;B\n5;b5\n2;b2\n')
+    manifest = convert.Manifest(str(tmp_path))
+    assert manifest.get(device_file) == {'header': ['ts', 'B'], 'max_ts': 5, 'sorted': False,
+                                         'size': os.path.getsize(device_file),
+                                         'mtime': os.stat(device_file).st_mtime_ns}
+    convert.load_file([('ts', 'A'), (4, 'a4')], device_file, manifest)
+    with open(device_file) as f:
+        assert f.read().splitlines() == ['ts;A;B', '2;;b2', '4;a4;', '5;;b5']
+
+
+def test_manifest_is_saved_if_a_device_fails(tmp_path):
+    devices = {'1': {'name': 'A'}, '2': {'name': 'B'}}
+    tables = {'1': [('ts', 'A'), (1, 'a1')], '2': [('ts', 'B'), ('x', 'b1')]}
+    with pytest.raises(ValueError):
+        convert.load(tables, str(tmp_path), devices)
+    assert list(convert.Manifest(str(tmp_path)).entries) == ['A.csv']
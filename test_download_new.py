@@ -0,0 +1,256 @@
+import asyncio
+import datetime
+import os
+import random
+from urllib.parse import urlparse
+
+import pytest
+
+import download_new as dn
+
+START = datetime.datetime(2021, 3, 1)
+START_TS = int(START.timestamp()) * 1000
+
+
+class FakeResponse:
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeTelemetry:
+    """Serves the timeseries of the keys like Thingsboard: the points of [startTs, endTs),
+    the latest limit points if there are more"""
+
+    def __init__(self, points):
+        self.points = points  # key -> sorted ts
+        self.requests = []
+
+    def get(self, url, headers=None, params=None):
+        assert urlparse(url).path.endswith('/values/timeseries')
+        start, end, limit = params['startTs'], params['endTs'], params['limit']
+        self.requests.append((start, end))
+        data = {}
+        for key in params['keys'].split(','):
+            values = [{'ts': ts, 'value': str(ts)} for ts in reversed(self.points.get(key, [])) if start <= ts < end]
+            if values:
+                data[key] = values[:limit]
+        return FakeResponse(200, data)
+
+
+class FakeConnection:
+    url = 'http://tb'
+
+    def __init__(self, session):
+        self.session = session
+
+    def get_token(self):
+        return 'token'
+
+
+def saved_ts(file):
+    with open(file) as f:
+        return [int(line.split(dn.DELIMETER)[0]) for line in f.read().splitlines()[1:]]
+
+
+def test_next_segment():
+    hour = datetime.timedelta(hours=1)
+    # unknown density: the segment grows by MAX_GROWTH
+    assert dn.next_segment(hour, None) == hour * dn.MAX_GROWTH
+    # the segment is expected to hold TARGET_FILL of the limit
+    assert dn.next_segment(hour, 1.0, limit=1000) == datetime.timedelta(seconds=1000 * dn.TARGET_FILL)
+    # a sparse key grows at most MAX_GROWTH times at once
+    assert dn.next_segment(hour, 1e-6, limit=1000) == hour * dn.MAX_GROWTH
+    assert dn.next_segment(dn.MAX_SEGMENT, 1e-9) == dn.MAX_SEGMENT
+    assert dn.next_segment(hour, 1e6, limit=10) == dn.MIN_SEGMENT
+
+
+def test_densities_are_kept_between_runs(tmp_path):
+    file = str(tmp_path / dn.DENSITY_FILE)
+    densities = dn.Densities(file)
+    assert densities.get('A', 'T') is None
+    densities.update('A', 'T', 0.5)
+    densities.update('A', 'H', 2.0)
+    densities.save()
+    loaded = dn.Densities(file)
+    assert (loaded.get('A', 'T'), loaded.get('A', 'H'), loaded.get('B', 'T')) == (0.5, 2.0, None)
+
+
+def load(tmp_path, points, end, limit, densities=None, time_delta=datetime.timedelta(hours=1)):
+    session = FakeTelemetry(points)
+    key_files = {key: dn.KeyFile(str(tmp_path / f'{key}.csv'), START, 'w') for key in points}
+    densities = densities or dn.Densities(str(tmp_path / dn.DENSITY_FILE))
+    assert dn.load_adaptive(FakeConnection(session), 'A', 'id', key_files, START + end, time_delta, densities,
+                            limit=limit)
+    return session.requests, densities
+
+
+def test_truncated_segment_is_halved(tmp_path):
+    # sparse points every 10 minutes around a burst of a point per second
+    burst = range(START_TS + 3600_000, START_TS + 3700_000, 1000)
+    points = sorted(set(range(START_TS, START_TS + 6 * 3600_000, 600_000)) | set(burst))
+    end = datetime.timedelta(hours=6)
+    requests, densities = load(tmp_path, {'T': points}, end, limit=30)
+    assert saved_ts(tmp_path / 'T.csv') == points
+    # the segments follow each other without gaps and overlaps
+    written = [r for i, r in enumerate(requests) if i + 1 == len(requests) or requests[i + 1][0] != r[0]]
+    assert all(a[1] == b[0] for a, b in zip(written, written[1:]))
+    assert written[0][0] == START_TS and written[-1][1] == START_TS + 6 * 3600_000
+    # the segment of the burst is halved until it holds less than the limit
+    halved = [(r, n) for r, n in zip(requests, requests[1:]) if r[0] == n[0]]
+    assert halved and all(n[1] - n[0] == (r[1] - r[0]) // 2 for r, n in halved)
+    assert densities.get('A', 'T') is not None
+
+
+def test_sparse_segments_grow(tmp_path):
+    points = list(range(START_TS, START_TS + 40 * 86400_000, 3600_000))
+    end = datetime.timedelta(days=40)
+    requests, densities = load(tmp_path, {'T': points, 'H': points[::2]}, end, limit=1000)
+    assert saved_ts(tmp_path / 'T.csv') == points
+    assert saved_ts(tmp_path / 'H.csv') == points[::2]
+    lengths = [e - s for s, e in requests]
+    assert lengths[:3] == [3600_000, 3600_000 * dn.MAX_GROWTH, 3600_000 * dn.MAX_GROWTH ** 2]
+    assert densities.get('A', 'T') == pytest.approx(1 / 3600, rel=0.1)
+
+
+def test_known_density_gives_the_first_segment(tmp_path):
+    densities = dn.Densities(str(tmp_path / dn.DENSITY_FILE))
+    densities.update('A', 'T', 0.01)
+    points = list(range(START_TS, START_TS + 86400_000, 100_000))
+    requests, _ = load(tmp_path, {'T': points}, datetime.timedelta(days=1), limit=100, densities=densities)
+    first = requests[0][1] - requests[0][0]
+    assert first == dn.TARGET_FILL * 100 / 0.01 * 1000
+    assert saved_ts(tmp_path / 'T.csv') == points
+
+
+@pytest.mark.parametrize('content, line', [(b'', ''),
+                                           (b'ts,T\n', 'ts,T'),
+                                           (b'ts,T\n1,a\n2,b', '2,b'),
+                                           (b'ts,T\n1,a\n2,b\n\n', '2,b'),
+                                           (b'ts,T\r\n1,a\r\n2,b\r\n', '2,b')])
+def test_last_line(tmp_path, content, line):
+    file = tmp_path / 'T.csv'
+    file.write_bytes(content)
+    assert dn.last_line(str(file)) == line
+
+
+def test_last_line_longer_than_the_block(tmp_path):
+    file = tmp_path / 'T.csv'
+    long_line = '3,' + 'ж' * dn.TAIL_BLOCK
+    file.write_bytes(('ts,T\n1,a\n' + long_line + '\n').encode('utf-8'))
+    assert dn.last_line(str(file)) == long_line
+    file.write_bytes(long_line.encode('utf-8'))
+    assert dn.last_line(str(file)) == long_line
+    # the line with its end fills the last block, the previous line end is in the block before
+    block_line = '4,' + 'x' * (dn.TAIL_BLOCK - 3)
+    file.write_bytes(('ts,T\n1,a\n' + block_line + '\n').encode('utf-8'))
+    assert dn.last_line(str(file)) == block_line
+
+
+def test_download_is_resumed_from_the_state(tmp_path):
+    data_dir = str(tmp_path)
+    file = str(tmp_path / 'T.csv')
+    points = list(range(START_TS, START_TS + 86400_000, 600_000))
+    session = FakeTelemetry({'T': points[:100]})
+    state = dn.DownloadState(data_dir)
+    key_files = {'T': dn.KeyFile(file, START, 'a')}
+    densities = dn.Densities(str(tmp_path / dn.DENSITY_FILE))
+    end = START + datetime.timedelta(days=1)
+    assert dn.load_adaptive(FakeConnection(session), 'A', 'id', key_files, end, datetime.timedelta(hours=1),
+                            densities, state=state)
+    state.save()
+    assert dn.DownloadState(data_dir).last_ts(file) == points[99]
+
+    # the next run starts after the saved ts without reading the file
+    session.points['T'] = points
+    state = dn.DownloadState(data_dir)
+    start, _ = dn.check_interval(START, end, file, 'a', state)
+    assert dn.tb.toJsTimestamp(start.timestamp()) == points[99] + 100
+    key_files = {'T': dn.KeyFile(file, start, 'a')}
+    assert dn.load_adaptive(FakeConnection(session), 'A', 'id', key_files, end, datetime.timedelta(hours=1),
+                            densities, state=state)
+    assert saved_ts(file) == points
+
+
+def test_state_of_a_changed_file_is_not_used(tmp_path):
+    file = tmp_path / 'T.csv'
+    file.write_text('ts,T\n1000,a\n')
+    state = dn.DownloadState(str(tmp_path))
+    state.update(str(file), 1000)
+    assert state.last_ts(str(file)) == 1000
+    with open(file, 'a') as f:
+        f.write('2000,b\n')
+    assert state.last_ts(str(file)) is None
+    start, _ = dn.check_interval(START, None, str(file), 'a', state)
+    assert dn.tb.toJsTimestamp(start.timestamp()) == max(START_TS, 2100)
+    file.unlink()
+    assert state.last_ts(str(file)) is None
+
+
+class FakeAsyncConnection:
+    """tb_rest_async.AsyncTbConnection serving FakeTelemetry, the responses complete in a shuffled order.
+    The requests of the segments starting at fail_ts fail."""
+    url = 'http://tb'
+
+    def __init__(self, session, max_concurrency=4, fail_ts=None):
+        self.session = session
+        self.max_concurrency = max_concurrency
+        self.fail_ts = fail_ts
+        self.running = 0
+        self.max_running = 0
+
+    async def get_timeseries(self, deviceId, keys, startTs, endTs, limit=dn.tb.SEC_IN_DAY):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(random.random() / 1000)
+        self.running -= 1
+        if startTs == self.fail_ts:
+            return FakeResponse(500, {'message': 'Internal error'})
+        return self.session.get(self.url + f'/api/plugins/telemetry/DEVICE/{deviceId}/values/timeseries',
+                                params={'keys': ','.join(keys), 'startTs': startTs, 'endTs': endTs, 'limit': limit})
+
+
+def download_files(data_dir):
+    files = {}
+    for device in sorted(os.listdir(data_dir)):
+        if os.path.isdir(os.path.join(data_dir, device)):
+            for key in sorted(os.listdir(os.path.join(data_dir, device))):
+                with open(os.path.join(data_dir, device, key)) as f:
+                    files[f'{device}/{key}'] = f.read()
+    return files
+
+
+@pytest.mark.parametrize('batch_keys', [False, True])
+def test_async_download_is_the_parallel_download(tmp_path, batch_keys):
+    random.seed(1)
+    points = {'T': list(range(START_TS, START_TS + 86400_000, 60_000)),
+              'H': list(range(START_TS + 30_000, START_TS + 86400_000, 300_000))}
+    devices = {'A': 'id-a', 'B': 'id-b'}
+    end = START + datetime.timedelta(days=1)
+    args = (devices, START, end, datetime.timedelta(hours=1), ['T', 'H'], 'a')
+    expected, actual = tmp_path / 'parallel', tmp_path / 'async'
+    expected.mkdir()
+    actual.mkdir()
+    assert not dn.load_all_data_parallel(FakeConnection(FakeTelemetry(points)), str(expected), *args, workers=3,
+                                         batch_keys=batch_keys)
+    connection = FakeAsyncConnection(FakeTelemetry(points))
+    assert not asyncio.run(dn.load_all_data_async(connection, str(actual), *args, batch_keys=batch_keys))
+    assert download_files(actual) == download_files(expected)
+    assert saved_ts(actual / 'A' / 'T.csv') == points['T']
+    assert 1 < connection.max_running <= connection.max_concurrency * dn.PENDING_PER_WORKER
+    # the next run continues after the saved state
+    assert not asyncio.run(dn.load_all_data_async(connection, str(actual), *args, batch_keys=batch_keys))
+    assert download_files(actual) == download_files(expected)
+
+
+def test_async_download_stops_the_key_at_the_failed_segment(tmp_path):
+    points = {'T': list(range(START_TS, START_TS + 86400_000, 60_000))}
+    connection = FakeAsyncConnection(FakeTelemetry(points), fail_ts=START_TS + 5 * 3600_000)
+    failed = asyncio.run(dn.load_all_data_async(connection, str(tmp_path), {'A': 'id-a'}, START,
+                                                START + datetime.timedelta(days=1), datetime.timedelta(hours=1),
+                                                ['T'], 'a'))
+    assert failed == {f'{tmp_path}/A/T.csv'}
+    assert saved_ts(tmp_path / 'A' / 'T.csv') == points['T'][:5 * 60]
@@ -0,0 +1,145 @@
+import json
+import os
+
+import pytest
+
+import compression
+import entity_backup as backup
+from conftest import TB_URL
+
+ENTITIES = [{'id': {'entityType': 'DEVICE', 'id': str(i)}, 'name': f'Устройство {i}',
+             'additionalInfo': {'description': 'a,\n]b' if i % 2 else None}} for i in range(5)]
+
+
+@pytest.mark.parametrize('fmt', backup.FORMATS)
+@pytest.mark.parametrize('codec', [None, 'gzip'])
+@pytest.mark.parametrize('count', [0, 1, 5])
+def test_entities_are_read_back(tmp_path, fmt, codec, count):
+    file = backup.mkpath(str(tmp_path), 'DEVICE', fmt, codec)
+    assert backup.save_entities(file, iter(ENTITIES[:count])) == count
+    assert list(backup.read_entities(file)) == ENTITIES[:count]
+    assert os.listdir(tmp_path) == [os.path.basename(file)]
+
+
+def test_json_array_is_valid_json(tmp_path):
+    file = str(tmp_path / 'devices.json')
+    backup.save_entities(file, ENTITIES)
+    with open(file, encoding='utf-8') as f:
+        assert json.load(f) == ENTITIES
+
+
+def test_json_written_whole_is_read(tmp_path):
+    file = str(tmp_path / 'devices.json.gz')
+    with compression.open_file(file, 'wb') as f:
+        f.write(json.dumps(ENTITIES, indent=2).encode('utf-8'))
+    assert list(backup.read_entities(file)) == ENTITIES
+
+
+def test_failed_writer_keeps_the_previous_file(tmp_path):
+    file = str(tmp_path / 'devices.jsonl')
+    backup.save_entities(file, ENTITIES[:2])
+
+    def failing():
+        yield ENTITIES[2]
+        raise RuntimeError("connection lost")
+    with pytest.raises(RuntimeError):
+        backup.save_entities(file, failing())
+    assert list(backup.read_entities(file)) == ENTITIES[:2]
+    assert os.listdir(tmp_path) == ['devices.jsonl']
+
+
+def populate(fake_tb):
+    customer = fake_tb.add('CUSTOMER', 'Customer')
+    assets = [fake_tb.add('ASSET', f'Asset {i}', customerId=customer['id']) for i in range(2)]
+    devices = [fake_tb.add('DEVICE', f'Device {i}') for i in range(3)]
+    for device in devices:
+        fake_tb.relations.append({'from': assets[0]['id'], 'to': device['id'], 'type': 'Contains',
+                                  'typeGroup': 'COMMON'})
+        fake_tb.attributes[device['id']['id']] = {'SERVER_SCOPE': [{'key': 'active', 'value': True,
+                                                                    'lastUpdateTs': 1}]}
+    for entity_type, name in (('DASHBOARD', 'Dashboard'), ('RULECHAIN', 'Root')):
+        entity = fake_tb.add(entity_type, name)
+        fake_tb.details[entity['id']['id']] = {'configuration': {'widgets': 1}}
+    return assets, devices
+
+
+def change(fake_tb, assets, devices):
+    """Adds, modifies and deletes the entities, their relations and attributes"""
+    new_device = fake_tb.add('DEVICE', 'Device 3')
+    fake_tb.relations.append({'from': assets[1]['id'], 'to': new_device['id'], 'type': 'Contains',
+                              'typeGroup': 'COMMON'})
+    fake_tb.update(assets[1], label='moved')
+    fake_tb.remove(devices[0])
+    fake_tb.attributes[devices[1]['id']['id']]['SERVER_SCOPE'][0].update(value=False, lastUpdateTs=2)
+    dashboard = fake_tb.entities['DASHBOARD'][0]
+    fake_tb.update(dashboard)
+    fake_tb.details[dashboard['id']['id']] = {'configuration': {'widgets': 2}}
+    fake_tb.remove(fake_tb.entities['RULECHAIN'][0])
+
+
+def saved_files(folder, fmt='json'):
+    """The saved entities by the entity names in the order of their ids"""
+    manifest = backup.Manifest(folder, fmt)
+    saved = {}
+    for name in backup.TRACKED:
+        file = manifest.entity_path(folder, name)
+        if name in backup.DIRS:
+            entities = []
+            for entity_file in os.listdir(file):
+                with open(os.path.join(file, entity_file), encoding='utf-8') as f:
+                    entities.append(json.load(f))
+        else:
+            entities = list(backup.read_entities(file))
+        saved[name] = sorted(entities, key=lambda e: json.dumps(e, sort_keys=True))
+    return saved
+
+
+@pytest.mark.parametrize('fmt', backup.FORMATS)
+def test_compacted_deltas_are_the_snapshot(fake_tb, tmp_path, fmt):
+    folder, fresh = str(tmp_path / 'backup'), str(tmp_path / 'fresh')
+    assets, devices = populate(fake_tb)
+    backup.save_snapshot(TB_URL, 'token', folder, fmt)
+    change(fake_tb, assets, devices)
+    delta_dir = backup.save_delta(TB_URL, 'token', folder)
+    with open(os.path.join(delta_dir, backup.DELETED_FILE), encoding='utf-8') as f:
+        deleted = json.load(f)
+    assert deleted['DEVICE'] == [devices[0]['id']['id']]
+    assert len(deleted['RULECHAIN']) == 1
+    # the second delta changes the entity of the first one again
+    fake_tb.update(assets[1], label='moved again')
+    backup.save_delta(TB_URL, 'token', folder)
+
+    backup.compact(folder)
+    assert backup.Manifest.load(folder).deltas == []
+    assert not [f for f in os.listdir(folder) if f.startswith(backup.DELTA_PREFIX)]
+    backup.save_snapshot(TB_URL, 'token', fresh, fmt)
+    compacted = saved_files(folder, fmt)
+    assert compacted == saved_files(fresh, fmt)
+    assert [d['name'] for d in compacted['DEVICE']] == ['Device 1', 'Device 2', 'Device 3']
+    assert compacted['RULECHAIN'] == []
+    assert [a.get('label') for a in compacted['ASSET']] == [None, 'moved again']
+    assert {a['SERVER_SCOPE'][0]['value'] for a in compacted['ATTRIBUTE'] if a['SERVER_SCOPE']} == {True, False}
+    assert backup.Manifest.load(folder).entities == backup.Manifest.load(fresh).entities
+
+
+def test_failed_list_keeps_the_backup(fake_tb, tmp_path, capsys):
+    folder = str(tmp_path)
+    assets, devices = populate(fake_tb)
+    backup.save_snapshot(TB_URL, 'token', folder)
+    change(fake_tb, assets, devices)
+    delta_dir = backup.save_delta(TB_URL, 'token', folder)
+    saved, files = saved_files(folder), sorted(os.listdir(folder))
+    manifest = backup.Manifest.load(folder)
+
+    fake_tb.remove(fake_tb.entities['DEVICE'][0])
+    fake_tb.fail.add('/api/tenant/assets')
+    with pytest.raises(backup.tb.RequestError):
+        backup.save_snapshot(TB_URL, 'token', folder)
+    assert "FAILURE: assets were not loaded" in capsys.readouterr().out
+    with pytest.raises(backup.tb.RequestError):
+        backup.save_delta(TB_URL, 'token', folder)
+    assert saved_files(folder) == saved
+    assert sorted(os.listdir(folder)) == files
+    assert os.path.isdir(delta_dir)
+    failed = backup.Manifest.load(folder)
+    assert (failed.snapshot, failed.deltas, failed.entities) == (manifest.snapshot, manifest.deltas, manifest.entities)
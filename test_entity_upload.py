@@ -0,0 +1,84 @@
+import entity_backup as backup
+import entity_upload as upload
+from conftest import TB_URL
+
+NULL_CUSTOMER = {'entityType': 'CUSTOMER', 'id': upload.NULL_ID}
+
+
+def entity(entity_type, entity_id, name, customer_id=None):
+    saved = {'id': {'entityType': entity_type, 'id': entity_id}, 'createdTime': 1, 'version': 3,
+             'tenantId': {'entityType': 'TENANT', 'id': 'old-tenant'}}
+    saved['title' if entity_type == 'CUSTOMER' else 'name'] = name
+    if customer_id:
+        saved['customerId'] = {'entityType': 'CUSTOMER', 'id': customer_id}
+    return saved
+
+
+def relation(from_entity, to_entity):
+    return {'from': from_entity['id'], 'to': to_entity['id'], 'type': 'Contains', 'typeGroup': 'COMMON',
+            'additionalInfo': None}
+
+
+def save_backup(folder):
+    """Backup folder of a customer with an asset and a device, an unassigned asset and device"""
+    customers = [entity('CUSTOMER', 'old-c', 'Customer')]
+    assets = [entity('ASSET', 'old-a1', 'Building', 'old-c'), entity('ASSET', 'old-a2', 'Room', upload.NULL_ID)]
+    devices = [entity('DEVICE', 'old-d1', 'Meter 1', 'old-c'), entity('DEVICE', 'old-d2', 'Meter 2', upload.NULL_ID)]
+    lost = {'id': {'entityType': 'DEVICE', 'id': 'old-lost'}}
+    relations = [relation(assets[0], assets[1]), relation(assets[1], devices[0]), relation(assets[1], lost)]
+    attributes = [{'id': assets[0]['id'], 'SERVER_SCOPE': [{'key': 'floors', 'value': 3, 'lastUpdateTs': 5}],
+                   'SHARED_SCOPE': [], 'CLIENT_SCOPE': []},
+                  {'id': devices[0]['id'], 'SERVER_SCOPE': [], 'SHARED_SCOPE': [{'key': 'period', 'value': 60}],
+                   'CLIENT_SCOPE': [{'key': 'firmware', 'value': '1.2'}]}]
+    for name, entities in (('CUSTOMER', customers), ('ASSET', assets), ('DEVICE', devices),
+                           ('RELATION', relations), ('ATTRIBUTE', attributes)):
+        backup.save_entities(backup.mkpath(folder, name, 'jsonl', 'gzip'), entities)
+
+
+def test_backup_is_restored_with_new_ids(fake_tb, tmp_path):
+    folder = str(tmp_path)
+    save_backup(folder)
+    # the device created by the request whose response is lost is found on the retry, not created twice
+    fake_tb.lose.add('Meter 1')
+    id_map = upload.restore(TB_URL, 'token', folder, workers=2)
+    assert not fake_tb.lose
+
+    new = {name: fake_tb.find(entity_type, name)
+           for entity_type, name in (('CUSTOMER', 'Customer'), ('ASSET', 'Building'), ('ASSET', 'Room'),
+                                     ('DEVICE', 'Meter 1'), ('DEVICE', 'Meter 2'))}
+    assert all(len(found) == 1 for found in new.values())
+    new = {name: found[0] for name, found in new.items()}
+    assert id_map == {'old-c': new['Customer']['id']['id'], 'old-a1': new['Building']['id']['id'],
+                      'old-a2': new['Room']['id']['id'], 'old-d1': new['Meter 1']['id']['id'],
+                      'old-d2': new['Meter 2']['id']['id']}
+    assert new['Building']['customerId'] == new['Meter 1']['customerId'] == new['Customer']['id']
+    assert new['Room']['customerId'] == new['Meter 2']['customerId'] == NULL_CUSTOMER
+    # the server fields of the backup are not sent
+    assert not any('id' in body or 'tenantId' in body
+                   for url, body in fake_tb.posted if url in ('/api/customer', '/api/asset', '/api/device'))
+    assert len([url for url, body in fake_tb.posted if url == '/api/device']) == 2
+
+    assert sorted((r['from']['id'], r['to']['id']) for r in fake_tb.relations) == sorted(
+        [(id_map['old-a1'], id_map['old-a2']), (id_map['old-a2'], id_map['old-d1'])])
+    assert fake_tb.attributes == {
+        id_map['old-a1']: {'SERVER_SCOPE': [{'key': 'floors', 'value': 3, 'lastUpdateTs': 1}]},
+        id_map['old-d1']: {'SHARED_SCOPE': [{'key': 'period', 'value': 60, 'lastUpdateTs': 1}]}}
+
+
+def test_existing_entities_are_not_created_again(fake_tb, tmp_path):
+    folder = str(tmp_path)
+    save_backup(folder)
+    customer = fake_tb.add('CUSTOMER', 'Customer')
+    device = fake_tb.add('DEVICE', 'Meter 2', customerId=NULL_CUSTOMER)
+    id_map = upload.restore(TB_URL, 'token', folder, workers=2)
+    assert id_map['old-c'] == customer['id']['id']
+    assert id_map['old-d2'] == device['id']['id']
+    assert fake_tb.find('ASSET', 'Building')[0]['customerId'] == customer['id']
+    assert [len(fake_tb.entities[name]) for name in ('CUSTOMER', 'ASSET', 'DEVICE')] == [1, 2, 2]
+
+
+def test_devices_are_uploaded_without_customers(fake_tb, tmp_path):
+    file = str(tmp_path / 'devices.json')
+    backup.save_entities(file, [entity('DEVICE', 'old-d1', 'Meter 1', 'old-c'), entity('DEVICE', 'old-d2', 'Meter 2')])
+    assert upload.upload_devices(TB_URL, file, 'token') == 2
+    assert [d['customerId'] for d in fake_tb.entities['DEVICE']] == [NULL_CUSTOMER, NULL_CUSTOMER]
@@ -0,0 +1,70 @@
+import pytest
+
+import tb_mqtt
+
+
+class ReasonCode:
+    is_failure = False
+
+
+class PublishInfo:
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = tb_mqtt.mqtt.MQTT_ERR_SUCCESS
+
+
+class FakeClient:
+    """paho client connected at once, the messages are acknowledged by ack(mid)"""
+
+    def __init__(self, *args):
+        self.mids = 0
+
+    def username_pw_set(self, token):
+        pass
+
+    def max_inflight_messages_set(self, max_inflight):
+        pass
+
+    def connect(self, host, port, keepalive):
+        pass
+
+    def loop_start(self):
+        self.on_connect(self, None, None, ReasonCode(), None)
+
+    def publish(self, topic, payload, qos):
+        self.mids += 1
+        return PublishInfo(self.mids)
+
+    def ack(self, mid):
+        self.on_publish(self, None, mid, ReasonCode(), None)
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    monkeypatch.setattr(tb_mqtt.mqtt, 'Client', FakeClient)
+    monkeypatch.setattr(tb_mqtt, 'INFLIGHT_TIMEOUT_SEC', 0.2)
+    monkeypatch.setattr(tb_mqtt, 'INFLIGHT_POLL_SEC', 0.05)
+    return tb_mqtt.Connection('tb', 1883, 'token', max_inflight=2)
+
+
+def test_message_without_a_place_in_flight_is_failed(connection):
+    results = []
+    for i in range(4):
+        connection.publish('topic', b'{}', lambda success, i=i: results.append((i, success)))
+    # the third message waits for the timeout, the fourth is failed at once
+    assert results == [(2, False), (3, False)]
+    connection.client.ack(1)
+    assert results[2:] == [(0, True)]
+    connection.publish('topic', b'{}', lambda success: results.append((4, success)))
+    connection.client.ack(3)
+    assert results[3:] == [(4, True)]
+
+
+def test_rejected_connection_fails_the_message_at_once(connection):
+    results = []
+    for i in range(2):
+        connection.publish('topic', b'{}', results.append)
+    connection.error = "Not authorized"
+    connection.publish('topic', b'{}', results.append)
+    assert results == [False]
+    assert connection.stalled
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+import tb_rest as tb
+
+
+class FakeResponse:
+    def __init__(self, url, status_code, data=None):
+        self.url = url
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    """Serves the list of count entities by pages, the request of the page fail_page fails"""
+
+    def __init__(self, count, fail_page=None):
+        self.entities = [{'id': {'id': str(i)}, 'name': f'Device {i}'} for i in range(count)]
+        self.fail_page = fail_page
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def get(self, url, headers=None, params=None):
+        with self.lock:
+            self.requests.append(params)
+        page, size = params['page'], params['pageSize']
+        if page == self.fail_page:
+            return FakeResponse(url, 500)
+        data = self.entities[page * size:(page + 1) * size]
+        return FakeResponse(url, 200, {'data': data, 'hasNext': (page + 1) * size < len(self.entities)})
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_all_pages_are_followed(prefetch):
+    session = FakeSession(25)
+    entities = list(tb.iter_tenant_devices('http://tb', 'token', deviceType='meter', page_size=10,
+                                           prefetch=prefetch, session=session))
+    assert entities == session.entities
+    assert [p['page'] for p in session.requests] == [0, 1, 2]
+    assert session.requests[0] == {'type': 'meter', 'textSearch': None, 'pageSize': 10, 'page': 0,
+                                   'sortProperty': 'createdTime', 'sortOrder': 'ASC'}
+
+
+def test_pages_are_requested_as_entities_are_consumed():
+    session = FakeSession(25)
+    entities = tb.iter_customers('http://tb', 'token', page_size=10, session=session)
+    assert session.requests == []
+    assert [next(entities) for _ in range(10)] == session.entities[:10]
+    assert len(session.requests) == 1
+    next(entities)
+    assert len(session.requests) == 2
+
+
+def test_empty_list():
+    session = FakeSession(0)
+    assert list(tb.iter_tenant_assets('http://tb', 'token', session=session)) == []
+    assert len(session.requests) == 1
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_failed_page_raises(prefetch):
+    session = FakeSession(25, fail_page=1)
+    entities = tb.iter_tenant_assets('http://tb', 'token', page_size=10, prefetch=prefetch, session=session)
+    with pytest.raises(tb.RequestError):
+        for _ in entities:
+            pass
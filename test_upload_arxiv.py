@@ -0,0 +1,285 @@
+import json
+import os
+import sys
+
+import pytest
+
+import upload_arxiv
+
+
+class Clock:
+    """time.monotonic and time.sleep of upload_arxiv without waiting"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(upload_arxiv.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(upload_arxiv.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_token_bucket_burst_and_rate(clock):
+    bucket = upload_arxiv.TokenBucket(10)
+    bucket.acquire(10)
+    assert clock.sleeps == []
+    bucket.acquire(5)
+    assert clock.sleeps == [pytest.approx(0.5)]
+    # the debt is paid by the sleep, then one second gives the rate again
+    clock.now += 1
+    bucket.acquire(10)
+    assert len(clock.sleeps) == 1
+    bucket.acquire(1)
+    assert clock.sleeps[1:] == [pytest.approx(0.1)]
+
+
+def test_token_bucket_refill_is_capped(clock):
+    bucket = upload_arxiv.TokenBucket(10, capacity=2)
+    clock.now += 100
+    bucket.acquire(2)
+    assert clock.sleeps == []
+    bucket.acquire(1)
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+
+def test_token_bucket_without_rate(clock):
+    bucket = upload_arxiv.TokenBucket()
+    for _ in range(1000):
+        bucket.acquire(100)
+    assert clock.sleeps == []
+
+
+class FakeUploader:
+    def __init__(self):
+        self.bodies = []
+
+    def submit_body(self, device_token, body, entries=1, done=None):
+        self.bodies.append((device_token, json.loads(body), entries))
+        if done:
+            done(True)
+
+
+def test_batcher_by_size_and_on_close(clock):
+    uploader = FakeUploader()
+    acked = []
+    with upload_arxiv.Batcher(uploader, max_entries=2) as batcher:
+        for ts in range(3):
+            batcher.submit('A', {'ts': ts}, done=lambda success, ts=ts: acked.append(ts))
+        batcher.submit('B', {'ts': 10})
+    assert uploader.bodies == [('A', [{'ts': 0}, {'ts': 1}], 2), ('A', [{'ts': 2}], 1), ('B', [{'ts': 10}], 1)]
+    assert acked == [0, 1, 2]
+
+
+def test_batcher_by_bytes(clock):
+    uploader = FakeUploader()
+    entry = {'ts': 1, 'values': {'A': 'x' * 100}}
+    size = len(json.dumps(entry))
+    with upload_arxiv.Batcher(uploader, max_entries=100, max_bytes=2 * (size + 2)) as batcher:
+        for _ in range(5):
+            batcher.submit('A', entry)
+    assert [entries for _, _, entries in uploader.bodies] == [2, 2, 1]
+
+
+def test_batcher_by_age(clock):
+    uploader = FakeUploader()
+    batcher = upload_arxiv.Batcher(uploader, max_entries=100, max_age=5)
+    batcher.submit('A', {'ts': 1})
+    clock.now += 3
+    batcher.submit('B', {'ts': 2})
+    assert uploader.bodies == []
+    clock.now += 3
+    batcher.submit('B', {'ts': 3})
+    assert uploader.bodies == [('A', [{'ts': 1}], 1)]
+    batcher.close()
+    assert uploader.bodies[1:] == [('B', [{'ts': 2}, {'ts': 3}], 2)]
+
+
+def test_batcher_of_single_entries(clock):
+    uploader = FakeUploader()
+    with upload_arxiv.Batcher(uploader) as batcher:
+        batcher.submit('A', {'ts': 1})
+    assert uploader.bodies == [('A', {'ts': 1}, 1)]
+
+
+def log_entries(count, devices=3):
+    return [{'ts': 1000 * i, 'devEui': f'DEV-{i % devices}', 'values': {'PT': i, 'S': 'ü' * (i % 3)}}
+            for i in range(count)]
+
+
+def write_pack(file, entries, per_line=4):
+    with open(file, 'w', encoding='utf-8') as f:
+        for k in range(0, len(entries), per_line):
+            f.write(json.dumps(entries[k:k + per_line], ensure_ascii=False) + ",\n")
+
+
+def write_expand(file, entries, per_array=4):
+    with open(file, 'w', encoding='utf-8') as f:
+        for k in range(0, len(entries), per_array):
+            lines = [json.dumps(e, ensure_ascii=False) for e in entries[k:k + per_array]]
+            f.write("[\n\t" + ",\n\t".join(lines) + "\n],\n")
+
+
+@pytest.mark.parametrize('write', [write_pack, write_expand])
+@pytest.mark.parametrize('chunk_size', [7, upload_arxiv.CHUNK_SIZE])
+def test_entry_reader(tmp_path, write, chunk_size):
+    file = str(tmp_path / 'a.log')
+    entries = log_entries(50)
+    write(file, entries)
+    read = list(upload_arxiv.EntryReader(file, chunk_size=chunk_size))
+    assert [entry for _, entry in read] == entries
+    with open(file, 'rb') as f:
+        data = f.read()
+    for offset, entry in read:
+        assert upload_arxiv.DECODER.raw_decode(data[offset:].decode('utf-8'))[0] == entry
+
+
+def write_gzip(file):
+    with open(file, 'rb') as f, upload_arxiv.gz.open(file + '.gz', 'wb') as gz_file:
+        gz_file.write(f.read())
+    return file + '.gz'
+
+
+def test_entry_reader_of_gzip(tmp_path):
+    file = str(tmp_path / 'a.log')
+    write_expand(file, log_entries(50))
+    assert list(upload_arxiv.EntryReader(write_gzip(file), chunk_size=16)) == list(upload_arxiv.EntryReader(file))
+
+
+def test_entry_reader_of_ranges(tmp_path):
+    file = str(tmp_path / 'a.log')
+    write_pack(file, log_entries(50))
+    offsets = [offset for offset, _ in upload_arxiv.EntryReader(file)]
+    ranges = [(offsets[5], offsets[10]), (offsets[10], offsets[12]), (offsets[40], None)]
+    read = [offset for offset, _ in upload_arxiv.EntryReader(write_gzip(file), ranges, chunk_size=16)]
+    assert read == offsets[5:12] + offsets[40:]
+
+
+def test_entry_reader_skips_lines_out_of_window(tmp_path):
+    file = str(tmp_path / 'a.log')
+    entries = log_entries(50)
+    write_pack(file, entries)
+    read = [entry for _, entry in upload_arxiv.EntryReader(file, window=(10000, 20000))]
+    # the lines of 4 entries overlapping the window are decoded completely
+    assert read == entries[8:20]
+
+
+def test_log_index(tmp_path):
+    file = str(tmp_path / 'a.log')
+    entries = log_entries(200)
+    write_pack(file, entries)
+    index = upload_arxiv.LogIndex.build(file, block_bytes=1000)
+    assert len(index.blocks) > 3
+    assert index.blocks[0][0] == 0 and index.blocks[-1][1] == upload_arxiv.os.path.getsize(file)
+    window = (50000, 60000)
+    ranges = index.ranges(window)
+    read = [entry for _, entry in upload_arxiv.EntryReader(file, ranges)]
+    assert entries[50:60] == [e for e in read if window[0] <= e['ts'] < window[1]]
+    assert len(read) < len(entries)
+    assert index.ranges((0, 10 ** 9)) == [(0, index.blocks[-1][1])]
+    assert index.ranges((10 ** 9, 10 ** 10)) == []
+
+
+def test_log_index_is_saved_until_the_log_changes(tmp_path):
+    file = str(tmp_path / 'a.log')
+    write_pack(file, log_entries(20))
+    index = upload_arxiv.LogIndex.get(file)
+    assert upload_arxiv.LogIndex.load(file).blocks == index.blocks
+    with open(file, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(log_entries(1)) + ",\n")
+    assert upload_arxiv.LogIndex.load(file) is None
+
+
+def test_log_index_of_entries_in_several_lines(tmp_path):
+    file = str(tmp_path / 'a.log')
+    with open(file, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(log_entries(5), indent=1) + ",\n")
+    index = upload_arxiv.LogIndex.build(file)
+    assert index.blocks == [[0, None, None, None]]
+    assert index.ranges((10 ** 9, 10 ** 10)) == [(0, None)]
+
+
+def test_journal_resumes_from_the_acks_after_the_last_save(tmp_path):
+    file = str(tmp_path / 'journal')
+    log = str(tmp_path / 'a.log')
+    window = ('2021-12-01 00:00:00', '2022-01-01 00:00:00')
+    journal = upload_arxiv.Journal(file, *window, interval=3600)
+    progress = journal.progress(log)
+    for offset in (0, 10, 20):
+        progress.submit('A', offset, offset)
+    progress.acknowledge('A', 0, 0)
+    journal.save()
+    progress.acknowledge('A', 10, 10)
+    # the script is killed: the journal is not saved again
+    journal.stopped.set()
+    journal.ack_log.close()
+
+    resumed = upload_arxiv.Journal(file, *window, resume=True, interval=3600)
+    progress = resumed.progress(log)
+    assert progress.low == 10
+    assert progress.is_posted('A', 10) and not progress.is_posted('A', 20)
+    resumed.close()
+    assert os.listdir(tmp_path) == ['journal']
+
+    fresh = upload_arxiv.Journal(file, *window, interval=3600)
+    assert not fresh.progress(log).is_posted('A', 0)
+    fresh.close()
+
+
+class DeadProcess:
+    exitcode = -9
+
+    def is_alive(self):
+        return False
+
+
+def test_pipeline_raises_if_the_reading_process_died(monkeypatch):
+    monkeypatch.setattr(upload_arxiv, 'PIPELINE_POLL_SEC', 0.01)
+    chunks = upload_arxiv.queue.Queue()
+    chunks.put([(0, 'A', 1, b'{}')])
+    # the chunk put before the process was killed is passed, then the missing end of the file is an error
+    assert upload_arxiv._get(chunks, DeadProcess(), 'a.log') == [(0, 'A', 1, b'{}')]
+    with pytest.raises(RuntimeError, match='a.log exited with code -9'):
+        upload_arxiv._get(chunks, DeadProcess(), 'a.log')
+
+
+class FakeHttpUploader(FakeUploader):
+    def __init__(self, url, workers, limiter):
+        super().__init__()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+@pytest.mark.parametrize('journal', [False, True])
+def test_journal_is_written_only_with_the_option(tmp_path, monkeypatch, journal):
+    logs, work = tmp_path / 'logs', tmp_path / 'work'
+    logs.mkdir()
+    work.mkdir()
+    write_pack(str(logs / '20211230-devices.log'), log_entries(10))
+    monkeypatch.chdir(work)
+    monkeypatch.setattr(upload_arxiv, 'Uploader', FakeHttpUploader)
+    options = ['--journal', str(tmp_path / 'upload.journal')] if journal else []
+    monkeypatch.setattr(sys, 'argv', ['upload_arxiv.py', *options, 'http://tb', str(logs)])
+    upload_arxiv.main(upload_arxiv.get_args())
+    assert os.listdir(work) == []
+    assert sorted(os.listdir(tmp_path)) == ['logs', 'upload.journal', 'work'] if journal else ['logs', 'work']
+
+
+def test_resume_requires_the_journal(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['upload_arxiv.py', '--resume', 'http://tb', 'logs'])
+    with pytest.raises(SystemExit):
+        upload_arxiv.get_args()
@@ -0,0 +1,56 @@
+import pytest
+
+import writers
+
+pa = pytest.importorskip("pyarrow")
+
+
+def test_column_type():
+    assert writers.column_type(['1', '', None, '2']) == pa.int64()
+    assert writers.column_type(['1', '1.5']) == pa.float64()
+    assert writers.column_type(['true', False]) == pa.bool_()
+    assert writers.column_type(['true', '12']) == pa.string()
+    assert writers.column_type(['', None]) == pa.null()
+
+
+def test_csv(tmp_path):
+    file = str(tmp_path / 'A.csv')
+    with writers.open_writer('csv', file, 'w') as w:
+        w.write(['ts', 'A'], [(1, 'x'), (2, None)])
+    with writers.open_writer('csv', file, 'a') as w:
+        w.write(['ts', 'A'], [(3, 1.5)])
+    with open(file) as f:
+        assert f.read() == "ts,A\n1,x\n2,\n3,1.5\n"
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather'])
+def test_mixed_bool_and_numbers(tmp_path, fmt):
+    file = str(tmp_path / ('A.' + fmt))
+    with writers.open_writer(fmt, file, 'w') as w:
+        w.write(['ts', 'k'], [(1, 'true'), (2, '12')])
+    assert writers.read_table(file).to_pylist() == [{'ts': 1, 'k': 'true'}, {'ts': 2, 'k': '12'}]
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather'])
+def test_parts_with_different_schemas(tmp_path, fmt):
+    file = str(tmp_path / ('A.' + fmt))
+    with writers.open_writer(fmt, file, 'w') as w:
+        w.write(['ts', 'A'], [(1, '1'), (2, '2')])
+    with writers.open_writer(fmt, file) as w:
+        w.write(['ts', 'A', 'B'], [(3, '1.5', 'x')])
+    assert len(writers.list_parts(file)) == 2
+    table = writers.read_table(file)
+    assert table.schema.types == [pa.int64(), pa.float64(), pa.string()]
+    assert table.to_pylist() == [{'ts': 1, 'A': 1.0, 'B': None}, {'ts': 2, 'A': 2.0, 'B': None},
+                                 {'ts': 3, 'A': 1.5, 'B': 'x'}]
+    assert writers.last_ts(file) == 3
+
+
+def test_values_fitting_the_part_schema(tmp_path):
+    file = str(tmp_path / 'A.parquet')
+    with writers.open_writer('parquet', file, 'w') as w:
+        w.write(['ts', 'A'], [(1, '1.5')])
+        w.write(['ts', 'A'], [(2, '2')])
+        w.write(['ts', 'A'], [(3, '')])
+    assert len(writers.list_parts(file)) == 1
+    assert writers.read_table(file).column('A').to_pylist() == [1.5, 2.0, None]
@@ -4,6 +4,25 @@ The script uploads telemetry from the collector logs to Thingsboard.
 A log file contains data for the previous day:
 20211229-devices-name.log.gz contains data for 2021-12-28
 
+The messages are posted by --workers threads, each thread keeps its own connection.
+The messages of a device are posted by the same thread in the order of the log.
+The rate is limited by --rate and --byte-rate for all devices and by --device-rate and --device-byte-rate
+for every device. Without --rate, one message is posted every --delay milliseconds.
+With --batch N, the entries of a device are posted as arrays of up to N entries (and --batch-bytes);
+an incomplete batch is posted after --batch-age seconds.
+If the server responds 429 or 5xx, all workers wait before the next request;
+the wait doubles after every such response and halves after every success.
+The log files are parsed entry by entry while they are read, so a file of any size takes little memory.
+The ts ranges of the blocks of a log are saved in the index file <log>.idx when the log is read first time.
+The files and the blocks out of --start and --end are skipped, the lines out of them are not decoded.
+With --mqtt, the telemetry is published by MQTT (see tb_mqtt.py) with the same rates and batches.
+With --jobs N, N processes decompress and parse the current and the next files while the current file is uploaded.
+With --journal, the progress is saved to the journal file every second: the offset of the first entry not posted
+in every file and the last posted entry of every device. Between the saves, every posted entry is appended
+to the ack log <journal>.<N>.acks. After a failure, the upload is continued by --resume with the same --journal
+without sending the posted entries again; only the messages that were in flight at the moment of the failure
+may be posted twice. Without --journal the progress is not saved.
+
 Usage:
 1. Upload all files matching dates
 python upload_arxiv.py --matchdate --start "2021-12-29 18:30:00" --end "2022-01-01 00:00:00" --delay 30
@@ -13,9 +32,14 @@ python upload_arxiv.py --matchdate --start "2021-12-29 18:30:00" --end "2022-01-
 python upload_arxiv.py --matchdate --start "2021-12-29 18:30:00" --end "2021-12-30 00:00:00" --delay 30
        http://my-tb.org log_file
 
+3. Upload with the journal, then continue the upload after a failure
+python upload_arxiv.py --journal upload.journal --matchdate --start "2021-12-29 18:30:00" --end "2022-01-01 00:00:00"
+       --delay 30 http://my-tb.org log_folder
+python upload_arxiv.py --journal upload.journal --resume --matchdate --start "2021-12-29 18:30:00"
+       --end "2022-01-01 00:00:00" --delay 30 http://my-tb.org log_folder
+
 """
 
-from os import error
 import os
 from sys import stderr
 from os import path
@@ -24,61 +48,519 @@ import datetime as dt
 from datetime import datetime
 import time
 import argparse
+import queue
+import threading
+import zlib
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from urllib.parse import urlparse
+import codecs
+import math
+import multiprocessing as mp
+import traceback
+import re
 import requests
 import gzip as gz
 
 DELAY_MS = 1000
+MAX_TRY = 5
+WORKERS = 1
+QUEUE_SIZE = 1000  # messages waiting for every worker
+TIMEOUT_SEC = 30
+BACKOFF_SEC = 0.5
+MAX_BACKOFF_SEC = 60
+RETRY_STATUS = (429, 500, 502, 503, 504)
+BATCH_SIZE = 1
+BATCH_BYTES = 65536
+BATCH_AGE_SEC = 5
+CHUNK_SIZE = 1 << 20
+MAX_ENTRY_SIZE = 1 << 24  # longer entry means the file is broken
+SEPARATORS = re.compile(r'[\s\[\],]*')
+DECODER = json.JSONDecoder()
+TS_FIELD = re.compile(r'"ts"\s*:\s*(\d+)')
+TS_FIELD_BYTES = re.compile(TS_FIELD.pattern.encode())
+LINE_END = ' \t\r\n,]'
+INDEX_SUFFIX = ".idx"
+INDEX_BLOCK_BYTES = 1 << 20
+JOURNAL_SEC = 1
+ACK_LOG_SUFFIX = ".acks"
+JOBS = 1
+PIPELINE_CHUNK = 1000  # entries passed from a reading process at once
+PIPELINE_QUEUE = 16  # chunks read ahead by a process
+PIPELINE_POLL_SEC = 1  # the reading process is checked if no chunk comes for this time
 
 
 def log_error(entry, resp):
     print(f"ERROR at {datetime.now()}. Response code {resp.status_code}: {resp.text}", file=stderr)
 
 
-def upload_telemetry(tb_url, deviceToken, json_data):
-    # http(s)://host:port/api/v1/$ACCESS_TOKEN/telemetry
-    url = tb_url + '/api/v1/' + deviceToken + '/telemetry'
-    headers = {'Content-Type': 'application/json'}
-    resp = requests.post(url, headers=headers, json=json_data)
-    return resp
+class TokenBucket:
+    """Allows rate units per second on average and bursts up to capacity units (one second of the rate by default).
+    rate=None means no limit."""
+
+    def __init__(self, rate=None, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+            # the tokens are taken at once, the caller waits until the debt is paid
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """Messages and bytes per second for all devices and for every device"""
+
+    def __init__(self, msg_rate=None, byte_rate=None, device_msg_rate=None, device_byte_rate=None):
+        self.buckets = [TokenBucket(msg_rate), TokenBucket(byte_rate)]
+        self.device_rates = (device_msg_rate, device_byte_rate)
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, device, size):
+        with self.lock:
+            if device not in self.devices:
+                self.devices[device] = [TokenBucket(rate) for rate in self.device_rates]
+            device_buckets = self.devices[device]
+        for bucket, amount in zip(device_buckets + self.buckets, (1, size, 1, size)):
+            bucket.acquire(amount)
+
+
+class Backoff:
+    """The wait before a request, shared by the workers.
+    It doubles after every response telling that the server is overloaded and halves after every success."""
+
+    def __init__(self, base=BACKOFF_SEC, maximum=MAX_BACKOFF_SEC):
+        self.base = base
+        self.maximum = maximum
+        self.delay = 0
+        self.lock = threading.Lock()
+
+    def failure(self, retry_after=None):
+        with self.lock:
+            self.delay = min(self.maximum, max(self.base, self.delay * 2, retry_after or 0))
+
+    def success(self):
+        with self.lock:
+            self.delay = self.delay / 2 if self.delay > self.base else 0
+
+    def wait(self):
+        delay = self.delay
+        if delay:
+            time.sleep(delay)
+
+
+def retry_after(resp):
+    try:
+        return float(resp.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class Uploader:
+    """Posts telemetry by worker threads, every worker has its own keep-alive session.
+    The messages of a device are posted by the same worker in the order they are submitted.
+    Used as a context manager: on exit it waits until all messages are posted."""
+
+    def __init__(self, tb_url, workers=WORKERS, limiter=None, backoff=None, max_try=MAX_TRY):
+        self.tb_url = tb_url
+        self.limiter = limiter or RateLimiter()
+        self.backoff = backoff or Backoff()
+        self.max_try = max_try
+        self.sent = 0
+        self.failed = 0
+        self.entries = 0
+        self.lock = threading.Lock()
+        self.queues = [queue.Queue(QUEUE_SIZE) for _ in range(workers)]
+        self.threads = [threading.Thread(target=self._work, args=(q,), daemon=True) for q in self.queues]
+        for t in self.threads:
+            t.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, device_token, message_json, done=None):
+        self.submit_body(device_token, json.dumps(message_json).encode('utf-8'), done=done)
+
+    def submit_body(self, device_token, body, entries=1, done=None):
+        """body is the json of the message, entries is the number of telemetry entries in it.
+        done(success) is called by the worker when the message is posted or failed."""
+        self.queues[zlib.crc32(device_token.encode('utf-8')) % len(self.queues)].put((device_token, body, entries,
+                                                                                       done))
+
+    def close(self):
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+        print(f"Posted {self.sent} messages with {self.entries} entries, failed {self.failed}")
+
+    def _work(self, q):
+        with requests.Session() as session:
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                device_token, body, entries, done = item
+                self.limiter.acquire(device_token, len(body))
+                try:
+                    success = self._post(session, device_token, body)
+                except Exception as e:
+                    print(f"ERROR at {datetime.now()}: {e}", file=stderr)
+                    success = False
+                with self.lock:
+                    if success:
+                        self.sent += 1
+                        self.entries += entries
+                    else:
+                        self.failed += 1
+                if done:
+                    done(success)
+
+    def _post(self, session, device_token, body):
+        url = self.tb_url + '/api/v1/' + device_token + '/telemetry'
+        headers = {'Content-Type': 'application/json'}
+        for _ in range(self.max_try):
+            self.backoff.wait()
+            try:
+                resp = session.post(url, headers=headers, data=body, timeout=TIMEOUT_SEC)
+            except requests.RequestException as e:
+                print(f"ERROR at {datetime.now()}: {e}", file=stderr)
+                self.backoff.failure()
+                continue
+            if resp.status_code == 200:
+                self.backoff.success()
+                return True
+            log_error(body, resp)
+            if resp.status_code not in RETRY_STATUS:
+                # the request is wrong, repeating it does not help
+                return False
+            self.backoff.failure(retry_after(resp))
+        return False
+
+
+class Batcher:
+    """Collects the entries of every device to arrays [{"ts": ..., "values": {...}}, ...] posted by the uploader.
+    A batch is posted when it has max_entries entries, when the next entry does not fit to max_bytes
+    or when the batch is older than max_age seconds (checked as new entries come).
+    The batches of a device are posted in the order of the entries.
+    Used as a context manager: on exit the incomplete batches are posted.
+    If max_entries is 1, the entries are passed to the uploader as they are."""
+
+    def __init__(self, uploader, max_entries=BATCH_SIZE, max_bytes=BATCH_BYTES, max_age=BATCH_AGE_SEC):
+        self.uploader = uploader
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # device token -> (creation time, list of entries, size, done callbacks); the oldest batch is the first
+        self.batches = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, device_token, message_json, done=None):
+        self.submit_encoded(device_token, json.dumps(message_json).encode('utf-8'), done)
+
+    def submit_encoded(self, device_token, entry, done=None):
+        """entry is the json of the message"""
+        if self.max_entries <= 1:
+            self.uploader.submit_body(device_token, entry, done=done)
+            return
+        batch = self.batches.get(device_token)
+        # 2 bytes for the brackets or the separator
+        if batch and batch[2] + len(entry) + 2 > self.max_bytes:
+            self.flush(device_token)
+            batch = None
+        if batch is None:
+            batch = (time.monotonic(), [], 0, [])
+        created, entries, size, callbacks = batch
+        entries.append(entry)
+        if done:
+            callbacks.append(done)
+        self.batches[device_token] = (created, entries, size + len(entry) + 2, callbacks)
+        if len(entries) >= self.max_entries:
+            self.flush(device_token)
+        self.flush_expired()
+
+    def flush(self, device_token):
+        created, entries, size, callbacks = self.batches.pop(device_token)
+        self.uploader.submit_body(device_token, b'[' + b', '.join(entries) + b']', len(entries),
+                                  _call_all(callbacks))
+
+    def flush_expired(self):
+        now = time.monotonic()
+        while self.batches:
+            device_token, (created, entries, size, callbacks) = next(iter(self.batches.items()))
+            if now - created < self.max_age:
+                break
+            self.flush(device_token)
+
+    def close(self):
+        for device_token in list(self.batches):
+            self.flush(device_token)
+
+
+def _call_all(callbacks):
+    if not callbacks:
+        return None
+
+    def done(success):
+        for callback in callbacks:
+            callback(success)
+    return done
+
+
+class FileProgress:
+    """Progress of the upload of a log file in the journal.
+    low - offset of the entry the file is read from on resume: the entries before it are posted or skipped
+    devices - {device token: (offset, ts)} of the last posted entry of the device in the file
+    On resume, the entries of a device up to its offset are not posted again.
+    A failed message keeps low, so it is posted on resume unless a later message of the device was posted.
+    log(device token, offset, ts) is called with the lock for every posted entry."""
+
+    def __init__(self, lock, state=None, log=None):
+        state = state or {}
+        self.lock = lock
+        self.log = log
+        self.done = state.get('done', False)
+        self.devices = {d: tuple(v) for d, v in state.get('devices', {}).items()}
+        self.last_read = state.get('low', 0)
+        self.finished = False
+        # offsets of the submitted entries in the order of the file, acknowledged is the set of the posted ones
+        self.pending = deque()
+        self.acknowledged = set()
+
+    @property
+    def low(self):
+        return self.pending[0] if self.pending else self.last_read
+
+    def read(self, offset):
+        self.last_read = offset
+
+    def is_posted(self, device_token, offset):
+        return device_token in self.devices and offset <= self.devices[device_token][0]
+
+    def submit(self, device_token, offset, ts):
+        """Adds the entry to the pending ones and returns the callback for the uploader"""
+        with self.lock:
+            self.pending.append(offset)
+
+        def done(success):
+            if success:
+                self.acknowledge(device_token, offset, ts)
+        return done
+
+    def acknowledge(self, device_token, offset, ts):
+        with self.lock:
+            self.acknowledged.add(offset)
+            self.posted(device_token, offset, ts)
+            while self.pending and self.pending[0] in self.acknowledged:
+                self.acknowledged.remove(self.pending.popleft())
+            if self.log:
+                self.log(device_token, offset, ts)
+
+    def posted(self, device_token, offset, ts):
+        if device_token not in self.devices or self.devices[device_token][0] < offset:
+            self.devices[device_token] = (offset, ts)
+
+    def finish(self):
+        self.finished = True
+
+    def state(self):
+        """The state saved in the journal, called with the lock"""
+        if self.done or (self.finished and not self.pending):
+            return {'low': self.low, 'done': True}
+        return {'low': self.low, 'done': False, 'devices': {d: list(v) for d, v in self.devices.items()}}
+
+
+class Journal:
+    """Checkpoints of the upload: {"start": ..., "end": ..., "files": {path: FileProgress state}, "log": N}.
+    The journal is saved to the file by a background thread every interval seconds if it has changed,
+    the file is replaced atomically, so it is consistent if the script is killed.
+    Every posted entry is appended to the ack log <file>.<N>.acks as [path, device token, offset, ts]
+    and flushed, so it is kept if the script is killed. Every save starts the ack log N + 1 and records N + 1,
+    the older logs are deleted when the journal is saved. On resume, the logs from the recorded one are applied
+    to the saved state, so only the messages in flight at the kill are posted again;
+    Thingsboard keeps one value of a key at a ts, so they do not change the data.
+    Used as a context manager: on exit the final state is saved."""
+
+    def __init__(self, file, starttime, endtime, resume=False, interval=JOURNAL_SEC):
+        self.file = file
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.window = [str(starttime), str(endtime)]
+        self.files = {}
+        logs = self._ack_logs()
+        if resume:
+            data = {}
+            if path.isfile(file):
+                with open(file, encoding='utf-8') as f:
+                    data = json.load(f)
+                if [data.get('start'), data.get('end')] != self.window:
+                    print(f"WARNING: the journal {file} was made for the period from {data.get('start')} "
+                          f"to {data.get('end')}")
+            self.files = {name: self._file_progress(name, state) for name, state in data.get('files', {}).items()}
+            # the logs are replayed without the journal if the script was killed before the first save
+            self._replay([log_file for n, log_file in logs if n >= data.get('log', 0)])
+            if self.files:
+                print(f"Resuming from the journal {file}")
+        else:
+            for _, log_file in logs:
+                os.remove(log_file)
+            logs = []
+        self.generation = max((n for n, _ in logs), default=0) + 1
+        self.ack_log = open(self._ack_log_name(self.generation), 'a', encoding='utf-8')
+        self.saved = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def progress(self, filename):
+        name = path.abspath(filename)
+        with self.lock:
+            if name not in self.files:
+                self.files[name] = self._file_progress(name)
+            return self.files[name]
+
+    def save(self):
+        with self.lock:
+            data = {'start': self.window[0], 'end': self.window[1],
+                    'files': {name: p.state() for name, p in self.files.items()}}
+            if data == self.saved:
+                return
+            # the acks of the saved state are in the logs before the new one
+            self.ack_log.close()
+            self.generation += 1
+            self.ack_log = open(self._ack_log_name(self.generation), 'a', encoding='utf-8')
+            generation = self.generation
+        tmp_file = self.file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(dict(data, log=generation), f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.file)
+        self.saved = data
+        for n, log_file in self._ack_logs():
+            if n < generation:
+                os.remove(log_file)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.save()
+        # the acks are in the saved journal
+        self.ack_log.close()
+        os.remove(self.ack_log.name)
+
+    def _file_progress(self, name, state=None):
+        def log(device_token, offset, ts):
+            self.ack_log.write(json.dumps([name, device_token, offset, ts]) + '\n')
+            self.ack_log.flush()
+        return FileProgress(self.lock, state, log)
+
+    def _ack_log_name(self, generation):
+        return f"{self.file}.{generation}{ACK_LOG_SUFFIX}"
+
+    def _ack_logs(self):
+        """(N, file name) of the ack logs of the journal in the order of N"""
+        folder, prefix = path.split(path.abspath(self.file))
+        pattern = re.compile(re.escape(prefix) + r'\.(\d+)' + re.escape(ACK_LOG_SUFFIX) + '$')
+        logs = [(int(m.group(1)), path.join(folder, m.group(0)))
+                for m in map(pattern.match, os.listdir(folder)) if m]
+        return sorted(logs)
+
+    def _replay(self, log_files):
+        """Applies the acks of the logs to the loaded state, the line being written at the kill is skipped"""
+        for log_file in log_files:
+            with open(log_file, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        name, device_token, offset, ts = json.loads(line)
+                    except ValueError:
+                        break
+                    if name not in self.files:
+                        self.files[name] = self._file_progress(name)
+                    if not self.files[name].done:
+                        self.files[name].posted(device_token, offset, ts)
+
+    def _work(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.save()
+            except OSError as e:
+                print(f"ERROR at {datetime.now()}: the journal is not saved: {e}", file=stderr)
 
 
 def from_js_timestamp(js_timestamp):
     return round(int(js_timestamp) / 1e3)
 
 
-MAX_TRY = 5
+def upload_entries(sender, entries, starttime, endtime, progress=None):
+    """entries are (offset, entry) of EntryReader. The progress of the file is updated if it is given."""
+    for offset, entry in entries:
+        if progress:
+            progress.read(offset)
+        if in_period(entry, starttime, endtime):
+            device_token, message_json = split_entry(entry)
+            if progress is None:
+                sender.submit(device_token, message_json)
+            elif not progress.is_posted(device_token, offset):
+                sender.submit(device_token, message_json, progress.submit(device_token, offset, entry['ts']))
 
 
-def upload(tb_url, data, starttime, endtime, delay):
-    """data is json array:
-    [{"ts": 1616965289148, "devEui": "MOXAKON1-MR234-017", "values": {"PT": 0,...} }, {...}, ... ]
-    """
+def in_period(entry, starttime, endtime):
+    return starttime.timestamp() <= from_js_timestamp(entry['ts']) < endtime.timestamp()
+
 
-    for entry in data:
-        if starttime.timestamp() <= from_js_timestamp(entry['ts']) < endtime.timestamp():
-            device_token = entry['devEui']
-            message_json = entry
-            del message_json['devEui']
-            stop = False
-            try_count = 0
-            while not stop and try_count < MAX_TRY:
-                resp = upload_telemetry(tb_url, device_token, message_json)
-                if resp.status_code == 200:
-                    stop = True
-                else:
-                    log_error(entry, resp)
-                    try_count += 1
-                    time.sleep(delay / DELAY_MS)
-
-            time.sleep(delay / DELAY_MS)
+def split_entry(entry):
+    """(device token, message) of the log entry"""
+    message_json = dict(entry)
+    device_token = message_json.pop('devEui')
+    return device_token, message_json
 
 
 def get_args():
     parser = argparse.ArgumentParser(
         description="Uploads collector arxiv to Thingsboard. \
                      The data flow is being balanced such that TB is not overloaded.")
-    parser.add_argument('--format', help="expand or pack", default="pack")
-    parser.add_argument('--delay', help="Time in milliseconds between messages.", default=DELAY_MS, type=int)
+    parser.add_argument('--format', help="expand or pack. Both formats are read by the same parser, \
+                        the option is kept for compatibility.", default="pack")
+    parser.add_argument('--delay', help="Time in milliseconds between messages. Ignored if --rate is given. \
+                        0 means no limit.", default=DELAY_MS, type=int)
+    parser.add_argument('--rate', help="Messages per second for all devices", type=float)
+    parser.add_argument('--byte-rate', help="Bytes per second for all devices", type=float)
+    parser.add_argument('--device-rate', help="Messages per second for every device", type=float)
+    parser.add_argument('--device-byte-rate', help="Bytes per second for every device", type=float)
+    parser.add_argument('--workers', help="Number of threads posting the messages", default=WORKERS, type=int)
+    parser.add_argument('--batch', help="Maximal number of entries of a device posted in one message",
+                        default=BATCH_SIZE, type=int)
+    parser.add_argument('--batch-bytes', help="Maximal size of a message with a batch of entries",
+                        default=BATCH_BYTES, type=int)
+    parser.add_argument('--batch-age', help="Seconds an incomplete batch waits for more entries",
+                        default=BATCH_AGE_SEC, type=float)
     parser.add_argument('--start', help="The time of the beginning of the target period (including). \
                         String in ISO format as \"2021-01-25 09:01:00\" ", default='1970-01-02 12:00:00',
                         type=datetime.fromisoformat)
@@ -88,65 +570,358 @@ def get_args():
     parser.add_argument("--matchdate", help="Only files that match YYYYmmdd pattern with the date belonging to  \
                         the range given by --start and --end arguments. Used only input is a directory.",
                         action="store_true")
+    parser.add_argument('--no-index', help="Do not use and do not make the index files <log>.idx \
+                        with the ts ranges of the blocks of the logs", action="store_true")
+    parser.add_argument('--mqtt', help="Publish the telemetry by MQTT to the host of the url instead of HTTP. \
+                        --workers is not used.", action="store_true")
+    parser.add_argument('--mqtt-port', help="MQTT port of Thingsboard", default=1883, type=int)
+    parser.add_argument('--qos', help="QoS of MQTT messages: 1 - a message is complete when Thingsboard \
+                        acknowledges it, 0 - when it is sent", default=1, type=int, choices=(0, 1))
+    parser.add_argument('--inflight', help="Maximal number of MQTT messages of a connection \
+                        waiting for the acknowledgement", default=100, type=int)
+    parser.add_argument('--gateway', help="Access token of a gateway device. The telemetry is published by \
+                        the gateway API over one connection, devEui is the name of the device. \
+                        Without it, every device connects with devEui as the access token.")
+    parser.add_argument('--jobs', help="Number of processes reading the current and the next files of the input \
+                        directory while the current file is uploaded. With 1, the files are read by the uploading process.",
+                        default=JOBS, type=int)
+    parser.add_argument('--journal', help="The file where the progress of the upload is saved, the posted entries \
+                        are logged to the files <journal>.<N>.acks between the saves. \
+                        Without it the progress is not saved.")
+    parser.add_argument('--resume', help="Continue the upload saved in --journal: the files uploaded completely \
+                        are skipped, the other files are read from the first entry not posted, \
+                        the posted entries are not sent again; only the messages in flight at the failure \
+                        may be sent twice. The same --start and --end should be given.",
+                        action="store_true")
     parser.add_argument('url', help="TB host url")
     parser.add_argument('input', help="File with json data to upload or a directory where the files are stored.")
-    return parser.parse_args()
-
-
-def get_ts(dt_obj):
-    return dt_obj.timestamp()
+    args = parser.parse_args()
+    if args.resume and not args.journal:
+        parser.error("--resume requires --journal")
+    return args
 
 
 def is_gzip(filename):
     return filename[-2:] == "gz"
 
 
-def open_gz(filename):
-    return gz.open(filename, 'rt') if is_gzip(filename) else open(filename)
-
-
-def make_json(filename):
-    json_str = ""
-    bracket_found = False
-    with open_gz(filename) as f:
-        for line in f.readlines():
-            if line.rstrip('\n') == "],":
-                json_str += ","
-                bracket_found = True
+def open_binary(filename):
+    return gz.open(filename, 'rb') if is_gzip(filename) else open(filename, 'rb')
+
+
+class EntryReader:
+    """Iterates over (offset, entry) of the log file, offset is the position of the entry in the uncompressed file.
+    The file is read by chunks and the entries are decoded one by one, so the memory does not depend
+    on the size of the file. Both formats are read:
+        expand - arrays with an entry per line: "[", "\t{...},", ..., "],"
+        pack - an array per line: "[{...}, {...}],"
+    The brackets of the arrays, the commas and the whitespace between the entries are skipped.
+
+    ranges - [(start, stop), ...] byte ranges of the file to read, sorted; start is the offset of an entry,
+    stop is None for the end of the file. A gzip file is decompressed up to the range, but not parsed.
+    window - (min_ts, max_ts) in milliseconds: the lines whose ts are all out of [min_ts, max_ts)
+    are skipped without decoding (a line with entries not decoded completely or without ts is decoded).
+    The entries of the decoded lines are not filtered, the window only saves the time."""
+
+    def __init__(self, filename, ranges=None, window=None, chunk_size=CHUNK_SIZE):
+        self.filename = filename
+        self.ranges = [(0, None)] if ranges is None else ranges
+        self.window = window
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        with open_binary(self.filename) as f:
+            decode = None
+            read = 0  # bytes read from the file
+            for start, stop in self.ranges:
+                if decode is None or start > read:
+                    if start:
+                        f.seek(start)
+                    decode = codecs.getincrementaldecoder('utf-8')().decode
+                    buf = ''
+                    pos = 0
+                    # offset is the position in the file of buf[mark], so the bytes are counted once
+                    offset = read = start
+                    mark = 0
+                    checked = 0  # buf[:checked] is tested by the window
+                    eof = False
+                # else the range starts in the data read already, the entries before it are not yielded
+                while True:
+                    pos = SEPARATORS.match(buf, pos).end()
+                    if pos < len(buf):
+                        offset += _byte_len(buf[mark:pos])
+                        mark = pos
+                        if stop is not None and offset >= stop:
+                            break
+                        if buf[pos] != '{':
+                            raise ValueError(f"{self.filename}: unexpected {buf[pos]!r} at {offset}")
+                        if self.window and pos >= checked:
+                            line_end = buf.find('\n', pos)
+                            if line_end >= 0 or eof:
+                                checked = line_end if line_end >= 0 else len(buf)
+                                if not line_in_window(buf[pos:checked], self.window):
+                                    pos = checked
+                                    continue
+                        try:
+                            entry, end = DECODER.raw_decode(buf, pos)
+                        except json.JSONDecodeError:
+                            # the entry is not read completely
+                            if eof or len(buf) - pos > MAX_ENTRY_SIZE:
+                                raise
+                        else:
+                            if offset >= start:
+                                yield offset, entry
+                            pos = end
+                            continue
+                    elif eof:
+                        break
+                    chunk = f.read(self.chunk_size)
+                    read += len(chunk)
+                    eof = not chunk
+                    offset += _byte_len(buf[mark:pos])
+                    buf = buf[pos:] + decode(chunk, final=eof)
+                    checked = max(checked - pos, 0)
+                    pos = mark = 0
+
+
+def _byte_len(text):
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+
+def line_in_window(line, window):
+    """False if the line holds complete entries and all its ts are out of the window.
+    The ts are found by the pattern, so ts of nested objects are taken too, which only makes the test weaker."""
+    if not line.rstrip(LINE_END).endswith('}'):
+        return True
+    found = TS_FIELD.findall(line)
+    if not found:
+        return True
+    min_ts, max_ts = window
+    return any(min_ts <= int(ts) < max_ts for ts in found)
+
+
+def ms_window(starttime, endtime):
+    """[min_ts, max_ts) in milliseconds holding all ts passing the test of upload.
+    The bounds are a second wider, because upload rounds ts to seconds."""
+    return math.floor(starttime.timestamp() * 1e3) - 1000, math.ceil(endtime.timestamp() * 1e3) + 1000
+
+
+class LogIndex:
+    """Sidecar index of the log file: ts range of every block of about INDEX_BLOCK_BYTES of the uncompressed file.
+    It is kept in the file <log>.idx:
+        {"size": 81234, "mtime_ns": 1640800000000000000,
+         "blocks": [[start, stop, min_ts, max_ts], ...]}
+    start and stop are byte offsets of the lines starting the blocks, min_ts and max_ts are None
+    if the block has entries without ts. The index is valid while the size and mtime of the log are the same.
+    The index is built by searching ts in the raw lines, the entries are not decoded.
+    If an entry is written in several lines, the index has one block with unknown ts."""
+
+    def __init__(self, size, mtime_ns, blocks):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.blocks = blocks
+
+    @classmethod
+    def get(cls, filename):
+        """The index of the file: loaded if it is valid, otherwise built and saved"""
+        index = cls.load(filename)
+        if index is None:
+            print(f"Indexing {filename}...")
+            index = cls.build(filename)
+            index.save(filename)
+        return index
+
+    @classmethod
+    def load(cls, filename):
+        """The saved index or None if there is no valid index"""
+        try:
+            with open(filename + INDEX_SUFFIX, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        stat = os.stat(filename)
+        if data.get('size') != stat.st_size or data.get('mtime_ns') != stat.st_mtime_ns:
+            return None
+        return cls(data['size'], data['mtime_ns'], data['blocks'])
+
+    @classmethod
+    def build(cls, filename, block_bytes=INDEX_BLOCK_BYTES):
+        stat = os.stat(filename)
+        blocks = []
+        offset = 0
+        start = 0
+        found = []  # ts of the block
+        unknown = False  # the block has entries without ts
+        with open_binary(filename) as f:
+            for line in f:
+                if b'{' in line:
+                    if not line.rstrip(LINE_END.encode()).endswith(b'}'):
+                        # an entry continues in the next line, so the file can not be read from a line
+                        return cls(stat.st_size, stat.st_mtime_ns, [[0, None, None, None]])
+                    line_ts = TS_FIELD_BYTES.findall(line)
+                    unknown = unknown or not line_ts
+                    found.extend(map(int, line_ts))
+                offset += len(line)
+                if offset - start >= block_bytes:
+                    cls._add_block(blocks, start, offset, found, unknown)
+                    start, found, unknown = offset, [], False
+        cls._add_block(blocks, start, offset, found, unknown)
+        return cls(stat.st_size, stat.st_mtime_ns, blocks)
+
+    @staticmethod
+    def _add_block(blocks, start, stop, found, unknown):
+        if unknown:
+            blocks.append([start, stop, None, None])
+        elif found:
+            blocks.append([start, stop, min(found), max(found)])
+        # else the block has no entries
+
+    def save(self, filename):
+        tmp_file = filename + INDEX_SUFFIX + ".tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'size': self.size, 'mtime_ns': self.mtime_ns, 'blocks': self.blocks}, f)
+            os.replace(tmp_file, filename + INDEX_SUFFIX)
+        except OSError as e:
+            print(f"WARNING: the index of {filename} is not saved: {e}")
+
+    def ranges(self, window):
+        """Byte ranges of the blocks overlapping the window, adjacent blocks are merged"""
+        min_ts, max_ts = window
+        ranges = []
+        for start, stop, block_min, block_max in self.blocks:
+            if block_min is not None and (block_max < min_ts or block_min >= max_ts):
+                continue
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], stop)
             else:
-                if bracket_found:
-                    # skip current "[\n" line and proceed to the next
-                    bracket_found = False
-                else:
-                    json_str += line.rstrip('\n').lstrip('\t')
-    if bracket_found:
-        # if the last line of the file was like "]," then json str is like "[{...},...,{},"
-        json_str = json_str[:-1] + "]"
-    return json_str
-
-
-def upload_file(filename, url, fileformat, starttime, endtime, delay):
-    def upload_expand():
-        data = json.loads(make_json(filename))
-        print(f"Uploading data from {starttime} to {endtime}...")
-        upload(url, data, starttime, endtime, delay)
-
-    def upload_pack():
-        with open_gz(filename) as f:
-            print(f"Uploading data from {starttime} to {endtime}...")
-            for line in f.readlines():
-                if line[-2] == ",":
-                    data = json.loads(line[:-2])
-                else:
-                    data = json.loads(line)
-                upload(url, data, starttime, endtime, delay)
+                ranges.append((start, stop))
+        return ranges
+
 
+def upload_file(filename, sender, fileformat, starttime, endtime, use_index=True, journal=None):
     print(f"Reading {filename}...")
-    if fileformat == "expand":
-        upload_expand()
+    progress = journal.progress(filename) if journal else None
+    if progress and progress.done:
+        print(f"Uploaded already, skipped")
+        return
+    window = ms_window(starttime, endtime)
+    ranges = read_ranges(filename, window, use_index, progress.low if progress else 0)
+    if ranges:
+        print(f"Uploading data from {starttime} to {endtime}...")
+        upload_entries(sender, EntryReader(filename, ranges, window), starttime, endtime, progress)
+        print(f"Completed")
     else:
-        upload_pack()
-    print(f"Completed")
+        print(f"No data from {starttime} to {endtime}, skipped")
+    if progress:
+        progress.finish()
+
+
+def read_ranges(filename, window, use_index=True, low=0):
+    """Byte ranges of the file to read: the blocks overlapping the window, starting from the offset low"""
+    ranges = LogIndex.get(filename).ranges(window) if use_index else [(0, None)]
+    return [(max(start, low), stop) for start, stop in ranges if stop is None or stop > low]
+
+
+def parse_file(filename, starttime, endtime, use_index, low, chunks):
+    """Runs in a process of the pipeline. Puts the lists of (offset, device token, ts, message json)
+    of the entries in the period to the queue chunks, then None. If the file can not be read, puts the error text."""
+    try:
+        window = ms_window(starttime, endtime)
+        chunk = []
+        for offset, entry in EntryReader(filename, read_ranges(filename, window, use_index, low), window):
+            if in_period(entry, starttime, endtime):
+                device_token, message_json = split_entry(entry)
+                chunk.append((offset, device_token, entry['ts'], json.dumps(message_json).encode('utf-8')))
+                if len(chunk) >= PIPELINE_CHUNK:
+                    _put(chunks, chunk)
+                    chunk = []
+        if chunk:
+            _put(chunks, chunk)
+        _put(chunks, None)
+    except Exception:
+        _put(chunks, traceback.format_exc())
+
+
+def _put(chunks, item):
+    """Waits for a place in the queue while the uploading process is alive"""
+    while True:
+        try:
+            chunks.put(item, timeout=1)
+            return
+        except queue.Full:
+            if not mp.parent_process().is_alive():
+                # the data in the pipe will not be read, so the process does not wait to flush them
+                chunks.cancel_join_thread()
+                raise SystemExit(1)
+
+
+def _get(chunks, process, filename):
+    """Waits for the next chunk while the reading process is alive.
+    Raises RuntimeError if the process has exited without putting the end of the file, e.g. it was killed."""
+    while True:
+        try:
+            return chunks.get(timeout=PIPELINE_POLL_SEC)
+        except queue.Empty:
+            if not process.is_alive():
+                # the chunks put before the exit are flushed to the pipe already
+                try:
+                    return chunks.get(block=False)
+                except queue.Empty:
+                    raise RuntimeError(f"The process reading {filename} exited with code {process.exitcode}") from None
+
+
+def upload_files_pipelined(files, sender, starttime, endtime, use_index=True, journal=None, jobs=JOBS):
+    """Uploads the files in their order, while jobs processes decompress and parse the current and the next files.
+    A process passes the entries by a queue of PIPELINE_QUEUE chunks, so it stops if it is far ahead of the upload.
+    The entries of a file are submitted after all entries of the previous files,
+    so the entries of a device are posted in the order of the files."""
+    context = mp.get_context('spawn')  # the uploader threads are running, so the processes are not forked
+    files = iter(files)
+    parsers = deque()  # (filename, progress, process, queue) in the order of the files
+
+    def start_parser():
+        for filename in files:
+            progress = journal.progress(filename) if journal else None
+            if progress and progress.done:
+                print(f"{filename} is uploaded already, skipped")
+                continue
+            chunks = context.Queue(PIPELINE_QUEUE)
+            process = context.Process(target=parse_file, daemon=True,
+                                      args=(filename, starttime, endtime, use_index,
+                                            progress.low if progress else 0, chunks))
+            process.start()
+            parsers.append((filename, progress, process, chunks))
+            return
+
+    try:
+        for _ in range(jobs):
+            start_parser()
+        while parsers:
+            filename, progress, process, chunks = parsers[0]
+            print(f"Uploading {filename} from {starttime} to {endtime}...")
+            while True:
+                chunk = _get(chunks, process, filename)
+                if chunk is None:
+                    break
+                if isinstance(chunk, str):
+                    raise RuntimeError(f"Failed to read {filename}:\n{chunk}")
+                for offset, device_token, ts, message in chunk:
+                    if progress is None:
+                        sender.submit_encoded(device_token, message)
+                    else:
+                        progress.read(offset)
+                        if not progress.is_posted(device_token, offset):
+                            sender.submit_encoded(device_token, message, progress.submit(device_token, offset, ts))
+            process.join()
+            parsers.popleft()
+            start_parser()
+            if progress:
+                progress.finish()
+            print(f"Completed {filename}")
+    finally:
+        for filename, progress, process, chunks in parsers:
+            process.terminate()
 
 
 def is_log(filename):
@@ -191,20 +966,44 @@ def main(args):
             f_list = [f for f in f_list if match_date(path.basename(f), args.start, args.end)]
         return sorted(f_list, key=lambda x: os.stat(x).st_mtime)
 
-    if path.isdir(args.input):
-        print(f"The input directory is {args.input}")
-        files = list_files()
-        nl = '\n'
-        print(f"Files selected for upload:\n {nl.join(files)}")
-        for fname in files:
-            upload_file(fname, args.url, args.format, args.start, args.end, args.delay)
-    else:
-        upload_file(args.input,
-                    args.url,
-                    args.format,
-                    args.start,
-                    args.end,
-                    args.delay)
+    def make_limiter():
+        if args.rate is not None:
+            msg_rate = args.rate
+        else:
+            msg_rate = DELAY_MS / args.delay if args.delay else None
+        return RateLimiter(msg_rate, args.byte_rate, args.device_rate, args.device_byte_rate)
+
+    def make_uploader():
+        if args.mqtt:
+            import tb_mqtt
+            return tb_mqtt.MqttUploader(urlparse(args.url).hostname, args.mqtt_port, args.qos, args.inflight,
+                                        args.gateway, make_limiter())
+        return Uploader(args.url, args.workers, make_limiter())
+
+    # without --journal the progress is not saved, journal is None
+    saved_progress = Journal(args.journal, args.start, args.end, args.resume) if args.journal else nullcontext()
+    # the journal is closed after the uploader, so it keeps the messages posted at exit
+    with saved_progress as journal, \
+            make_uploader() as uploader, \
+            Batcher(uploader, args.batch, args.batch_bytes, args.batch_age) as sender:
+        if path.isdir(args.input):
+            print(f"The input directory is {args.input}")
+            files = list_files()
+            nl = '\n'
+            print(f"Files selected for upload:\n {nl.join(files)}")
+            if args.jobs > 1:
+                upload_files_pipelined(files, sender, args.start, args.end, not args.no_index, journal, args.jobs)
+            else:
+                for fname in files:
+                    upload_file(fname, sender, args.format, args.start, args.end, not args.no_index, journal)
+        else:
+            upload_file(args.input,
+                        sender,
+                        args.format,
+                        args.start,
+                        args.end,
+                        not args.no_index,
+                        journal)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,341 @@
+"""
+Writers of the time series tables produced by download_new and convert.
+
+Formats:
+    csv - text file with the header, the values are separated by the delimiter and are not quoted
+    parquet - Apache Parquet, every write() adds a row group
+    feather - Arrow IPC file (Feather v2), every write() adds a record batch
+
+The columns of parquet and feather files are typed: ts is int64,
+the values are bool, int64, float64 or string, depending on what the column holds.
+Empty values are stored as nulls.
+
+A columnar file can not be appended after it is closed, so the columnar output is a directory of parts:
+    P1.parquet/part-00000.parquet
+    P1.parquet/part-00001.parquet
+Every writer opened in 'a' mode adds a new part, mode 'w' removes the old parts.
+A part has a single schema; if the header or the type of a column changes, the writer starts a new part.
+So the parts may have different columns and types: read_table(path) reads the directory as one table,
+the columns absent from a part are nulls and a column gets the widest of its types in the parts.
+pyarrow.dataset.dataset(path) and pandas.read_parquet(path) take the schema of one part,
+so they read the directory correctly only if all parts have the same schema.
+
+Parquet and feather require pyarrow.
+"""
+import os
+import shutil
+from os import path
+
+FORMATS = ('csv', 'parquet', 'feather')
+ROW_GROUP_SIZE = 100000
+PART_PREFIX = "part-"
+BROKEN_PREFIX = "."  # parts renamed so are skipped by pyarrow.dataset
+
+
+def open_writer(fmt, file, mode='a', delimiter=','):
+    if fmt == 'csv':
+        return CsvWriter(file, mode, delimiter)
+    elif fmt == 'parquet':
+        return ParquetWriter(file, mode)
+    elif fmt == 'feather':
+        return FeatherWriter(file, mode)
+    else:
+        raise ValueError(f"Unknown format {fmt}. Possible values are {', '.join(FORMATS)}")
+
+
+def file_extension(fmt):
+    return '.' + fmt
+
+
+def is_columnar(file):
+    return file.endswith(file_extension('parquet')) or file.endswith(file_extension('feather'))
+
+
+def output_size(file):
+    """Size of the file or the total size of the parts of a columnar file"""
+    if path.isdir(file):
+        return sum(os.stat(p).st_size for p in list_parts(file))
+    return path.getsize(file)
+
+
+def list_parts(folder):
+    if not path.isdir(folder):
+        return []
+    return sorted(e.path for e in os.scandir(folder) if e.name.startswith(PART_PREFIX))
+
+
+def next_part(folder, extension):
+    """Path of the part following the existing parts of the folder"""
+    parts = list_parts(folder)
+    number = int(path.basename(parts[-1])[len(PART_PREFIX):].split('.')[0]) + 1 if parts else 0
+    return path.join(folder, f"{PART_PREFIX}{number:05d}{extension}")
+
+
+def append_parts(src, dst):
+    """Moves the parts of the columnar file src to the end of the columnar file dst"""
+    os.makedirs(dst, exist_ok=True)
+    for part in list_parts(src):
+        os.replace(part, next_part(dst, path.splitext(part)[1]))
+
+
+def last_ts(file, ts_field='ts'):
+    """Maximal ts of the columnar file or None if it has no rows.
+    Parts which can not be read (e.g. not closed because the writer was killed) are skipped."""
+    result = None
+    for part in list_parts(file):
+        try:
+            part_max = _part_max(part, ts_field)
+        except Exception:
+            continue
+        if part_max is not None and (result is None or part_max > result):
+            result = part_max
+    return result
+
+
+def read_table(file):
+    """All parts of the columnar file as one pyarrow.Table.
+    The columns are in the order they appear in the parts, the types are widened by wider_type."""
+    import pyarrow as pa
+    tables = [_read_part(part) for part in list_parts(file)]
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            types[field.name] = wider_type(types[field.name], field.type) if field.name in types else field.type
+    schema = pa.schema(list(types.items()))
+    return pa.concat_tables([_conform(table, schema) for table in tables]) if tables else schema.empty_table()
+
+
+def wider_type(a, b):
+    """The type holding the values of both types, as column_type chooses it for the mixed values"""
+    import pyarrow as pa
+    names = {_type_name(a), _type_name(b)}
+    if len(names) == 1:
+        return a
+    if 'null' in names:
+        return b if _type_name(a) == 'null' else a
+    if names == {'int64', 'float64'}:
+        return pa.float64()
+    return pa.string()
+
+
+def _conform(table, schema):
+    import pyarrow as pa
+    columns = [table.column(f.name).cast(f.type) if f.name in table.column_names else pa.nulls(len(table), f.type)
+               for f in schema]
+    return pa.table(columns, schema=schema)
+
+
+def _part_max(part, field):
+    if part.endswith(file_extension('parquet')):
+        # the statistics of the row groups are in the footer, so the data are not read
+        import pyarrow.parquet as pq
+        metadata = pq.ParquetFile(part).metadata
+        column = metadata.schema.names.index(field)
+        maximums = [metadata.row_group(i).column(column).statistics.max for i in range(metadata.num_row_groups)]
+        return max(maximums, default=None)
+    import pyarrow.compute as pc
+    return pc.max(_read_part(part, [field])[field]).as_py()
+
+
+def _read_part(part, columns=None):
+    if part.endswith(file_extension('parquet')):
+        import pyarrow.parquet as pq
+        return pq.read_table(part, columns=columns)
+    import pyarrow.feather as feather
+    return feather.read_table(part, columns=columns)
+
+
+class TableWriter:
+    """Writes rows with the given header. The writer is used as a context manager or closed explicitly."""
+
+    def write(self, header, rows):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class CsvWriter(TableWriter):
+    """The header is written if the file is new or the mode is 'w'."""
+
+    def __init__(self, file, mode='a', delimiter=','):
+        self.file = file
+        self.delimiter = delimiter
+        self.need_header = not path.exists(file) or mode == 'w'
+        self.f = open(file, mode, newline='', encoding='utf-8')
+
+    def write(self, header, rows):
+        if self.need_header:
+            self.f.write(self.delimiter.join(header) + '\n')
+            self.need_header = False
+        for row in rows:
+            self.f.write(self.delimiter.join(map(_csv_value, row)) + '\n')
+        # flushed, so the size of the file tells what is written
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def _csv_value(value):
+    return '' if value is None else str(value)
+
+
+class ColumnarWriter(TableWriter):
+    def __init__(self, file, mode='a', row_group_size=ROW_GROUP_SIZE):
+        import pyarrow  # fail early if pyarrow is not installed
+        self.folder = file
+        self.row_group_size = row_group_size
+        if mode == 'w' and path.exists(file):
+            shutil.rmtree(file)
+        os.makedirs(file, exist_ok=True)
+        self._hide_broken_parts()
+        self.writer = None
+        self.schema = None
+
+    def write(self, header, rows):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.row_group_size:
+                self._write_chunk(header, chunk)
+                chunk = []
+        if chunk:
+            self._write_chunk(header, chunk)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def _write_chunk(self, header, rows):
+        import pyarrow as pa
+        columns = list(zip(*rows))
+        types = [column_type(c) for c in columns]
+        if self.schema is not None:
+            # keep the schema of the part if the new values can be stored in it
+            file_types = dict(zip(self.schema.names, self.schema.types))
+            if list(header) == self.schema.names and all(_fits(t, file_types[h]) for h, t in zip(header, types)):
+                types = [file_types[h] for h in header]
+        schema = pa.schema([(h, t) for h, t in zip(header, types)])
+        table = pa.table([to_array(c, t) for c, t in zip(columns, types)], schema=schema)
+        if self.schema is None or not schema.equals(self.schema):
+            self.close()
+            self.writer = self._open_part(next_part(self.folder, self.extension), schema)
+            self.schema = schema
+        self.writer.write_table(table)
+
+    def _hide_broken_parts(self):
+        for part in list_parts(self.folder):
+            try:
+                _read_part(part, [])
+            except Exception:
+                print(f"WARNING: {part} is broken and ignored")
+                os.rename(part, path.join(self.folder, BROKEN_PREFIX + path.basename(part)))
+
+
+class ParquetWriter(ColumnarWriter):
+    extension = file_extension('parquet')
+
+    def _open_part(self, part, schema):
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(part, schema)
+
+
+class FeatherWriter(ColumnarWriter):
+    extension = file_extension('feather')
+
+    def _open_part(self, part, schema):
+        import pyarrow as pa
+        return pa.ipc.new_file(part, schema)
+
+
+# types of the columns from the narrowest to the widest
+TYPE_ORDER = ('bool', 'int64', 'float64', 'string')
+
+
+def column_type(values):
+    """The narrowest arrow type holding all values.
+    The values are python objects or strings, as Thingsboard returns them: 'true', '12', '1.5'.
+    A column of booleans and numbers is string, because neither type holds the other."""
+    import pyarrow as pa
+    kinds = set()
+    for v in values:
+        if not _is_null(v):
+            kinds.add(_value_type(v))
+            if 'string' in kinds:
+                break
+    if not kinds:
+        return pa.null()
+    if 'bool' in kinds and len(kinds) > 1:
+        return pa.string()
+    return pa.type_for_alias(max(kinds, key=TYPE_ORDER.index))
+
+
+def _fits(value_type, file_type):
+    names = [_type_name(value_type), _type_name(file_type)]
+    if names[0] == 'null' or names[1] == 'string':
+        return True
+    if 'null' in names or ('bool' in names and names[0] != names[1]):
+        return False
+    return TYPE_ORDER.index(names[0]) <= TYPE_ORDER.index(names[1])
+
+
+def _type_name(arrow_type):
+    """The name of the type in TYPE_ORDER"""
+    name = str(arrow_type)
+    return 'float64' if name == 'double' else name
+
+
+def _value_type(v):
+    if isinstance(v, bool):
+        return 'bool'
+    if isinstance(v, int):
+        return 'int64'
+    if isinstance(v, float):
+        return 'float64'
+    s = str(v)
+    if s in ('true', 'false', 'True', 'False'):
+        return 'bool'
+    try:
+        int(s)
+        return 'int64'
+    except ValueError:
+        pass
+    try:
+        float(s)
+        return 'float64'
+    except ValueError:
+        return 'string'
+
+
+def _is_null(v):
+    return v is None or v == ''
+
+
+def to_array(values, arrow_type):
+    import pyarrow as pa
+    kind = _type_name(arrow_type)
+    if kind == 'bool':
+        conv = _to_bool
+    elif kind == 'int64':
+        conv = int
+    elif kind == 'float64':
+        conv = float
+    elif kind == 'null':
+        conv = None
+    else:
+        conv = str
+    return pa.array([None if _is_null(v) else conv(v) for v in values], type=arrow_type)
+
+
+def _to_bool(v):
+    if isinstance(v, str):
+        return v in ('true', 'True')
+    return bool(v)